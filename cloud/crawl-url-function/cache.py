@@ -1,16 +1,32 @@
 import copy
-import difflib
 import logging
+import time
+from concurrent import futures
 from enum import Enum, auto
 from hashlib import sha256
-from typing import Any, Callable, Dict, Optional, Sequence, Union
+from typing import Any, Dict, Iterable, Optional, Sequence, Tuple, Union
 
-import google.cloud.firestore_v1.base_query
+import google.api_core.exceptions
 import requests
 from google.cloud import firestore
 from requests.structures import CaseInsensitiveDict
 
+import config
+import linediff
+from codec import decode_text, encode_text, fits_in_document
+from download import read_body
 from htmlutil import HtmlProcessor
+from ratelimit import OutOfTime, RateLimiter, parse_retry_after
+from revisit import RevisitHistory
+from simhash import distance, simhash
+from storage import (
+    ContentWriter,
+    CrawlEntry,
+    Storage,
+    as_storage,
+    url_digest,
+)
+from timing import span
 
 
 def is_good_html_response(response):
@@ -20,14 +36,112 @@ def is_good_html_response(response):
 
 
 class Cache:
-    def __init__(self, db: firestore.Client):
-        self.db = db
+    def __init__(
+        self,
+        db: Union[Storage, firestore.Client],
+        index_prev_crawl: bool = True,
+        near_duplicate_bits: Optional[int] = None,
+        max_body_bytes: int = config.MAX_BODY_BYTES,
+    ):
+        """
+        Args:
+            db: The Storage holding the crawls, or a Firestore client to use
+                with FirestoreStorage.
+            index_prev_crawl: Whether to load the whole previous crawl into
+                memory on first use, instead of reading it one URL at a time.
+            near_duplicate_bits: If given, changed pages whose markdown's
+                SimHash is within this many bits of the previous crawl's are
+                treated as unchanged.
+            max_body_bytes: The largest HTML page to download and store.
+        """
+        self.storage = as_storage(db)
+        self.index_prev_crawl = index_prev_crawl
+        self.near_duplicate_bits = near_duplicate_bits
+        self.max_body_bytes = max_body_bytes
+        self._prev_crawl_index: Optional[CrawlIndex] = None
+
+    def prev_crawl_index(self, prev_crawl: str) -> "CrawlIndex":
+        """Returns the index of prev_crawl, loading it if necessary.
+
+        Only the most recently used crawl stays in memory.
+        """
+        if self._prev_crawl_index is None or self._prev_crawl_index.crawl != prev_crawl:
+            self._prev_crawl_index = CrawlIndex.load(self.storage, prev_crawl)
+        return self._prev_crawl_index
 
     def response_for(
         self, *, url: str, curr_crawl: str, prev_crawl: str
     ) -> "CachedResponse":
         """Loads url from the cache into a CachedResponse."""
-        return CachedResponse(self.db, url, curr_crawl, prev_crawl)
+        responses = self.responses_for(
+            [url], curr_crawl=curr_crawl, prev_crawl=prev_crawl
+        )
+        return responses[url]
+
+    def responses_for(
+        self, urls: Iterable[str], *, curr_crawl: str, prev_crawl: str
+    ) -> Dict[str, "CachedResponse"]:
+        """Loads many URLs from the cache with a single batched read.
+
+        Returns a CachedResponse for each URL.
+        """
+        urls = list(urls)
+        if not urls:
+            return {}
+        if self.index_prev_crawl:
+            prev_index = self.prev_crawl_index(prev_crawl)
+            curr_entries = self.storage.read_crawl_entries(
+                [(curr_crawl, url) for url in urls]
+            )
+            entries = {
+                url: (curr_entries[(curr_crawl, url)] is not None, prev_index.get(url))
+                for url in urls
+            }
+        else:
+            crawl_entries = self.storage.read_crawl_entries(
+                [(crawl, url) for url in urls for crawl in (curr_crawl, prev_crawl)]
+            )
+            entries = {
+                url: (
+                    crawl_entries[(curr_crawl, url)] is not None,
+                    crawl_entries[(prev_crawl, url)],
+                )
+                for url in urls
+            }
+        return {
+            url: CachedResponse(
+                self.storage,
+                url,
+                curr_crawl,
+                prev_crawl,
+                entries=entries[url],
+                near_duplicate_bits=self.near_duplicate_bits,
+                max_body_bytes=self.max_body_bytes,
+            )
+            for url in urls
+        }
+
+
+class CrawlIndex:
+    """An in-memory copy of one crawl, which is immutable once it's finished."""
+
+    def __init__(self, crawl: str, entries: Dict[bytes, CrawlEntry]):
+        self.crawl = crawl
+        # Keyed by the SHA-256 digest of the URL.
+        self.entries = entries
+
+    @classmethod
+    def load(cls, storage: Storage, crawl: str) -> "CrawlIndex":
+        logging.info("Indexing crawl %s.", crawl)
+        entries = dict(storage.crawl_entries(crawl))
+        logging.info("Indexed %d pages from crawl %s.", len(entries), crawl)
+        return cls(crawl, entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, url: str) -> Optional[CrawlEntry]:
+        return self.entries.get(url_digest(url))
 
 
 class CacheState(Enum):
@@ -50,6 +164,11 @@ class PresenceChange(Enum):
     REMOVED = auto()
 
 
+# Reads the previous crawl's links and text while pages are being fetched.
+_prefetch_executor = futures.ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix="prefetch"
+)
+
 RELEVANT_HEADERS = ["etag", "last-modified", "location", "content-type"]
 
 
@@ -60,22 +179,39 @@ class Response:
     content_reference: Optional[firestore.DocumentReference] = None
     text_content_reference: Optional[firestore.DocumentReference] = None
     _links: Optional[Sequence[str]] = None
+    _links_future: Optional["futures.Future[Optional[Sequence[str]]]"] = None
 
     @property
     def links(self):
+        if self._links is None and self._links_future is not None:
+            self._links = self._links_future.result()
         if self._links is None and self.content_reference is not None:
-            self._links = self.content_reference.get().get("links")
+            self._links = read_links(self.content_reference)
         return self._links
 
 
 class CachedResponse(Response):
     def __init__(
-        self, db: firestore.Client, url: str, curr_crawl: str, prev_crawl: str
+        self,
+        db: Union[Storage, firestore.Client],
+        url: str,
+        curr_crawl: str,
+        prev_crawl: str,
+        entries: Optional[Tuple[bool, Optional[CrawlEntry]]] = None,
+        near_duplicate_bits: Optional[int] = None,
+        max_body_bytes: int = config.MAX_BODY_BYTES,
     ):
-        """Loads a response from the current or previous crawl in Firestore if
-        it was previously crawled.
+        """Loads a response from the current or previous crawl in db if it was
+        previously crawled.
+
+        entries holds whether url is already in the current crawl, and its entry
+        in the previous crawl, if the caller already loaded them. If it's None,
+        they're read here. near_duplicate_bits and max_body_bytes are as for
+        Cache.
         """
-        self.db = db
+        self.storage = as_storage(db)
+        self.near_duplicate_bits = near_duplicate_bits
+        self.max_body_bytes = max_body_bytes
         self.url = url
         self.prev_crawl = prev_crawl
         self.curr_crawl = curr_crawl
@@ -83,126 +219,273 @@ class CachedResponse(Response):
         self.headers: Dict[str, str] = {}
         self.content_reference: Optional[firestore.DocumentReference] = None
         self.text_content_reference: Optional[firestore.DocumentReference] = None
+        self.history: Optional[RevisitHistory] = None
         self.state = CacheState.ABSENT
 
-        response_doc = read_one_firestore_doc(
-            db.collection(f"crawl-{curr_crawl}").where("url", "==", self.url)
-        )
-
-        if response_doc is not None:
+        if entries is None:
+            crawl_entries = self.storage.read_crawl_entries(
+                [(curr_crawl, url), (prev_crawl, url)]
+            )
+            entries = (
+                crawl_entries[(curr_crawl, url)] is not None,
+                crawl_entries[(prev_crawl, url)],
+            )
+        in_curr_crawl, prev_entry = entries
+
+        if in_curr_crawl:
             self.state = CacheState.FRESH
             return
 
-        response_doc = read_one_firestore_doc(
-            db.collection(f"crawl-{prev_crawl}").where("url", "==", self.url)
-        )
-        if response_doc is not None:
+        if prev_entry is not None:
             self.state = CacheState.STALE
         else:
             self.state = CacheState.ABSENT
             return
 
-        self.status_code = response_doc.get("status_code")
+        self.status_code = prev_entry.status_code
 
         # Treat cached errors in the previous crawl as missing entirely.
         if self.status_code >= 400:
             self.state = CacheState.ABSENT
             return
 
-        self.headers = response_doc.get("headers")
+        self.headers = dict(prev_entry.headers)
+        self.history = prev_entry.history
 
         if is_good_html_response(self):
-            self.content_reference = response_doc.get("content")
-            try:
-                self.text_content_reference = response_doc.get("text_content")
-            except KeyError:
-                self.text_content_reference = None
-
-    def fetch(self, session: requests.Session) -> "FreshResponse":
-        """Freshens this resource from the network."""
+            if prev_entry.content_path is not None:
+                self.content_reference = self.storage.document(prev_entry.content_path)
+            if prev_entry.text_content_path is not None:
+                self.text_content_reference = self.storage.document(
+                    prev_entry.text_content_path
+                )
+
+    def fetch(
+        self,
+        session: requests.Session,
+        rate_limiter: Optional[RateLimiter] = None,
+        content_writer: Optional["ContentWriter"] = None,
+        deadline: Optional[float] = None,
+    ) -> "FreshResponse":
+        """Freshens this resource from the network.
+
+        If rate_limiter is given, waits for it just before the request, so all
+        the cache work before and after the request happens outside the
+        politeness delay. If that wait would go past deadline, a
+        time.monotonic() value, raises ratelimit.OutOfTime instead. If
+        content_writer is given, new content is queued to it instead of being
+        written immediately, and the caller has to flush it before writing the
+        response.
+        """
         assert (
             self.state != CacheState.FRESH
         ), "Shouldn't be trying to fetch fresh resources."
 
         result = FreshResponse(self.url)
         headers = None
+        prev_text = None
+        prev_links = None
         if self.state == CacheState.STALE:
             if "etag" in self.headers:
                 headers = {"If-None-Match": self.headers["etag"]}
             elif "last-modified" in self.headers:
                 headers = {"If-Modified-Since": self.headers["last-modified"]}
+            # Read what the response will need from the previous crawl while
+            # waiting for the network: the links if the page is unchanged, or
+            # the text to diff against if it changed.
+            if self.content_reference is not None:
+                prev_links = _prefetch_executor.submit(
+                    read_links, self.content_reference
+                )
+            if self.text_content_reference is not None:
+                prev_text = _prefetch_executor.submit(
+                    read_fingerprinted_text, self.text_content_reference
+                )
 
         # Fetch the URL for either STALE or ABSENT resources.
-        with session.get(
-            self.url, headers=headers, stream=True, allow_redirects=False
-        ) as response:
+        if rate_limiter is not None:
+            with span("rate_limit_wait"):
+                try:
+                    rate_limiter.acquire(deadline)
+                except OutOfTime:
+                    for prefetch in (prev_text, prev_links):
+                        if prefetch is not None:
+                            prefetch.cancel()
+                    raise
+        start = time.monotonic()
+        with span("fetch"):
+            response = session.get(
+                self.url, headers=headers, stream=True, allow_redirects=False
+            )
+        with response:
+            latency = time.monotonic() - start
+            retry_after = None
+            if response.status_code in (429, 503):
+                retry_after = parse_retry_after(response.headers.get("retry-after"))
+                logging.warning(
+                    "%s returned %d; Retry-After: %s",
+                    self.url,
+                    response.status_code,
+                    retry_after,
+                )
+            if rate_limiter is not None:
+                rate_limiter.record(response.status_code, latency, retry_after)
             if response.status_code == 304 and self.state == CacheState.STALE:
-                result.change = PresenceChange.SAME
+                self._copy_unchanged(result)
                 result.status_code = 200
+                result._links_future = prev_links
                 # Update stored headers as described by https://httpwg.org/specs/rfc9111.html#rfc.section.3.2
-                result.headers = self._update_relevant_headers(
-                    copy.deepcopy(self.headers), response.headers
-                )
-                result.content_reference = self.content_reference
-                result.text_content_reference = self.text_content_reference
+                self._update_relevant_headers(result.headers, response.headers)
             else:
                 result.status_code = response.status_code
                 result.headers = self._update_relevant_headers({}, response.headers)
                 result.content_reference = None
                 result.text_content_reference = None
                 markdown = ""
-                # We don't need the content of non-HTML files or failed responses.
+                fingerprint = None
+                # We don't need the content of non-HTML files or failed responses,
+                # so they're never read.
+                body = None
+                oversize = False
                 if is_good_html_response(response):
-                    processor = HtmlProcessor(response.content, result.url)
+                    with span("download"):
+                        body = read_body(response, self.max_body_bytes)
+                    if body is None:
+                        oversize = True
+                        logging.error(
+                            "Not storing %r: body is over %d bytes",
+                            result.url,
+                            self.max_body_bytes,
+                        )
+                if body is not None:
+                    with span("parse"):
+                        processor = HtmlProcessor(
+                            body,
+                            result.url,
+                            response.headers.get("content-type"),
+                        )
                     try:
-                        markdown = processor.get_markdown()
+                        with span("markdown"):
+                            markdown = processor.get_markdown()
                     except ValueError:
                         logging.exception("Failed to parse HTML in %r", result.url)
                         markdown = ""
-                    result.content_reference = self.db.collection("content").document(
-                        sha256(processor.content).hexdigest()
+                    result.content_reference = self.storage.document(
+                        f"content/{sha256(processor.content).hexdigest()}"
+                    )
+                    result.text_content_reference = self.storage.document(
+                        f"text_content/{sha256(markdown.encode()).hexdigest()}"
                     )
-                    result.text_content_reference = self.db.collection(
-                        "text_content"
-                    ).document(sha256(markdown.encode()).hexdigest())
                     # Go ahead and write the links and content to the database. The
                     # content-addressed store isn't used for signaling any part
                     # of the crawl, and we'll definitely need the outbound links.
-                    result._links = set_if_absent(
-                        result.content_reference,
-                        lambda: {
-                            "links": list(processor.scrape_links()),
-                            "content": processor.content.decode(
-                                processor.encoding, errors="backslashreplace"
-                            ),
-                        },
-                    )["links"]
-                    set_if_absent(
-                        result.text_content_reference,
-                        lambda: {"text": markdown},
-                    )
+                    result._links = list(processor.scrape_links())
+                    with span("encode"):
+                        content_value: Dict[str, Any] = {"links": result._links}
+                        add_encoded(
+                            content_value,
+                            "content",
+                            processor.text,
+                            result.url,
+                        )
+                        text_value: Dict[str, Any] = {}
+                        add_encoded(text_value, "text", markdown, result.url)
+                    with span("fingerprint"):
+                        fingerprint = simhash(markdown)
+                        text_value["simhash"] = fingerprint
+                    with span("store_content"):
+                        create_if_absent(
+                            result.content_reference, content_value, content_writer
+                        )
+                        create_if_absent(
+                            result.text_content_reference, text_value, content_writer
+                        )
 
-                result.change = self._describe_change(result)
+                if oversize and self.state == CacheState.STALE:
+                    # We can't tell whether it changed, so keep the previous
+                    # crawl's version rather than report an empty change.
+                    self._copy_unchanged(result)
+                    result._links_future = prev_links
+                else:
+                    result.change = self._describe_change(result)
                 if (
                     result.change == PresenceChange.CHANGED
-                    and self.text_content_reference is not None
+                    and prev_text is not None
                     and markdown != ""
                 ):
-                    result.diff = "".join(
-                        difflib.unified_diff(
-                            self.text_content_reference.get()
-                            .get("text")
-                            .splitlines(keepends=True),
-                            markdown.splitlines(keepends=True),
-                            fromfile=self.url,
-                            fromfiledate=self.prev_crawl,
-                            tofile=self.url,
-                            tofiledate=self.curr_crawl,
-                        )
-                    )
+                    with span("prev_text_wait"):
+                        old_markdown, old_fingerprint = prev_text.result()
+                    if self._is_near_duplicate(
+                        old_markdown, old_fingerprint, fingerprint
+                    ):
+                        # Keep the previous crawl's text, so the next crawl is
+                        # compared with the last version that was reported and
+                        # small changes can't accumulate unnoticed. The new
+                        # content stays, since its links are current.
+                        result.change = PresenceChange.SAME
+                        result.text_content_reference = self.text_content_reference
+                    else:
+                        with span("diff"):
+                            result.diff = "".join(
+                                linediff.unified_diff(
+                                    old_markdown.splitlines(keepends=True),
+                                    markdown.splitlines(keepends=True),
+                                    fromfile=self.url,
+                                    fromfiledate=self.prev_crawl,
+                                    tofile=self.url,
+                                    tofiledate=self.curr_crawl,
+                                )
+                            )
+
+        # Drop whichever reads weren't needed, if they haven't started yet.
+        for prefetch in (prev_text, prev_links):
+            if prefetch is not None and prefetch is not result._links_future:
+                prefetch.cancel()
+
+        changed = result.change in (PresenceChange.NEW, PresenceChange.CHANGED)
+        if self.history is None:
+            result.history = RevisitHistory.first_fetch(changed)
+        else:
+            result.history = self.history.after_fetch(changed)
+        return result
 
+    def reuse(self) -> "FreshResponse":
+        """Carries this resource into the current crawl without fetching it, as
+        if the server had said it was unchanged.
+        """
+        assert self.state == CacheState.STALE, "Can only reuse stale resources."
+        result = FreshResponse(self.url)
+        self._copy_unchanged(result)
+        result.history = (self.history or RevisitHistory()).after_skip()
         return result
 
+    def _is_near_duplicate(
+        self,
+        old_markdown: str,
+        old_fingerprint: Optional[int],
+        fingerprint: Optional[int],
+    ) -> bool:
+        """Returns whether a change is small enough to ignore."""
+        if self.near_duplicate_bits is None or fingerprint is None:
+            return False
+        if old_fingerprint is None:
+            # Text stored before fingerprints were.
+            old_fingerprint = simhash(old_markdown)
+        bits = distance(old_fingerprint, fingerprint)
+        if bits > self.near_duplicate_bits:
+            return False
+        logging.info(
+            "Ignoring a change to %r: SimHash differs by %d bits", self.url, bits
+        )
+        return True
+
+    def _copy_unchanged(self, result: "FreshResponse") -> None:
+        result.change = PresenceChange.SAME
+        result.status_code = self.status_code
+        result.headers = copy.deepcopy(self.headers)
+        result.content_reference = self.content_reference
+        result.text_content_reference = self.text_content_reference
+
     @staticmethod
     def _update_relevant_headers(
         dst: Dict[str, str], src: Union[Dict[str, str], CaseInsensitiveDict[str]]
@@ -246,23 +529,31 @@ class FreshResponse(Response):
         self.content_reference = None
         self.change = PresenceChange.NEW
         self.diff = ""
-
-    def write_to_firestore(self, db: firestore.Client, current_crawl: str) -> None:
-        """Write a response to the current crawl's directory, making sure the
-        content is in the content-addressed store.
+        self.history: Optional[RevisitHistory] = None
+
+    def write(
+        self,
+        db: Union[Storage, firestore.Client],
+        current_crawl: str,
+        batch: Any = None,
+    ) -> None:
+        """Write a response to the current crawl, whose content is already in
+        the content-addressed store.
+
+        If batch is given, the write is added to it instead of being sent
+        immediately.
         """
-        logging.info("Writing %s to Firestore.", self)
-        db.collection(f"crawl-{current_crawl}").document(
-            sha256(self.url.encode()).hexdigest()
-        ).set(
-            {
-                "url": self.url,
-                "status_code": self.status_code,
-                "headers": self.headers,
-                "content": self.content_reference,
-                "text_content": self.text_content_reference,
-            }
-        )
+        logging.info("Writing %s to storage.", self)
+        value = {
+            "url": self.url,
+            "status_code": self.status_code,
+            "headers": self.headers,
+            "content": self.content_reference,
+            "text_content": self.text_content_reference,
+        }
+        if self.history is not None:
+            value["history"] = self.history.to_dict()
+        as_storage(db).write_crawl_entry(current_crawl, self.url, value, batch)
 
     def __str__(self):
         content_reference = None
@@ -278,25 +569,51 @@ class FreshResponse(Response):
         )
 
 
-def read_one_firestore_doc(
-    query: google.cloud.firestore_v1.base_query.BaseQuery,
-) -> Optional[firestore.DocumentSnapshot]:
-    """Reads one document from a Firestore query, or returns None if there are no documents."""
-    return next(query.limit(1).stream(), None)
+def add_encoded(value: Dict[str, Any], field: str, text: str, url: str) -> None:
+    """Sets value[field] to text, compressed, unless it's too big to store."""
+    encoded = encode_text(text)
+    if fits_in_document(encoded):
+        value[field] = encoded
+    else:
+        logging.error(
+            "Not storing %s for %r: %d bytes compressed", field, url, len(encoded)
+        )
+
 
+def read_links(doc: firestore.DocumentReference) -> Optional[Sequence[str]]:
+    """Reads the outbound links from a content document."""
+    # Only transfer the links, not the whole page's content.
+    return doc.get(field_paths=["links"]).get("links")
 
-def set_if_absent(
-    doc: firestore.DocumentReference, value_generator: Callable[[], Dict[str, Any]]
-) -> Dict[str, Any]:
-    """Sets the value of a Firestore document if it doesn't already exist.
 
-    Returns the content of the document.
+def read_fingerprinted_text(
+    doc: firestore.DocumentReference,
+) -> Tuple[str, Optional[int]]:
+    """Reads the markdown and its SimHash, if stored, from a text_content
+    document."""
+    value = doc.get(field_paths=["text", "simhash"]).to_dict() or {}
+    return decode_text(value.get("text")), value.get("simhash")
+
+
+def read_text(doc: firestore.DocumentReference) -> str:
+    """Reads the markdown from a text_content document."""
+    return decode_text((doc.get(field_paths=["text"]).to_dict() or {}).get("text"))
+
+
+def create_if_absent(
+    doc: Any,
+    value: Dict[str, Any],
+    content_writer: Optional[ContentWriter] = None,
+) -> None:
+    """Creates a content-addressed document if it doesn't already exist.
+
+    A document that already exists has the same content, so this doesn't need
+    to read it first. If content_writer is given, the create is queued to it.
     """
-    snapshot: firestore.DocumentSnapshot = doc.get()
-    if snapshot.exists:
-        result = snapshot.to_dict()
-        assert result is not None
-        return result
-    value = value_generator()
-    doc.set(value)
-    return value
+    if content_writer is not None:
+        content_writer.create(doc, value)
+        return
+    try:
+        doc.create(value)
+    except google.api_core.exceptions.AlreadyExists:
+        pass
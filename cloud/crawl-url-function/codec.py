@@ -0,0 +1,33 @@
+import zlib
+from typing import Optional, Union
+
+# Firestore documents are limited to 1 MiB, and the links and other fields need
+# some of that.
+MAX_ENCODED_BYTES = 900_000
+
+# Drupal's pages are repetitive enough that higher levels gain very little.
+COMPRESSION_LEVEL = 6
+
+
+def encode_text(text: str) -> bytes:
+    """Compresses text for storage in the content-addressed collections."""
+    return zlib.compress(text.encode("utf-8"), COMPRESSION_LEVEL)
+
+
+def decode_text(value: Optional[Union[str, bytes]]) -> str:
+    """Returns the text stored in a content or text_content field.
+
+    Older documents hold plain strings, and newer ones hold compressed bytes.
+    A missing field decodes as "".
+    """
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    return zlib.decompress(value).decode("utf-8")
+
+
+def fits_in_document(encoded: bytes) -> bool:
+    """Returns whether an encoded field leaves room for the rest of its
+    document."""
+    return len(encoded) <= MAX_ENCODED_BYTES
@@ -1,3 +1,82 @@
 CLOUD_PROJECT = 'pbot-site-crawler'
 
 URL_ORIGIN = 'https://www.portland.gov/'
+
+# Pull subscription on the crawl topic that crawl_batch drains.
+CRAWL_SUBSCRIPTION = 'crawl-batch'
+# How many crawl messages crawl_batch leases per invocation. At 1 fetch per
+# second, this has to fit comfortably inside the function's 60s timeout.
+CRAWL_BATCH_SIZE = 40
+# crawl_batch doesn't start fetches after this many seconds, so it has time
+# to publish and commit before the timeout. Messages it doesn't get to are
+# returned to the subscription.
+CRAWL_BATCH_TIME_BUDGET = 40
+
+# How many crawled or queued URLs to accumulate before checkpointing the crawl
+# progress to Firestore.
+CRAWL_PROGRESS_CHECKPOINT_INTERVAL = 50
+
+# How many URLs crawl_batch processes at once. Fetches are still serialized by
+# the rate limiter, but the other threads can parse and store pages meanwhile.
+CRAWL_THREADS = 3
+
+# Whether to adapt the crawl delay to how quickly the site responds. The
+# adaptive delay only ever slows down from robots.txt's Crawl-delay, or
+# DEFAULT_CRAWL_DELAY seconds if it doesn't set one, up to MAX_CRAWL_DELAY.
+ADAPTIVE_CRAWL_DELAY = True
+DEFAULT_CRAWL_DELAY = 1
+MAX_CRAWL_DELAY = 30
+# Longer Retry-After delays are shortened to this many seconds, the functions'
+# timeout, so that one response can't stall the crawl indefinitely.
+MAX_RETRY_AFTER = 60
+
+# Pull subscription on the archive-pages topic that archive_pages drains.
+ARCHIVE_SUBSCRIPTION = 'archive-pages'
+# How many pages archive_pages asks the Web Archive to save per invocation.
+ARCHIVE_BATCH_SIZE = 10
+# Seconds between requests to the Web Archive, and how long to wait for each.
+ARCHIVE_DELAY = 5
+ARCHIVE_TIMEOUT = 20
+# archive_pages doesn't start a request after this many seconds, leaving room
+# for the last one's ARCHIVE_TIMEOUT and the commit within the function's
+# 300-second timeout.
+ARCHIVE_BATCH_TIME_BUDGET = 240
+
+# start_crawl packs this many of the previous crawl's URLs into each crawl
+# message, and checkpoints its progress every SEED_CHECKPOINT_MESSAGES
+# messages. After SEED_TIME_BUDGET seconds, it stops and asks Cloud Scheduler to
+# retry, which resumes from the checkpoint.
+SEED_URLS_PER_MESSAGE = 20
+SEED_CHECKPOINT_MESSAGES = 25
+SEED_TIME_BUDGET = 45
+
+# Pages that stay unchanged are revalidated less often, down to once every
+# MAX_REVISIT_INTERVAL crawls. Set it to 1 to revalidate every page every crawl.
+MAX_REVISIT_INTERVAL = 4
+# Pages whose smoothed fraction of changed fetches is at least this are queued
+# before the rest of the crawl.
+HOT_CHANGE_RATE = 0.25
+
+# Changed pages whose markdown's 64-bit SimHash differs from the previous
+# crawl's by at most this many bits are treated as unchanged, so boilerplate
+# churn isn't published or archived. None reports every change; leave it off
+# until a threshold has been measured against real crawls.
+NEAR_DUPLICATE_BITS = None
+
+# HTML pages bigger than this, after decompression, are neither downloaded in
+# full nor stored. Portland.gov's biggest pages are well under 1 MiB, so
+# anything this big is a mistake or an attack, and could run the function out
+# of memory.
+MAX_BODY_BYTES = 8 * 1024 * 1024
+
+# Bits of PBOT's HTML that change on every fetch. Each rule is a name, a regular
+# expression on the raw page, and what to replace its matches with, which
+# happens before pages are hashed. Changing the rules changes the content
+# hashes of the pages they match, so measure a change with
+# tools/reclean.py first. Rules can't use numbered groups or backreferences.
+NOISE_RULES = [
+    ('view_dom_id', rb'(?:js-view-dom-id-|views_dom_id:)[0-9a-f]+', b''),
+    ('view_dom_id_setting', rb',"view_dom_id":"[0-9a-f]+"', b''),
+    ('new_relic_script', rb'<script .+?NREUM.+?</script>', b''),
+    ('drawer_id', rb'drawer--\d+', b'drawer--0000000000'),
+]
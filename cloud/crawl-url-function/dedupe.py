@@ -0,0 +1,217 @@
+import logging
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from hashlib import sha256
+from typing import Iterable, Optional, Set
+
+from google.cloud import firestore
+
+
+def url_key(url: str) -> int:
+    """Returns the 64-bit key that UrlHashSet stores for url."""
+    return int.from_bytes(sha256(url.encode()).digest()[:8], "big")
+
+
+class UrlHashSet:
+    """A set of URLs, stored as a sorted array of 64-bit SHA-256 prefixes.
+
+    This takes 8 bytes per URL instead of the ~150 a set of strings needs, and
+    serializes directly to bytes. With 64-bit keys, collisions are vanishingly
+    unlikely at the site's scale.
+    """
+
+    def __init__(self, keys: Iterable[int] = ()):
+        self._keys = array("Q", sorted(set(keys)))
+
+    def __contains__(self, url: str) -> bool:
+        key = url_key(url)
+        i = bisect_left(self._keys, key)
+        return i < len(self._keys) and self._keys[i] == key
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, url: str) -> None:
+        key = url_key(url)
+        i = bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            self._keys.insert(i, key)
+
+    def update(self, urls: Iterable[str]) -> None:
+        for url in urls:
+            self.add(url)
+
+    def merge(self, other: "UrlHashSet") -> None:
+        """Adds every URL in other to this set."""
+        if len(other) > 0:
+            self._keys = array("Q", sorted(set(self._keys).union(other._keys)))
+
+    def discard(self, url: str) -> None:
+        key = url_key(url)
+        i = bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def clear(self) -> None:
+        del self._keys[:]
+
+    def to_bytes(self) -> bytes:
+        keys = array("Q", self._keys)
+        # Store big-endian, independent of the machine.
+        if sys.byteorder == "little":
+            keys.byteswap()
+        return keys.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "UrlHashSet":
+        keys = array("Q")
+        keys.frombytes(data)
+        if sys.byteorder == "little":
+            keys.byteswap()
+        result = cls()
+        result._keys = keys
+        return result
+
+
+class CrawlProgress:
+    """Tracks which URLs the current crawl has crawled and queued.
+
+    The state is checkpointed to a single Firestore document so that it
+    survives when the function's instance is recycled, and so that start_crawl
+    and the crawl workers share it. The methods are safe to call from several
+    threads.
+    """
+
+    def __init__(
+        self, doc: Optional[firestore.DocumentReference], checkpoint_interval: int
+    ):
+        self.doc = doc
+        self.checkpoint_interval = checkpoint_interval
+        self.crawl = ""
+        # URLs that have been fully crawled, including publishing their links.
+        self.crawled = UrlHashSet()
+        # URLs that have been published to the crawl topic.
+        self.queued = UrlHashSet()
+        # URLs discarded from queued since the last checkpoint, which merging
+        # the checkpoint mustn't bring back.
+        self._unqueued: Set[str] = set()
+        self._changes_since_checkpoint = 0
+        self._lock = threading.Lock()
+
+    def reset(self, crawl: str) -> None:
+        with self._lock:
+            self._reset(crawl)
+
+    def _reset(self, crawl: str) -> None:
+        self.crawl = crawl
+        self.crawled.clear()
+        self.queued.clear()
+        self._unqueued.clear()
+        self._changes_since_checkpoint = 0
+
+    def set_crawl(self, crawl: str) -> None:
+        """Starts tracking crawl, forgetting any other crawl's progress."""
+        with self._lock:
+            if crawl != self.crawl:
+                logging.info(
+                    "Switching crawl progress from %r to %r", self.crawl, crawl
+                )
+                self._reset(crawl)
+
+    def mark_crawled(self, url: str) -> None:
+        with self._lock:
+            self.crawled.add(url)
+            self._changes_since_checkpoint += 1
+
+    def claim(self, url: str) -> bool:
+        """Marks url queued, unless it has already been crawled or queued.
+
+        Returns whether it was marked, in which case the caller should publish
+        it. Checking and marking are one step, so that threads that find the
+        same link don't both publish it.
+        """
+        with self._lock:
+            if url in self.crawled or url in self.queued:
+                return False
+            self.queued.add(url)
+            self._unqueued.discard(url)
+            self._changes_since_checkpoint += 1
+            return True
+
+    def mark_queued(self, url: str) -> None:
+        with self._lock:
+            self.queued.add(url)
+            self._unqueued.discard(url)
+            self._changes_since_checkpoint += 1
+
+    def discard_queued(self, url: str) -> None:
+        with self._lock:
+            self.queued.discard(url)
+            self._unqueued.add(url)
+            self._changes_since_checkpoint += 1
+
+    def load(self) -> None:
+        """Loads the last checkpoint, if any."""
+        if self.doc is None:
+            return
+        snapshot = self.doc.get()
+        if not snapshot.exists:
+            return
+        with self._lock:
+            self.crawl = snapshot.get("crawl")
+            self.crawled = UrlHashSet.from_bytes(snapshot.get("crawled"))
+            self.queued = UrlHashSet.from_bytes(snapshot.get("queued"))
+            self._unqueued.clear()
+            self._changes_since_checkpoint = 0
+        logging.info(
+            "Loaded progress for crawl %s: %d crawled, %d queued",
+            self.crawl,
+            len(self.crawled),
+            len(self.queued),
+        )
+
+    def checkpoint(self) -> None:
+        """Merges this progress into the checkpoint.
+
+        Other instances checkpoint the same document, so rather than
+        overwriting it, this adds in whatever they've checkpointed for the same
+        crawl, and keeps that here too. A checkpoint that races with this one
+        can still drop some of these URLs from the document, but the next
+        checkpoint puts them back.
+        """
+        if self.doc is None:
+            return
+        snapshot = self.doc.get()
+        with self._lock:
+            if snapshot.exists:
+                stored_crawl = snapshot.get("crawl")
+                if stored_crawl > self.crawl:
+                    # A newer crawl has started, so this progress is obsolete.
+                    logging.info(
+                        "Switching crawl progress from %r to checkpointed %r",
+                        self.crawl,
+                        stored_crawl,
+                    )
+                    self._reset(stored_crawl)
+                if stored_crawl == self.crawl:
+                    self.crawled.merge(UrlHashSet.from_bytes(snapshot.get("crawled")))
+                    self.queued.merge(UrlHashSet.from_bytes(snapshot.get("queued")))
+                    for url in self._unqueued:
+                        self.queued.discard(url)
+            value = {
+                "crawl": self.crawl,
+                "crawled": self.crawled.to_bytes(),
+                "queued": self.queued.to_bytes(),
+            }
+            self._unqueued.clear()
+            self._changes_since_checkpoint = 0
+        self.doc.set(value)
+
+    def checkpoint_if_needed(self) -> None:
+        """Checkpoints if enough has changed since the last checkpoint."""
+        with self._lock:
+            needed = self._changes_since_checkpoint >= self.checkpoint_interval
+        if needed:
+            self.checkpoint()
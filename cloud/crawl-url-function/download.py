@@ -0,0 +1,36 @@
+from typing import Callable, Optional
+
+import requests
+
+import config
+
+CHUNK_BYTES = 64 * 1024
+
+
+def read_body(
+    response: requests.Response,
+    max_bytes: int = config.MAX_BODY_BYTES,
+    update: Optional[Callable[[bytes], object]] = None,
+) -> Optional[bytes]:
+    """Reads the body of a response requested with stream=True, in chunks.
+
+    Returns None as soon as the body turns out to be longer than max_bytes,
+    without reading the rest. The limit applies to the decompressed body, so
+    a small gzipped response can't expand past it. If update is given, it's
+    called with each chunk, e.g. to hash the body as it's read.
+    """
+    content_length = response.headers.get("content-length", "")
+    # With Content-Encoding, this is the compressed length, which can only be
+    # shorter than the body.
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        return None
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(CHUNK_BYTES):
+        size += len(chunk)
+        if size > max_bytes:
+            return None
+        if update is not None:
+            update(chunk)
+        chunks.append(chunk)
+    return b"".join(chunks)
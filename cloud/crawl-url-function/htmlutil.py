@@ -1,69 +1,251 @@
+import codecs
 import re
-import urllib.parse
-from typing import Iterator
+import threading
+from collections import Counter
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
 
 import html2text
-import whatwg_url
-from bs4 import BeautifulSoup
+import lxml.etree
+from bs4.dammit import UnicodeDammit
+
+import config
+from urlutil import canonicalize_link
+
+# How much of a page scrape_links() hands to lxml at a time.
+LINK_CHUNK_BYTES = 64 * 1024
+
+# Like browsers, only look this far into a page for a <meta> charset.
+META_PRESCAN_BYTES = 1024
+
+_BYTE_ORDER_MARKS = (codecs.BOM_UTF8, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+_CONTENT_TYPE_CHARSET = re.compile(r"""charset\s*=\s*["']?([^\s;"']+)""", re.I)
+_META_CHARSET = re.compile(
+    rb"""<meta\s[^>]*?charset\s*=\s*["']?([A-Za-z0-9_.:-]+)""", re.I
+)
 
 
 class HtmlProcessor:
-    def __init__(self, content: bytes, base_url: str):
+    """Extracts a page's links and markdown.
+
+    Both come from one pass of html2text's parser over the cleaned page, which
+    collects the links as it renders the markdown, so the page is only parsed
+    once and the markdown is exactly what html2text.html2text() returns. If
+    only the links are needed, they come from scrape_links() instead.
+    """
+
+    def __init__(
+        self, content: bytes, base_url: str, content_type: Optional[str] = None
+    ):
+        """content_type is the page's Content-Type header. Its charset is
+        trusted over the page's own, as browsers do."""
         self.content = clean_content(content)
         self.base_url = base_url
-        self.soup = BeautifulSoup(content, "lxml")
-        self.encoding = str(self.soup.original_encoding or "utf-8")
+        self.encoding, self.text = _decode(self.content, content_type)
+        self._markdown: Optional[str] = None
+        self._hrefs: Optional[List[str]] = None
 
     def scrape_links(self) -> Iterator[str]:
-        for link in self.soup.find_all("a", href=True):
-            # Skip nofollow links. This isn't strictly required by the spec, but
-            # nofollow links seem less valuable, so we can focus on the other
-            # ones. We'll see if this misses anything important.
-            if "nofollow" in link.get("rel", []):
-                continue
-            try:
-                href = urljoin(self.base_url, link["href"].strip())
-            except whatwg_url.UrlParserError:
-                continue
-            yield clean_url(href).href
+        if self._hrefs is None:
+            # Without the markdown, or if html2text failed, the links are
+            # cheaper to find on their own.
+            self._hrefs = list(_scrape_hrefs(self.text, None))
+        for href in self._hrefs:
+            url = canonicalize_link(self.base_url, href)
+            if url is not None:
+                yield url
 
     def get_markdown(self) -> str:
-        return html2text.html2text(
-            self.content.decode(self.encoding, errors="backslashreplace"),
-            baseurl=self.base_url,
-        )
+        if self._markdown is None:
+            self._parse()
+            assert self._markdown is not None
+        return self._markdown
+
+    def _parse(self) -> None:
+        parser = _MarkdownParser(self.base_url)
+        self._markdown = parser.handle(self.text)
+        if self._hrefs is None:
+            self._hrefs = parser.hrefs
+
+
+def content_type_charset(content_type: Optional[str]) -> Optional[str]:
+    """Returns the charset parameter of a Content-Type header, if any."""
+    match = _CONTENT_TYPE_CHARSET.search(content_type or "")
+    return match.group(1) if match else None
+
+
+def _decode(content: bytes, content_type: Optional[str]) -> Tuple[str, str]:
+    """Returns the page's encoding, and the page decoded with it.
+
+    If the page decodes cleanly in the encoding it's declared to be in, that
+    saves UnicodeDammit's detection, which can take several passes over it.
+    """
+    for encoding in _declared_encodings(content, content_type):
+        try:
+            return encoding, content.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    encoding = str(UnicodeDammit(content, is_html=True).original_encoding or "utf-8")
+    return encoding, content.decode(encoding, errors="backslashreplace")
+
+
+def _declared_encodings(content: bytes, content_type: Optional[str]) -> Iterator[str]:
+    """Yields the encodings the Content-Type header and a <meta> tag near the
+    start of the page declare, in that order."""
+    if content.startswith(_BYTE_ORDER_MARKS):
+        # A byte order mark overrides both; leave it to UnicodeDammit.
+        return
+    label = content_type_charset(content_type)
+    if label is not None:
+        try:
+            yield codecs.lookup(label).name
+        except LookupError:
+            pass
+    meta = _META_CHARSET.search(content, 0, META_PRESCAN_BYTES)
+    if meta is not None:
+        try:
+            encoding = codecs.lookup(meta.group(1).decode("ascii")).name
+        except LookupError:
+            return
+        # A <meta> tag that could be read as ASCII can't be in UTF-16 or UTF-32.
+        if not encoding.startswith(("utf-16", "utf-32")):
+            yield encoding
+
+
+def scrape_links(
+    content: Union[bytes, str], base_url: str, encoding: Optional[str] = None
+) -> Iterator[str]:
+    """Yields the canonical URLs of a page's links, except nofollow ones.
+
+    lxml reports each start tag as it parses, so no tree is built, and the
+    links in each chunk of the page are yielded as soon as it's parsed. Bytes
+    are decoded as encoding, or if that's None, however lxml works out from
+    the page.
+    """
+    for href in _scrape_hrefs(content, encoding):
+        url = canonicalize_link(base_url, href)
+        if url is not None:
+            yield url
+
+
+def _scrape_hrefs(content: Union[bytes, str], encoding: Optional[str]) -> Iterator[str]:
+    target = _LinkTarget()
+    try:
+        parser = lxml.etree.HTMLParser(target=target, encoding=encoding)
+    except LookupError:
+        # libxml2 doesn't know the encoding, so let it guess.
+        parser = lxml.etree.HTMLParser(target=target)
+    # lxml refuses to close a parser that was never fed, so feed it nothing.
+    parser.feed(content[:0])
+    for start in range(0, len(content), LINK_CHUNK_BYTES):
+        parser.feed(content[start : start + LINK_CHUNK_BYTES])
+        yield from target.take_hrefs()
+    parser.close()
+    yield from target.take_hrefs()
+
+
+def _followed_href(attributes: Mapping[str, Optional[str]]) -> Optional[str]:
+    """Returns the href of an <a> tag with attributes, unless it's nofollow."""
+    # Skip nofollow links. This isn't strictly required by the spec, but
+    # nofollow links seem less valuable, so we can focus on the other ones.
+    # We'll see if this misses anything important.
+    if "nofollow" in (attributes.get("rel") or "").split():
+        return None
+    return attributes.get("href")
+
+
+class _MarkdownParser(html2text.HTML2Text):
+    """html2text's converter, which also collects the links it passes."""
+
+    def __init__(self, base_url: str):
+        super().__init__(baseurl=base_url, bodywidth=html2text.config.BODY_WIDTH)
+        self.hrefs: List[str] = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag == "a":
+            attributes: Dict[str, Optional[str]] = {}
+            for name, value in attrs:
+                # Like browsers (and lxml), ignore repeated attributes.
+                attributes.setdefault(name, value)
+            href = _followed_href(attributes)
+            if href is not None:
+                self.hrefs.append(href)
+        super().handle_starttag(tag, attrs)
+
+
+class _LinkTarget:
+    """An lxml parser target that only collects the links it's shown."""
+
+    def __init__(self):
+        self.hrefs: List[str] = []
+
+    def start(self, tag: str, attrib: Mapping[str, str]) -> None:
+        if tag == "a":
+            href = _followed_href(attrib)
+            if href is not None:
+                self.hrefs.append(href)
+
+    def close(self) -> None:
+        pass
+
+    def take_hrefs(self) -> List[str]:
+        hrefs, self.hrefs = self.hrefs, []
+        return hrefs
+
+
+class NoiseRules:
+    """Removes bits of HTML that change on every fetch from PBOT's website.
+
+    The rules are compiled once into a single alternation, so each page is
+    scanned once however many rules there are. Counts of each rule's matches
+    accumulate in hits until take_hits(), from any number of threads.
+    """
+
+    def __init__(self, rules: Sequence[Tuple[str, bytes, bytes]]):
+        self.names = [name for name, _, _ in rules]
+        self._replacements = {
+            f"rule{i}": replacement for i, (_, _, replacement) in enumerate(rules)
+        }
+        self._names_by_group = {f"rule{i}": name for i, name in enumerate(self.names)}
+        self._pattern: Optional[re.Pattern] = None
+        if rules:
+            self._pattern = re.compile(
+                b"|".join(
+                    b"(?P<rule%d>%s)" % (i, pattern)
+                    for i, (_, pattern, _) in enumerate(rules)
+                )
+            )
+        self._lock = threading.Lock()
+        self.hits: Counter[str] = Counter()
+
+    def clean(self, content: bytes) -> bytes:
+        if self._pattern is None:
+            return content
+        hits: Counter[str] = Counter()
+
+        def replace(match: re.Match) -> bytes:
+            # Every alternative is a named group, so one of them matched.
+            assert match.lastgroup is not None
+            hits[match.lastgroup] += 1
+            return self._replacements[match.lastgroup]
 
+        content = self._pattern.sub(replace, content)
+        if hits:
+            with self._lock:
+                for group, count in hits.items():
+                    self.hits[self._names_by_group[group]] += count
+        return content
 
-def urljoin(base: str, relative: str) -> whatwg_url.Url:
-    """Join a base URL and a relative URL, removing any fragments."""
-    url = whatwg_url.parse_url(relative, base=base)
-    url.fragment = None
-    return url
+    def take_hits(self) -> Dict[str, int]:
+        """Returns the hits since the last call, and starts over."""
+        with self._lock:
+            hits, self.hits = self.hits, Counter()
+        return dict(hits)
 
 
-def clean_url(url: whatwg_url.Url) -> whatwg_url.Url:
-    """Removes query parameters that don't affect the resulting page."""
-    query = urllib.parse.parse_qs(url.query)
-    query.pop("utm_medium", None)
-    query.pop("utm_source", None)
-    query.pop("_ga", None)
-    query.pop("_gl", None)
-    url.query = urllib.parse.urlencode(query, doseq=True) or None
-    return url
+noise_rules = NoiseRules(config.NOISE_RULES)
 
 
 def clean_content(content: bytes) -> bytes:
-    """Removes bits of HTML that change on every fetch from PBOT's website."""
-    content = re.sub(
-        b"|".join(
-            [
-                rb"(?:js-view-dom-id-|views_dom_id:)[0-9a-f]+",
-                rb',"view_dom_id":"[0-9a-f]+"',
-                rb"<script .+?NREUM.+?</script>",
-            ]
-        ),
-        b"",
-        content,
-    )
-    content = re.sub(rb"drawer--\d+", b"drawer--0000000000", content)
-    return content
+    """Removes bits of HTML that change on every fetch from PBOT's website,
+    using the rules in config.NOISE_RULES."""
+    return noise_rules.clean(content)
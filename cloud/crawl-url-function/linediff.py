@@ -0,0 +1,250 @@
+import logging
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# (tag, i1, i2, j1, j2), like difflib.SequenceMatcher.get_opcodes().
+Opcode = Tuple[str, int, int, int, int]
+
+# Beyond these, unified_diff() shows the whole changed region as one
+# replacement instead of finding the smallest diff.
+MAX_LINES = 100_000
+MAX_EDITS = 1000
+TIMEOUT = 2.0
+
+
+def unified_diff(
+    a: Sequence[str],
+    b: Sequence[str],
+    fromfile: str = "",
+    tofile: str = "",
+    fromfiledate: str = "",
+    tofiledate: str = "",
+    n: int = 3,
+    *,
+    max_lines: int = MAX_LINES,
+    max_edits: int = MAX_EDITS,
+    timeout: float = TIMEOUT,
+) -> Iterator[str]:
+    """A drop-in replacement for difflib.unified_diff() on lists of lines.
+
+    Lines are compared by identity after interning, and the diff is found with
+    Myers' O(ND) algorithm, which stays fast on long pages full of similar
+    lines where difflib's SequenceMatcher can go quadratic. If the lines that
+    differ number more than max_lines, or the diff needs more than max_edits
+    insertions and deletions or more than timeout seconds, the output falls
+    back to a single hunk that replaces the whole changed region, preceded by
+    a line explaining that.
+    """
+    opcodes, exact = diff_opcodes(
+        a, b, max_lines=max_lines, max_edits=max_edits, timeout=timeout
+    )
+    started = False
+    for group in _grouped_opcodes(opcodes, n):
+        if not started:
+            started = True
+            if not exact:
+                yield (
+                    "Too many changes to diff line by line; "
+                    + "showing the changed region as one replacement.\n"
+                )
+            fromdate = f"\t{fromfiledate}" if fromfiledate else ""
+            todate = f"\t{tofiledate}" if tofiledate else ""
+            yield f"--- {fromfile}{fromdate}\n"
+            yield f"+++ {tofile}{todate}\n"
+        first, last = group[0], group[-1]
+        file1_range = _format_range(first[1], last[2])
+        file2_range = _format_range(first[3], last[4])
+        yield f"@@ -{file1_range} +{file2_range} @@\n"
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in a[i1:i2]:
+                    yield " " + line
+                continue
+            if tag in ("replace", "delete"):
+                for line in a[i1:i2]:
+                    yield "-" + line
+            if tag in ("replace", "insert"):
+                for line in b[j1:j2]:
+                    yield "+" + line
+
+
+def diff_opcodes(
+    a: Sequence[str],
+    b: Sequence[str],
+    *,
+    max_lines: int = MAX_LINES,
+    max_edits: int = MAX_EDITS,
+    timeout: float = TIMEOUT,
+) -> Tuple[List[Opcode], bool]:
+    """Returns the opcodes that turn a into b, and whether they're a minimal
+    diff rather than the fallback of replacing the whole changed region."""
+    # Lines that match at the start and end are common, and cheap to skip.
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while (
+        suffix < len(a) - prefix
+        and suffix < len(b) - prefix
+        and a[len(a) - 1 - suffix] == b[len(b) - 1 - suffix]
+    ):
+        suffix += 1
+    a_end, b_end = len(a) - suffix, len(b) - suffix
+
+    # Compare small integers instead of strings.
+    ids: Dict[str, int] = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a[prefix:a_end]]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b[prefix:b_end]]
+
+    matches = None
+    if len(a_ids) + len(b_ids) <= max_lines:
+        matches = _myers_matches(a_ids, b_ids, max_edits, time.monotonic() + timeout)
+    exact = matches is not None
+    if matches is None:
+        logging.info(
+            "Falling back to a coarse diff of %d and %d lines.",
+            len(a_ids),
+            len(b_ids),
+        )
+        matches = []
+
+    opcodes: List[Opcode] = []
+    if prefix:
+        opcodes.append(("equal", 0, prefix, 0, prefix))
+    i, j = 0, 0
+    # The sentinel match flushes the last gap.
+    for match_i, match_j in matches + [(len(a_ids), len(b_ids))]:
+        if i < match_i and j < match_j:
+            tag = "replace"
+        elif i < match_i:
+            tag = "delete"
+        elif j < match_j:
+            tag = "insert"
+        else:
+            tag = ""
+        if tag:
+            opcodes.append(
+                (tag, prefix + i, prefix + match_i, prefix + j, prefix + match_j)
+            )
+        if match_i < len(a_ids):
+            _append_equal(opcodes, prefix + match_i, prefix + match_j)
+        i, j = match_i + 1, match_j + 1
+    if suffix:
+        opcodes.append(("equal", a_end, len(a), b_end, len(b)))
+        _merge_last_equal(opcodes)
+    return opcodes, exact
+
+
+def _append_equal(opcodes: List[Opcode], i: int, j: int) -> None:
+    opcodes.append(("equal", i, i + 1, j, j + 1))
+    _merge_last_equal(opcodes)
+
+
+def _merge_last_equal(opcodes: List[Opcode]) -> None:
+    """Merges the last opcode into the one before it if both are adjacent
+    equal runs."""
+    if len(opcodes) < 2:
+        return
+    prev_tag, pi1, pi2, pj1, pj2 = opcodes[-2]
+    tag, i1, i2, j1, j2 = opcodes[-1]
+    if prev_tag == tag == "equal" and pi2 == i1 and pj2 == j1:
+        opcodes[-2:] = [("equal", pi1, i2, pj1, j2)]
+
+
+def _myers_matches(
+    a: Sequence[int], b: Sequence[int], max_edits: int, deadline: float
+) -> Optional[List[Tuple[int, int]]]:
+    """Returns the (i, j) pairs of a longest common subsequence of a and b, in
+    order, or None if that needs more than max_edits edits or takes past the
+    deadline.
+
+    This is the greedy algorithm from Myers, "An O(ND) Difference Algorithm and
+    Its Variations" (1986), with the furthest-reaching x of each diagonal saved
+    for every D so the path can be traced back.
+    """
+    n, m = len(a), len(b)
+    max_d = min(n + m, max_edits)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    # trace[d][k + d] is the furthest x on diagonal k after d edits.
+    trace: List[List[int]] = []
+    for d in range(max_d + 1):
+        if time.monotonic() > deadline:
+            return None
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                trace.append(v[offset - d : offset + d + 1])
+                return _backtrack(trace, n, m)
+        trace.append(v[offset - d : offset + d + 1])
+    return None
+
+
+def _backtrack(trace: List[List[int]], n: int, m: int) -> List[Tuple[int, int]]:
+    matches: List[Tuple[int, int]] = []
+    x, y = n, m
+    for d in range(len(trace) - 1, 0, -1):
+        prev = trace[d - 1]
+        k = x - y
+        if k == -d or (k != d and prev[k - 1 + d - 1] < prev[k + 1 + d - 1]):
+            prev_k = k + 1
+            prev_x = prev[prev_k + d - 1]
+            # An insertion moves down from the previous diagonal.
+            mid_x, mid_y = prev_x, prev_x - prev_k + 1
+        else:
+            prev_k = k - 1
+            prev_x = prev[prev_k + d - 1]
+            # A deletion moves right from the previous diagonal.
+            mid_x, mid_y = prev_x + 1, prev_x - prev_k
+        while x > mid_x and y > mid_y:
+            x -= 1
+            y -= 1
+            matches.append((x, y))
+        x, y = prev_x, prev_x - prev_k
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        matches.append((x, y))
+    matches.reverse()
+    return matches
+
+
+def _grouped_opcodes(opcodes: List[Opcode], n: int) -> Iterator[List[Opcode]]:
+    """Groups opcodes into hunks with n lines of context, like
+    difflib.SequenceMatcher.get_grouped_opcodes()."""
+    codes = list(opcodes) or [("equal", 0, 1, 0, 1)]
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+    group: List[Opcode] = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > 2 * n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _format_range(start: int, stop: int) -> str:
+    """Formats a hunk's line range the way difflib.unified_diff() does."""
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
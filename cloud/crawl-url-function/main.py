@@ -4,11 +4,13 @@ import logging
 import time
 import traceback
 from concurrent import futures
-from datetime import date, datetime, timedelta, timezone
-from typing import Tuple
+from datetime import date, datetime, timezone
+from hashlib import sha256
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 from urllib.robotparser import RobotFileParser
 
 import functions_framework
+import google.api_core.exceptions
 import google.auth.exceptions
 import requests
 import whatwg_url
@@ -17,22 +19,63 @@ from google.cloud import logging as cloud_logging
 from google.cloud import pubsub_v1
 
 import config
-from cache import Cache, CacheState, FreshResponse, PresenceChange
-from htmlutil import clean_url
+from cache import (
+    Cache,
+    CachedResponse,
+    CacheState,
+    ContentWriter,
+    FreshResponse,
+    PresenceChange,
+)
+from dedupe import CrawlProgress
+from htmlutil import noise_rules
+from manifest import CrawlManifest
+from ratelimit import AdaptiveRateLimiter, OutOfTime, RateLimiter, parse_retry_after
+from revisit import RevisitHistory, RevisitPolicy
+from timing import span, stage_timer
+from urlutil import clean_url
 
 SESSION = requests.Session()
 USER_AGENT = "PBOT Crawler from github.com/jyasskin/pbot-crawler"
 SESSION.headers.update({"user-agent": USER_AGENT})
-next_fetch = datetime.now(timezone.utc)
-
-crawled_urls = set()
 
 robots = RobotFileParser(config.URL_ORIGIN + "robots.txt")
 robots.read()
-crawl_delay = timedelta(seconds=float(robots.crawl_delay(USER_AGENT) or 1))
+robots_crawl_delay = robots.crawl_delay(USER_AGENT)
+crawl_delay = float(robots_crawl_delay or config.DEFAULT_CRAWL_DELAY)
+if config.ADAPTIVE_CRAWL_DELAY:
+    # Never go faster than robots.txt allows.
+    rate_limiter: RateLimiter = AdaptiveRateLimiter(
+        crawl_delay,
+        min_interval=crawl_delay,
+        max_interval=config.MAX_CRAWL_DELAY,
+        max_defer=config.MAX_RETRY_AFTER,
+    )
+else:
+    rate_limiter = RateLimiter(crawl_delay, max_defer=config.MAX_RETRY_AFTER)
+revisit_policy = RevisitPolicy(
+    max_interval=config.MAX_REVISIT_INTERVAL, hot_change_rate=config.HOT_CHANGE_RATE
+)
+# The Web Archive limits how often each client can ask it to save pages.
+archive_rate_limiter = RateLimiter(
+    config.ARCHIVE_DELAY, max_defer=config.MAX_RETRY_AFTER
+)
 
 db = firestore.Client()
-cache = Cache(db)
+cache = Cache(
+    db,
+    near_duplicate_bits=config.NEAR_DUPLICATE_BITS,
+    max_body_bytes=config.MAX_BODY_BYTES,
+)
+
+# Survives instance restarts by reloading the last checkpoint.
+crawl_progress = CrawlProgress(
+    db.collection("crawl_state").document("progress"),
+    config.CRAWL_PROGRESS_CHECKPOINT_INTERVAL,
+)
+crawl_progress.load()
+
+crawl_manifest = CrawlManifest(db.collection("crawl_state").document("crawls"))
 
 _error_reporting_client = None
 try:
@@ -54,6 +97,14 @@ batch_settings = pubsub_v1.types.BatchSettings(max_messages=1000)
 publisher = pubsub_v1.PublisherClient(batch_settings)
 crawl_topic_path = publisher.topic_path(config.CLOUD_PROJECT, "crawl")
 changed_pages_topic_path = publisher.topic_path(config.CLOUD_PROJECT, "changed-pages")
+archive_pages_topic_path = publisher.topic_path(config.CLOUD_PROJECT, "archive-pages")
+subscriber = pubsub_v1.SubscriberClient()
+crawl_subscription_path = subscriber.subscription_path(
+    config.CLOUD_PROJECT, config.CRAWL_SUBSCRIPTION
+)
+archive_subscription_path = subscriber.subscription_path(
+    config.CLOUD_PROJECT, config.ARCHIVE_SUBSCRIPTION
+)
 
 
 @functions_framework.http
@@ -62,39 +113,115 @@ def start_crawl(request):
     try:
         if request.method != "POST":
             return "Method not allowed\n", 405, {"Allow", "POST"}
-        do_start_crawl()
+        if not do_start_crawl():
+            # Cloud Scheduler retries, which resumes from the checkpoint.
+            return "Seeding is incomplete; retry to resume\n", 503
         return "Done\n", 200
     except Exception:
         report_exception()
         return traceback.format_exc(), 500
 
 
-def do_start_crawl():
+def do_start_crawl() -> bool:
+    """Starts today's crawl, and seeds it with the previous crawl's pages.
+
+    The pages are published SEED_URLS_PER_MESSAGE to a message, and progress is
+    checkpointed in the crawl manifest. Returns False if this ran out of time
+    before publishing every page; calling it again resumes from the last
+    checkpoint.
+    """
+    deadline = time.monotonic() + config.SEED_TIME_BUDGET
     current_crawl, prev_crawl = get_crawl({})
-    logging.info(
-        "Starting crawl %s; queuing existing pages from %s crawl.",
-        current_crawl,
-        prev_crawl,
-    )
+    crawl_progress.set_crawl(current_crawl)
     sync_publisher = SynchronousPublisher(publisher)
     link_publisher = OutboundLinkPublisher(sync_publisher, prev_crawl, current_crawl)
-    # Make sure the crawl is never empty.
-    link_publisher.publish("https://www.portland.gov/transportation")
-    # Check all known pages.
-    for existing_page in (
-        db.collection(f"crawl-{prev_crawl}")
-        .where("status_code", "<", 400)
-        .select(["url"])
-        .stream()
-    ):
-        link_publisher.publish(existing_page.get("url"))
-    logging.info("Waiting to publish %d existing pages.", len(sync_publisher))
-    sync_publisher.wait()
+    if current_crawl not in crawl_manifest.crawls():
+        logging.info(
+            "Starting crawl %s; queuing existing pages from %s crawl.",
+            current_crawl,
+            prev_crawl,
+        )
+        crawl_manifest.start(current_crawl, prev_crawl)
+        # Make sure the crawl is never empty.
+        link_publisher.publish("https://www.portland.gov/transportation")
+    elif crawl_manifest.seeded(current_crawl):
+        logging.info("Crawl %s is already seeded.", current_crawl)
+        return True
+
+    # Check all known pages, starting with the ones that change often, so
+    # they're revalidated early in the crawl. Each phase is a query and a
+    # filter on its results. The hot pages are found by querying their change
+    # rate, so only the second phase reads the whole previous crawl.
+    prev_collection = db.collection(f"crawl-{prev_crawl}")
+    seed_phases: List[Tuple[firestore.Query, Callable[[Dict[str, Any]], bool]]] = [
+        (
+            prev_collection.where(
+                "history.change_rate", ">=", revisit_policy.hot_change_rate
+            ),
+            lambda data: data.get("status_code", 0) < 400,
+        ),
+        (
+            prev_collection.where("status_code", "<", 400),
+            lambda data: not revisit_policy.is_hot(
+                RevisitHistory.from_dict(data.get("history"))
+            ),
+        ),
+    ]
+    start_phase = crawl_manifest.seed_phase(current_crawl)
+    cursor = crawl_manifest.seed_cursor(current_crawl)
+
+    def checkpoint(phase: int, cursor: Optional[str]) -> None:
+        # Only advance the cursor past pages that have actually been published.
+        sync_publisher.wait()
+        crawl_manifest.save_seed_cursor(current_crawl, phase, cursor)
+        crawl_progress.checkpoint()
+
+    messages = 0
+    for phase in range(start_phase, len(seed_phases)):
+        query, should_seed = seed_phases[phase]
+        existing_pages = query.select(["url", "status_code", "history"])
+        if cursor is not None:
+            logging.info(
+                "Resuming seeding phase %d of crawl %s after %s.",
+                phase,
+                current_crawl,
+                cursor,
+            )
+            existing_pages = existing_pages.start_after(
+                prev_collection.document(cursor).get()
+            )
+        urls: List[str] = []
+        for existing_page in existing_pages.stream():
+            cursor = existing_page.id
+            data = existing_page.to_dict() or {}
+            if "url" in data and should_seed(data):
+                urls.append(data["url"])
+            if len(urls) >= config.SEED_URLS_PER_MESSAGE:
+                link_publisher.publish_many(urls)
+                urls = []
+                messages += 1
+                if messages % config.SEED_CHECKPOINT_MESSAGES == 0:
+                    checkpoint(phase, cursor)
+            if time.monotonic() > deadline:
+                link_publisher.publish_many(urls)
+                checkpoint(phase, cursor)
+                logging.warning(
+                    "Ran out of time seeding crawl %s after %d messages.",
+                    current_crawl,
+                    messages,
+                )
+                return False
+        link_publisher.publish_many(urls)
+        logging.info("Waiting to publish %d existing pages.", len(sync_publisher))
+        cursor = None
+        checkpoint(phase + 1, cursor)
+    crawl_manifest.finish_seeding(current_crawl)
+    return True
 
 
 @functions_framework.cloud_event
 def crawl_url(cloud_event):
-    """Crawl one URL, received from a PubSub queue."""
+    """Crawl the URLs in a message pushed from a PubSub queue."""
     try:
         do_crawl_url(cloud_event)
     except Exception:
@@ -110,22 +237,300 @@ def do_crawl_url(cloud_event):
         ) from e
     logging.info("Invoked with %r", data)
     current_crawl, prev_crawl = get_crawl(data)
-    url = clean_url(whatwg_url.parse_url(data["url"])).href
-    assert ok_to_crawl(url), url
-    if url in crawled_urls:
+    urls = list(
+        dict.fromkeys(
+            clean_url(whatwg_url.parse_url(url)).href for url in message_urls(data)
+        )
+    )
+    for url in urls:
+        assert ok_to_crawl(url), url
+    if not is_current_crawl(current_crawl):
+        logging.warning("Dropping %d URLs from old crawl %s", len(urls), current_crawl)
+        return
+    crawl_progress.set_crawl(current_crawl)
+    urls = [url for url in urls if url not in crawl_progress.crawled]
+    if not urls:
         return
 
+    out_of_time, _ = crawl_urls(
+        {url: (current_crawl, prev_crawl) for url in urls},
+        time.monotonic() + config.CRAWL_BATCH_TIME_BUDGET,
+    )
+    if out_of_time:
+        # A pushed message can't be returned to the subscription, so queue the
+        # URLs it didn't get to again.
+        logging.warning(
+            "Ran out of time before fetching %d URLs; queuing them again.",
+            len(out_of_time),
+        )
+        for url in out_of_time:
+            crawl_progress.discard_queued(url)
+        sync_publisher = SynchronousPublisher(publisher)
+        OutboundLinkPublisher(sync_publisher, prev_crawl, current_crawl).publish_many(
+            sorted(out_of_time)
+        )
+        sync_publisher.wait()
+
+
+@functions_framework.http
+def crawl_batch(request):
+    """Crawl a batch of URLs pulled from the crawl subscription."""
+    try:
+        if request.method != "POST":
+            return "Method not allowed\n", 405, {"Allow": "POST"}
+        crawled = do_crawl_batch()
+        return f"Crawled {crawled} URLs\n", 200
+    except Exception:
+        report_exception()
+        return traceback.format_exc(), 500
+
+
+def do_crawl_batch(
+    max_messages: int = config.CRAWL_BATCH_SIZE, max_urls: int = config.CRAWL_BATCH_SIZE
+) -> int:
+    """Leases up to max_messages messages from the crawl subscription and crawls
+    their URLs as one unit.
+
+    Messages that would take the batch past max_urls URLs are returned to the
+    subscription for a later batch, unless the batch would otherwise be empty.
+
+    The URLs are crawled by crawl_urls(). Fetches that the rate limiter
+    wouldn't allow within CRAWL_BATCH_TIME_BUDGET seconds are skipped, and
+    their messages are returned to the subscription.
+
+    Returns the number of URLs that were actually crawled.
+    """
+    deadline = time.monotonic() + config.CRAWL_BATCH_TIME_BUDGET
+    try:
+        response = subscriber.pull(
+            request={
+                "subscription": crawl_subscription_path,
+                "max_messages": max_messages,
+            },
+            timeout=10,
+        )
+    except google.api_core.exceptions.DeadlineExceeded:
+        return 0
+    ack_ids = []
+    nack_ids = []
+    # Maps each URL to crawl onto its (current_crawl, prev_crawl).
+    to_crawl: Dict[str, Tuple[str, str]] = {}
+    # The URLs that each acked message added to to_crawl.
+    urls_by_ack_id: Dict[str, List[str]] = {}
+    for received in response.received_messages:
+        urls, crawls = parse_crawl_message(received.message.data)
+        if urls and not is_current_crawl(crawls[0]):
+            logging.warning("Dropping %d URLs from old crawl %s", len(urls), crawls[0])
+            urls = []
+        if urls:
+            crawl_progress.set_crawl(crawls[0])
+            urls = [
+                url
+                for url in urls
+                if url not in crawl_progress.crawled and url not in to_crawl
+            ]
+        if to_crawl and len(to_crawl) + len(urls) > max_urls:
+            nack_ids.append(received.ack_id)
+            continue
+        ack_ids.append(received.ack_id)
+        urls_by_ack_id[received.ack_id] = urls
+        for url in urls:
+            to_crawl[url] = crawls
+    logging.info("Crawling %d URLs from %d messages.", len(to_crawl), len(ack_ids))
+
+    out_of_time, failed = crawl_urls(to_crawl, deadline)
+    if out_of_time:
+        logging.warning(
+            "Ran out of time before fetching %d URLs; returning their messages.",
+            len(out_of_time),
+        )
+        # The redelivered messages' other URLs are skipped as already crawled.
+        nack_ids += [
+            ack_id
+            for ack_id in ack_ids
+            if not out_of_time.isdisjoint(urls_by_ack_id[ack_id])
+        ]
+        ack_ids = [ack_id for ack_id in ack_ids if ack_id not in nack_ids]
+    if ack_ids:
+        subscriber.acknowledge(
+            request={"subscription": crawl_subscription_path, "ack_ids": ack_ids}
+        )
+    if nack_ids:
+        subscriber.modify_ack_deadline(
+            request={
+                "subscription": crawl_subscription_path,
+                "ack_ids": nack_ids,
+                "ack_deadline_seconds": 0,
+            }
+        )
+    return len(to_crawl) - len(out_of_time) - len(failed)
+
+
+def crawl_urls(
+    to_crawl: Dict[str, Tuple[str, str]], deadline: float
+) -> Tuple[Set[str], Set[str]]:
+    """Crawls the URLs in to_crawl, which maps each one onto its
+    (current_crawl, prev_crawl), as one unit.
+
+    All the URLs share one publisher and one Firestore write batch, so the
+    batch waits for Pub/Sub and commits to Firestore once instead of once per
+    URL. Up to CRAWL_THREADS URLs are processed at once, sharing the rate
+    limiter. Fetches that the rate limiter wouldn't allow before deadline, a
+    time.monotonic() value, are skipped. URLs whose crawl fails are reported,
+    and aren't marked crawled, so other pages' links can queue them again.
+
+    Returns the URLs that were skipped for lack of time, and the URLs that
+    failed.
+    """
+    # Read all the cache entries up front, with one read per crawl.
+    urls_by_crawls: Dict[Tuple[str, str], List[str]] = {}
+    for url, crawls in to_crawl.items():
+        urls_by_crawls.setdefault(crawls, []).append(url)
+    cached_responses: Dict[str, CachedResponse] = {}
+    for (current_crawl, prev_crawl), urls in urls_by_crawls.items():
+        with span("cache_lookup"):
+            cached_responses.update(
+                cache.responses_for(
+                    urls, curr_crawl=current_crawl, prev_crawl=prev_crawl
+                )
+            )
+
     sync_publisher = SynchronousPublisher(publisher)
+    with cache.storage.content_writer() as content_writer:
+        out_of_time: Set[str] = set()
+        failed: Set[str] = set()
+
+        def crawl_in_batch(url: str) -> Optional[FreshResponse]:
+            current_crawl, prev_crawl = to_crawl[url]
+            try:
+                with span("crawl_url"):
+                    return crawl_one(
+                        url,
+                        current_crawl,
+                        prev_crawl,
+                        sync_publisher,
+                        cached_responses[url],
+                        content_writer,
+                        deadline,
+                    )
+            except OutOfTime:
+                out_of_time.add(url)
+                return None
+            except Exception:
+                # Don't retry URLs that fail, but let other pages' links queue
+                # them again.
+                report_exception()
+                failed.add(url)
+                crawl_progress.discard_queued(url)
+                return None
+
+        batch = db.batch()
+        pages_by_crawl: Dict[str, int] = {}
+        # Crawl several URLs at once, so that one page's parsing and storage overlap
+        # with the next page's wait for the rate limiter.
+        with futures.ThreadPoolExecutor(max_workers=config.CRAWL_THREADS) as executor:
+            for url, fresh_response in zip(
+                to_crawl, executor.map(crawl_in_batch, to_crawl)
+            ):
+                if fresh_response is None:
+                    continue
+                current_crawl = to_crawl[url][0]
+                fresh_response.write(cache.storage, current_crawl, batch)
+                pages_by_crawl[current_crawl] = pages_by_crawl.get(current_crawl, 0) + 1
+        for current_crawl, pages in pages_by_crawl.items():
+            crawl_manifest.add_pages(current_crawl, pages, batch)
+        with span("publish_wait"):
+            sync_publisher.wait()
+        with span("content_flush"):
+            content_writer.flush()
+    # After we've published all the links, we can mark the URLs as crawled.
+    for url in to_crawl:
+        if url not in out_of_time and url not in failed:
+            crawl_progress.mark_crawled(url)
+    stage_timer.flush(crawl_stats_document(crawl_progress.crawl), batch)
+    flush_noise_rule_hits(crawl_stats_document(crawl_progress.crawl), batch)
+    if len(batch) > 0:
+        with span("commit"):
+            batch.commit()
+    crawl_progress.checkpoint_if_needed()
+    return out_of_time, failed
+
+
+def parse_crawl_message(
+    message_data: bytes,
+) -> Tuple[List[str], Tuple[str, str]]:
+    """Parses a crawl message into its cleaned URLs and its (current_crawl,
+    prev_crawl).
+
+    URLs that are invalid or that we shouldn't crawl are dropped.
+    """
+    try:
+        data = json.loads(message_data)
+        message_url_list = message_urls(data)
+    except Exception:
+        logging.exception("Dropping invalid crawl message %r", message_data)
+        return [], ("", "")
+    crawls = get_crawl(data)
+    urls = []
+    for message_url in message_url_list:
+        try:
+            url = clean_url(whatwg_url.parse_url(message_url)).href
+        except Exception:
+            logging.exception("Dropping invalid URL %r", message_url)
+            continue
+        if not ok_to_crawl(url):
+            logging.error("Dropping disallowed URL %r", url)
+            continue
+        urls.append(url)
+    return urls, crawls
+
+
+def message_urls(data: dict) -> List[str]:
+    """Returns the URLs in a crawl message, from both its url and urls fields."""
+    urls = list(data.get("urls", []))
+    if data.get("url", ""):
+        urls.insert(0, data["url"])
+    return urls
+
+
+def crawl_one(
+    url: str,
+    current_crawl: str,
+    prev_crawl: str,
+    sync_publisher: "SynchronousPublisher",
+    cached_response: Optional[CachedResponse] = None,
+    content_writer: Optional[ContentWriter] = None,
+    deadline: Optional[float] = None,
+) -> Optional[FreshResponse]:
+    """Crawls url unless it's already in the current crawl.
+
+    Page changes and outbound links are published through sync_publisher. If
+    the caller already loaded url's cache entry, it can pass it as
+    cached_response. New content is written through content_writer if it's
+    given. If the rate limiter wouldn't allow the fetch until after deadline,
+    raises OutOfTime. This is safe to call from several threads at once.
+
+    Returns the response to record in the current crawl, or None if url is
+    already there. The caller has to wait for the publisher and flush
+    content_writer before writing the response.
+    """
     link_publisher = OutboundLinkPublisher(sync_publisher, prev_crawl, current_crawl)
-    cached_response = cache.response_for(
-        url=url, prev_crawl=prev_crawl, curr_crawl=current_crawl
-    )
+    if cached_response is None:
+        cached_response = cache.response_for(
+            url=url, prev_crawl=prev_crawl, curr_crawl=current_crawl
+        )
     if cached_response.state == CacheState.FRESH:
-        crawled_urls.add(url)
-        return
+        return None
 
-    wait_for_next_fetch()
-    fresh_response = cached_response.fetch(SESSION)
+    if cached_response.state == CacheState.STALE and not revisit_policy.is_due(
+        cached_response.history
+    ):
+        logging.info("Not revalidating %s this crawl.", url)
+        fresh_response = cached_response.reuse()
+    else:
+        fresh_response = cached_response.fetch(
+            SESSION, rate_limiter, content_writer, deadline
+        )
 
     publish_page_change(fresh_response, sync_publisher, current_crawl)
 
@@ -138,10 +543,7 @@ def do_crawl_url(cloud_event):
         logging.info("Queuing crawls of %r", fresh_response.links)
         for link in fresh_response.links:
             link_publisher.publish(link)
-    sync_publisher.wait()
-    # After we've published all the links, we can mark the URL as crawled.
-    crawled_urls.add(url)
-    fresh_response.write_to_firestore(db, current_crawl)
+    return fresh_response
 
 
 def get_crawl(data: dict) -> Tuple[str, str]:
@@ -152,6 +554,10 @@ def get_crawl(data: dict) -> Tuple[str, str]:
         current_crawl = datetime.now(timezone.utc).date().isoformat()
     prev_crawl = data.get("prev_crawl", "")
     if prev_crawl == "":
+        prev_crawl = crawl_manifest.prev_crawl(current_crawl)
+    if prev_crawl is None:
+        # Crawls from before the manifest existed have to be found by scanning.
+        prev_crawl = ""
         for collection in db.collections():
             if not collection.id.startswith("crawl-"):
                 continue
@@ -164,21 +570,59 @@ def get_crawl(data: dict) -> Tuple[str, str]:
     return current_crawl, prev_crawl
 
 
+def is_current_crawl(crawl: str) -> bool:
+    """Returns whether crawl is the newest crawl in the manifest.
+
+    Messages left over from earlier crawls are dropped rather than switching
+    crawl_progress back to their crawl. Crawls from before the manifest existed
+    are all accepted.
+    """
+    latest_crawl = crawl_manifest.latest_crawl()
+    if latest_crawl is not None and crawl > latest_crawl:
+        # The crawl may have started since we cached the manifest.
+        crawl_manifest.invalidate()
+        latest_crawl = crawl_manifest.latest_crawl()
+    return latest_crawl is None or crawl == latest_crawl
+
+
+def crawl_stats_document(crawl: str) -> Optional[firestore.DocumentReference]:
+    """Returns the document that accumulates crawl's stage timings."""
+    if not crawl:
+        return None
+    return db.collection("crawl_stats").document(crawl)
+
+
+def flush_noise_rule_hits(
+    doc: Optional[firestore.DocumentReference], batch: firestore.WriteBatch
+) -> None:
+    """Logs how many times each noise rule matched since the last flush, and
+    adds the counts to doc."""
+    hits = noise_rules.take_hits()
+    if not hits:
+        return
+    logging.info(
+        "Noise rule hits: %s",
+        hits,
+        extra={"json_fields": {"noise_rule_hits": hits}},
+    )
+    if doc is not None:
+        batch.set(
+            doc,
+            {
+                "noise_rule_hits": {
+                    name: firestore.Increment(count) for name, count in hits.items()
+                }
+            },
+            merge=True,
+        )
+
+
 def ok_to_crawl(url: str):
     return url.startswith(
         "https://www.portland.gov/transportation"
     ) and robots.can_fetch(USER_AGENT, url)
 
 
-def wait_for_next_fetch():
-    """Wait until the next fetch is allowed."""
-    global next_fetch
-    now = datetime.now(timezone.utc)
-    if now < next_fetch:
-        time.sleep((next_fetch - now).total_seconds())
-    next_fetch = datetime.now(timezone.utc) + crawl_delay
-
-
 class SynchronousPublisher:
     def __init__(self, publisher: pubsub_v1.PublisherClient):
         self.publisher = publisher
@@ -208,13 +652,44 @@ class OutboundLinkPublisher:
         self.prev_crawl = prev_crawl
         self.current_crawl = current_crawl
 
+    def claim(self, url: str) -> bool:
+        """Returns whether to publish url, marking it queued if so."""
+        return ok_to_crawl(url) and crawl_progress.claim(url)
+
     def publish(self, url: str) -> None:
-        if ok_to_crawl(url) and url not in crawled_urls:
+        if self.claim(url):
             data = json.dumps(
                 {"url": url, "crawl": self.current_crawl, "prev_crawl": self.prev_crawl}
             )
             logging.info("Publishing %s to %r", data, crawl_topic_path)
-            self.publisher.publish(crawl_topic_path, data.encode("utf-8"))
+            self._publish(data, [url])
+
+    def publish_many(self, urls: List[str]) -> None:
+        """Publishes urls, packed into a single message."""
+        urls = [url for url in urls if self.claim(url)]
+        if not urls:
+            return
+        data = json.dumps(
+            {"urls": urls, "crawl": self.current_crawl, "prev_crawl": self.prev_crawl}
+        )
+        logging.info("Publishing %d URLs to %r", len(urls), crawl_topic_path)
+        self._publish(data, urls)
+
+    def _publish(self, data: str, urls: List[str]) -> None:
+        """Publishes data, which queues urls. If that fails, the urls are
+        unmarked as queued, so that other pages' links can queue them again."""
+
+        def unmark(future: Optional[futures.Future] = None) -> None:
+            if future is None or future.cancelled() or future.exception() is not None:
+                for url in urls:
+                    crawl_progress.discard_queued(url)
+
+        try:
+            future = self.publisher.publish(crawl_topic_path, data.encode("utf-8"))
+        except Exception:
+            unmark()
+            raise
+        future.add_done_callback(unmark)
 
 
 def publish_page_change(
@@ -237,19 +712,155 @@ def publish_page_change(
     change_description["diff"] = response.diff
     logging.info("Publishing changed page: %s", json.dumps(change_description))
     publisher.publish(changed_pages_topic_path, json.dumps(change_description).encode())
-    # And ask the Web Archive to save a copy of the page.
-    archive_result = SESSION.get(
-        "https://web.archive.org/save/" + response.url,
-        # data={"url": response.url, "capture_all": "on"},
-        allow_redirects=False,
+    # And queue a request for the Web Archive to save a copy of the page.
+    publisher.publish(
+        archive_pages_topic_path,
+        json.dumps({"crawl": current_crawl, "url": response.url}).encode(),
     )
-    if archive_result.status_code >= 400:
-        logging.error(
-            f"Failed to archive {response.url!r}: {archive_result.status_code}, {archive_result.headers!r}"
+
+
+@functions_framework.http
+def archive_pages(request):
+    """Ask the Web Archive to save a batch of changed pages."""
+    try:
+        if request.method != "POST":
+            return "Method not allowed\n", 405, {"Allow": "POST"}
+        archived = do_archive_pages()
+        return f"Archived {archived} pages\n", 200
+    except Exception:
+        report_exception()
+        return traceback.format_exc(), 500
+
+
+def do_archive_pages(max_messages: int = config.ARCHIVE_BATCH_SIZE) -> int:
+    """Leases up to max_messages pages from the archive-pages subscription and
+    asks the Web Archive to save each one.
+
+    Each attempt is recorded in the archive-{crawl} collection. Attempts that
+    fail transiently are nacked, so the subscription's retry policy backs them
+    off, and stop the batch early, since waiting out more timeouts or
+    Retry-After delays could outlast the function. Pages that the rate limiter
+    wouldn't allow within ARCHIVE_BATCH_TIME_BUDGET seconds are nacked too.
+
+    Returns the number of pages that were archived.
+    """
+    deadline = time.monotonic() + config.ARCHIVE_BATCH_TIME_BUDGET
+    try:
+        response = subscriber.pull(
+            request={
+                "subscription": archive_subscription_path,
+                "max_messages": max_messages,
+            },
+            timeout=10,
         )
-    elif "location" in archive_result.headers:
-        logging.info(f"Archived to {archive_result.headers['location']}")
-    else:
+    except google.api_core.exceptions.DeadlineExceeded:
+        return 0
+    ack_ids = []
+    retry_ack_ids = []
+    archived = 0
+    stopped = False
+    crawl = ""
+    batch = db.batch()
+    for received in response.received_messages:
+        if stopped:
+            # Leave the rest of the batch for the retry policy.
+            retry_ack_ids.append(received.ack_id)
+            continue
+        try:
+            data = json.loads(received.message.data)
+            url, crawl = data["url"], data["crawl"]
+        except Exception:
+            logging.exception("Dropping invalid archive message %r", received.message)
+            ack_ids.append(received.ack_id)
+            continue
+        try:
+            result, retry = archive_page(url, deadline)
+        except OutOfTime:
+            retry_ack_ids.append(received.ack_id)
+            stopped = True
+            continue
+        if retry:
+            retry_ack_ids.append(received.ack_id)
+            stopped = True
+        else:
+            ack_ids.append(received.ack_id)
+            if "archived_url" in result:
+                archived += 1
+        result.update(
+            url=url,
+            attempts=firestore.Increment(1),
+            updated=firestore.SERVER_TIMESTAMP,
+        )
+        batch.set(
+            db.collection(f"archive-{crawl}").document(
+                sha256(url.encode()).hexdigest()
+            ),
+            result,
+            merge=True,
+        )
+    stage_timer.flush(crawl_stats_document(crawl), batch)
+    if len(batch) > 0:
+        batch.commit()
+    if ack_ids:
+        subscriber.acknowledge(
+            request={"subscription": archive_subscription_path, "ack_ids": ack_ids}
+        )
+    if retry_ack_ids:
+        # Nack these so the subscription's retry policy backs them off.
+        subscriber.modify_ack_deadline(
+            request={
+                "subscription": archive_subscription_path,
+                "ack_ids": retry_ack_ids,
+                "ack_deadline_seconds": 0,
+            }
+        )
+    return archived
+
+
+def archive_page(
+    url: str, deadline: Optional[float] = None
+) -> Tuple[Dict[str, Any], bool]:
+    """Asks the Web Archive to save url.
+
+    Returns the fields to record about the attempt, and whether it's worth
+    retrying. Raises OutOfTime if the rate limiter wouldn't allow the request
+    before deadline, a time.monotonic() value.
+    """
+    with span("archive_rate_limit_wait"):
+        archive_rate_limiter.acquire(deadline)
+    try:
+        with span("archive"):
+            archive_response = SESSION.get(
+                "https://web.archive.org/save/" + url,
+                allow_redirects=False,
+                timeout=config.ARCHIVE_TIMEOUT,
+            )
+    except requests.RequestException as e:
+        logging.warning("Failed to archive %r: %s", url, e)
+        return {"error": str(e)}, True
+    status_code = archive_response.status_code
+    retry_after = None
+    if status_code in (429, 503):
+        retry_after = parse_retry_after(archive_response.headers.get("retry-after"))
+    archive_rate_limiter.record(status_code, 0, retry_after)
+    if status_code == 429 or status_code >= 500:
         logging.warning(
-            f"Something odd with archiving {response.url!r}: {archive_result.status_code}, {archive_result.headers!r}"
+            f"Will retry archiving {url!r}: {status_code}, {archive_response.headers!r}"
         )
+        return {"status_code": status_code, "error": f"HTTP {status_code}"}, True
+    if status_code >= 400:
+        logging.error(
+            f"Failed to archive {url!r}: {status_code}, {archive_response.headers!r}"
+        )
+        return {"status_code": status_code, "error": f"HTTP {status_code}"}, False
+    if "location" in archive_response.headers:
+        logging.info(f"Archived to {archive_response.headers['location']}")
+        return {
+            "status_code": status_code,
+            "archived_url": archive_response.headers["location"],
+            "error": firestore.DELETE_FIELD,
+        }, False
+    logging.warning(
+        f"Something odd with archiving {url!r}: {status_code}, {archive_response.headers!r}"
+    )
+    return {"status_code": status_code, "error": "No location in the response"}, False
@@ -0,0 +1,102 @@
+import logging
+from typing import Any, Dict, Optional
+
+from google.cloud import firestore
+
+
+class CrawlManifest:
+    """The list of crawls, kept in a single Firestore document.
+
+    The document has a `crawls` map from each crawl's date to its `status`,
+    `prev_crawl`, `started` time, the number of `pages` written so far, and how
+    far start_crawl has gotten through seeding it. It's cached in-process, so
+    finding the previous crawl doesn't need to scan every collection in the
+    database.
+    """
+
+    def __init__(self, doc: firestore.DocumentReference):
+        self.doc = doc
+        self._crawls: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def crawls(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the crawls by date, loading them if they aren't cached."""
+        crawls = self._crawls
+        if crawls is None:
+            crawls = (self.doc.get().to_dict() or {}).get("crawls", {})
+            self._crawls = crawls
+        return crawls
+
+    def latest_crawl(self) -> Optional[str]:
+        """Returns the newest crawl, or None if the manifest doesn't list any."""
+        return max(self.crawls(), default=None)
+
+    def invalidate(self) -> None:
+        self._crawls = None
+
+    def prev_crawl(self, current_crawl: str) -> Optional[str]:
+        """Returns the newest crawl before current_crawl, or None if the manifest
+        doesn't list any.
+        """
+        if current_crawl not in self.crawls():
+            # A new crawl may have started since we cached the manifest.
+            self.invalidate()
+        return max(
+            (crawl for crawl in self.crawls() if crawl < current_crawl), default=None
+        )
+
+    def start(self, crawl: str, prev_crawl: str) -> None:
+        """Records that crawl has started, and that prev_crawl is complete."""
+        logging.info("Recording the start of crawl %s in the manifest.", crawl)
+        crawls: Dict[str, Dict[str, Any]] = {
+            crawl: {
+                "status": "running",
+                "prev_crawl": prev_crawl,
+                "started": firestore.SERVER_TIMESTAMP,
+            }
+        }
+        if prev_crawl:
+            crawls[prev_crawl] = {"status": "complete"}
+        self.doc.set({"crawls": crawls}, merge=True)
+        self.invalidate()
+
+    def add_pages(self, crawl: str, pages: int, batch: firestore.WriteBatch) -> None:
+        """Adds pages to crawl's page count as part of batch."""
+        batch.set(
+            self.doc,
+            {"crawls": {crawl: {"pages": firestore.Increment(pages)}}},
+            merge=True,
+        )
+
+    def seed_phase(self, crawl: str) -> int:
+        """Returns which of start_crawl's seeding passes crawl is in."""
+        return self.crawls().get(crawl, {}).get("seed_phase", 0)
+
+    def seed_cursor(self, crawl: str) -> Optional[str]:
+        """Returns the ID of the last previous-crawl document that the current
+        seeding phase got through, or None if it hasn't checkpointed yet."""
+        return self.crawls().get(crawl, {}).get("seed_cursor")
+
+    def seeded(self, crawl: str) -> bool:
+        """Returns whether all of the previous crawl's pages were seeded into
+        crawl."""
+        return self.crawls().get(crawl, {}).get("seeded", False)
+
+    def save_seed_cursor(self, crawl: str, phase: int, cursor: Optional[str]) -> None:
+        self.doc.set(
+            {
+                "crawls": {
+                    crawl: {
+                        "seed_phase": phase,
+                        "seed_cursor": (
+                            firestore.DELETE_FIELD if cursor is None else cursor
+                        ),
+                    }
+                }
+            },
+            merge=True,
+        )
+        self.invalidate()
+
+    def finish_seeding(self, crawl: str) -> None:
+        self.doc.set({"crawls": {crawl: {"seeded": True}}}, merge=True)
+        self.invalidate()
@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional
+
+
+class OutOfTime(Exception):
+    """Waiting for the rate limiter would have run past the caller's deadline."""
+
+
+class RateLimiter:
+    """A token bucket that spaces out fetches from one site.
+
+    One token accrues every `interval` seconds, up to `burst` tokens, and each
+    fetch spends one. This is implemented as the equivalent "virtual
+    scheduling" algorithm, which just tracks when the next token will be
+    available.
+
+    Slots are reserved under a lock, so several threads can share a limiter:
+    while one thread waits for its slot, the others can parse and store pages
+    they've already fetched.
+
+    Retry-After delays are capped at max_defer seconds.
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        burst: int = 1,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        max_defer: float = float("inf"),
+    ):
+        self.interval = interval
+        self.burst = burst
+        self.max_defer = max_defer
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        # When the bucket will next be empty, if nothing else is reserved.
+        self._theoretical_arrival = clock()
+
+    def reserve(self, deadline: Optional[float] = None) -> Optional[float]:
+        """Reserves the next slot, and returns how many seconds to wait for it.
+
+        If the slot would start after deadline, by the limiter's clock, nothing
+        is reserved and this returns None.
+        """
+        with self._lock:
+            now = self._clock()
+            arrival = max(self._theoretical_arrival, now)
+            # The slot starts when the bucket has a token again.
+            slot = arrival - (self.burst - 1) * self.interval
+            if deadline is not None and slot > deadline:
+                return None
+            self._theoretical_arrival = arrival + self.interval
+            return max(0.0, slot - now)
+
+    def acquire(self, deadline: Optional[float] = None) -> None:
+        """Waits until a fetch is allowed.
+
+        Raises OutOfTime, without waiting, if that would be after deadline.
+        """
+        delay = self.reserve(deadline)
+        if delay is None:
+            raise OutOfTime()
+        if delay > 0:
+            self._sleep(delay)
+
+    def record(
+        self, status_code: int, latency: float, retry_after: Optional[float] = None
+    ) -> None:
+        """Tells the limiter how the site responded to a fetch.
+
+        latency is the number of seconds until the response headers arrived.
+        The base limiter only honors retry_after.
+        """
+        if retry_after is not None:
+            self.defer(retry_after)
+
+    def defer(self, seconds: float) -> None:
+        """Delays all future slots until at least `seconds` from now, as asked by
+        a Retry-After header, up to max_defer.
+        """
+        seconds = min(seconds, self.max_defer)
+        with self._lock:
+            self._theoretical_arrival = max(
+                self._theoretical_arrival,
+                self._clock() + seconds + (self.burst - 1) * self.interval,
+            )
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """A RateLimiter whose interval follows how the site is coping.
+
+    Quick, successful responses shrink the interval toward min_interval, which
+    should be the fastest rate robots.txt allows. 429 and 503 responses,
+    Retry-After, or a smoothed latency above slow_latency grow it toward
+    max_interval.
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        *,
+        min_interval: float,
+        max_interval: float,
+        fast_latency: float = 0.5,
+        slow_latency: float = 2.0,
+        backoff_factor: float = 2.0,
+        recovery_factor: float = 0.9,
+        **kwargs,
+    ):
+        super().__init__(interval, **kwargs)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.fast_latency = fast_latency
+        self.slow_latency = slow_latency
+        self.backoff_factor = backoff_factor
+        self.recovery_factor = recovery_factor
+        # Exponentially-weighted moving average of the response latency.
+        self.latency: Optional[float] = None
+
+    @property
+    def rate(self) -> float:
+        """The current number of fetches allowed per second."""
+        return 1 / self.interval if self.interval > 0 else float("inf")
+
+    def record(
+        self, status_code: int, latency: float, retry_after: Optional[float] = None
+    ) -> None:
+        super().record(status_code, latency, retry_after)
+        with self._lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            old_interval = self.interval
+            if (
+                status_code in (429, 503)
+                or retry_after is not None
+                or self.latency > self.slow_latency
+            ):
+                self.interval = min(
+                    self.max_interval,
+                    max(self.interval, self.min_interval) * self.backoff_factor,
+                )
+            elif status_code < 500 and self.latency < self.fast_latency:
+                self.interval = max(
+                    self.min_interval, self.interval * self.recovery_factor
+                )
+            if self.interval != old_interval:
+                logging.info(
+                    "Crawl rate is now %.2f/s (latency %.2fs, status %d)",
+                    self.rate,
+                    self.latency,
+                    status_code,
+                    extra={"json_fields": {"crawl_rate": self.rate}},
+                )
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header into a number of seconds from now."""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_time = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_time.tzinfo is None:
+        retry_time = retry_time.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_time - datetime.now(timezone.utc)).total_seconds())
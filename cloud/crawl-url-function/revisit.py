@@ -0,0 +1,110 @@
+from typing import Any, Dict, Optional
+
+
+class RevisitHistory:
+    """How often a URL's content has changed, carried from each crawl's document
+    to the next one's.
+    """
+
+    __slots__ = ("change_rate", "unchanged_crawls", "skipped_crawls")
+
+    # How much of the change rate carries over from one fetch to the next.
+    CHANGE_RATE_DECAY = 0.7
+
+    def __init__(
+        self,
+        change_rate: float = 0.0,
+        unchanged_crawls: int = 0,
+        skipped_crawls: int = 0,
+    ):
+        # Exponentially-weighted fraction of fetches that found a change.
+        self.change_rate = change_rate
+        # Consecutive fetches that found the content unchanged.
+        self.unchanged_crawls = unchanged_crawls
+        # Consecutive crawls that reused the previous crawl's entry without
+        # fetching.
+        self.skipped_crawls = skipped_crawls
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> Optional["RevisitHistory"]:
+        if not data:
+            return None
+        return cls(
+            change_rate=data.get("change_rate", 0.0),
+            unchanged_crawls=data.get("unchanged_crawls", 0),
+            skipped_crawls=data.get("skipped_crawls", 0),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "change_rate": self.change_rate,
+            "unchanged_crawls": self.unchanged_crawls,
+            "skipped_crawls": self.skipped_crawls,
+        }
+
+    def after_fetch(self, changed: bool) -> "RevisitHistory":
+        """Returns the history after a fetch that did or didn't find a change."""
+        return RevisitHistory(
+            change_rate=self.CHANGE_RATE_DECAY * self.change_rate
+            + (1 - self.CHANGE_RATE_DECAY) * changed,
+            unchanged_crawls=0 if changed else self.unchanged_crawls + 1,
+            skipped_crawls=0,
+        )
+
+    def after_skip(self) -> "RevisitHistory":
+        """Returns the history after a crawl that didn't fetch the URL."""
+        return RevisitHistory(
+            change_rate=self.change_rate,
+            unchanged_crawls=self.unchanged_crawls,
+            skipped_crawls=self.skipped_crawls + 1,
+        )
+
+    @classmethod
+    def first_fetch(cls, changed: bool) -> "RevisitHistory":
+        """Returns the history of a URL that had no history before this fetch."""
+        return cls(
+            change_rate=1.0 if changed else 0.0, unchanged_crawls=0 if changed else 1
+        )
+
+
+class RevisitPolicy:
+    """Decides how often to revalidate each URL, based on its RevisitHistory.
+
+    Pages are revalidated every crawl until they've been unchanged for
+    `unchanged_per_step` fetches. After that, each further `unchanged_per_step`
+    unchanged fetches add a crawl to the interval, up to `max_interval` crawls.
+    Pages whose change rate is at least `hot_change_rate` are "hot", and are
+    queued before the rest of the crawl.
+    """
+
+    def __init__(
+        self,
+        max_interval: int,
+        hot_change_rate: float,
+        unchanged_per_step: int = 4,
+    ):
+        self.max_interval = max_interval
+        self.hot_change_rate = hot_change_rate
+        self.unchanged_per_step = unchanged_per_step
+
+    def interval(self, history: Optional[RevisitHistory]) -> int:
+        """Returns how many crawls apart to revalidate a URL."""
+        if history is None:
+            return 1
+        return max(
+            1,
+            min(
+                self.max_interval,
+                1 + history.unchanged_crawls // self.unchanged_per_step,
+            ),
+        )
+
+    def is_due(self, history: Optional[RevisitHistory]) -> bool:
+        """Returns whether this crawl should revalidate a URL."""
+        if history is None:
+            return True
+        return history.skipped_crawls + 1 >= self.interval(history)
+
+    def is_hot(self, history: Optional[RevisitHistory]) -> bool:
+        """Returns whether a URL changes often enough to queue it first."""
+        return history is not None and history.change_rate >= self.hot_change_rate
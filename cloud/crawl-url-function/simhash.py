@@ -0,0 +1,54 @@
+import re
+from collections import Counter
+from hashlib import blake2b
+
+# Fingerprints are 64 bits, stored as signed integers to fit in Firestore.
+FINGERPRINT_BITS = 64
+
+# Features are runs of this many words, so reordered words count as changes.
+SHINGLE_WORDS = 3
+
+_WORD = re.compile(r"\w+")
+
+
+def simhash(text: str) -> int:
+    """Returns Charikar's SimHash of text's word shingles.
+
+    Texts that differ in a few words have fingerprints that differ in a few
+    bits, so distance() between two fingerprints estimates how much the texts
+    changed without comparing them.
+    """
+    words = _WORD.findall(text.lower())
+    shingles = Counter(
+        " ".join(words[i : i + SHINGLE_WORDS])
+        for i in range(max(1, len(words) - SHINGLE_WORDS + 1))
+    )
+    # Tally each byte of the shingles' hashes, then each bit of those bytes,
+    # which is much faster in Python than tallying every bit of every hash.
+    byte_counts = [[0] * 256 for _ in range(FINGERPRINT_BITS // 8)]
+    for shingle, count in shingles.items():
+        digest = blake2b(shingle.encode(), digest_size=FINGERPRINT_BITS // 8).digest()
+        for position, value in enumerate(digest):
+            byte_counts[position][value] += count
+    total = sum(shingles.values())
+    weights = [0] * FINGERPRINT_BITS
+    for position, counts in enumerate(byte_counts):
+        for value, count in enumerate(counts):
+            if not count:
+                continue
+            for bit in range(8):
+                if value >> bit & 1:
+                    # Bits are numbered from the end of the digest.
+                    weights[(len(byte_counts) - 1 - position) * 8 + bit] += count
+    # Each bit's weight is the count of shingles with it set minus the count
+    # without it.
+    weights = [2 * weight - total for weight in weights]
+    fingerprint = sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+    if fingerprint >= 1 << (FINGERPRINT_BITS - 1):
+        fingerprint -= 1 << FINGERPRINT_BITS
+    return fingerprint
+
+
+def distance(a: int, b: int) -> int:
+    """Returns the number of bits that differ between two fingerprints."""
+    return bin((a ^ b) & ((1 << FINGERPRINT_BITS) - 1)).count("1")
@@ -0,0 +1,540 @@
+import json
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from hashlib import sha256
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import google.api_core.exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1.bulk_writer import BulkWriteFailure, BulkWriter
+from google.rpc import code_pb2
+
+from revisit import RevisitHistory
+
+
+class CrawlEntry:
+    """The parts of a crawl document that the cache uses.
+
+    Content references are kept as paths, which take much less memory than
+    DocumentReferences when a whole crawl is indexed.
+    """
+
+    __slots__ = (
+        "status_code",
+        "headers",
+        "content_path",
+        "text_content_path",
+        "history",
+    )
+
+    def __init__(
+        self,
+        status_code: int,
+        headers: Dict[str, str],
+        content_path: Optional[str],
+        text_content_path: Optional[str],
+        history: Optional[RevisitHistory] = None,
+    ):
+        self.status_code = status_code
+        self.headers = headers
+        self.content_path = content_path
+        self.text_content_path = text_content_path
+        self.history = history
+
+    @classmethod
+    def from_snapshot(
+        cls, snapshot: firestore.DocumentSnapshot
+    ) -> Optional["CrawlEntry"]:
+        """Returns the entry in a crawl document, or None if it doesn't exist."""
+        data = snapshot.to_dict()
+        if data is None:
+            return None
+        content = data.get("content")
+        text_content = data.get("text_content")
+        return cls(
+            status_code=data["status_code"],
+            headers=data.get("headers") or {},
+            content_path=content.path if content is not None else None,
+            text_content_path=text_content.path if text_content is not None else None,
+            history=RevisitHistory.from_dict(data.get("history")),
+        )
+
+
+def url_digest(url: str) -> bytes:
+    return sha256(url.encode()).digest()
+
+
+class Storage(ABC):
+    """Where the cache keeps its crawls and content-addressed documents.
+
+    Content documents are referred to by objects with the parts of
+    firestore.DocumentReference's interface that the cache uses: `path`, `id`,
+    `get(field_paths=...)`, and `create(value)`, which raises AlreadyExists if
+    the document exists.
+    """
+
+    @abstractmethod
+    def document(self, path: str) -> Any:
+        """Returns a reference to the content document at path, such as
+        "content/<digest>"."""
+
+    @abstractmethod
+    def read_crawl_entries(
+        self, keys: Sequence[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], Optional[CrawlEntry]]:
+        """Reads the entries for (crawl, url) pairs in one round trip.
+
+        Pairs with no entry map to None.
+        """
+
+    @abstractmethod
+    def crawl_entries(self, crawl: str) -> Iterator[Tuple[bytes, CrawlEntry]]:
+        """Yields every entry in crawl, keyed by the SHA-256 digest of its URL."""
+
+    @abstractmethod
+    def write_crawl_entry(
+        self, crawl: str, url: str, value: Dict[str, Any], batch: Any = None
+    ) -> None:
+        """Writes url's entry in crawl.
+
+        value holds the crawl document's fields, with content references as
+        returned by document(). If batch is given, the write is added to it
+        instead of being sent immediately.
+        """
+
+    @abstractmethod
+    def batch(self) -> Any:
+        """Returns a batch of writes, which are applied together by its
+        commit()."""
+
+    @abstractmethod
+    def content_writer(self) -> "ContentWriter":
+        """Returns a writer that creates content documents for a batch of
+        pages."""
+
+
+def as_storage(db: Union[Storage, firestore.Client]) -> Storage:
+    """Accepts a Storage, or a Firestore client to use with FirestoreStorage."""
+    if isinstance(db, Storage):
+        return db
+    return FirestoreStorage(db)
+
+
+class ContentWriteError(Exception):
+    """Raised when content documents couldn't be created."""
+
+
+class ContentWriter(ABC):
+    """Creates documents in the content-addressed collections for a batch of
+    pages.
+
+    It's safe to call create() from several threads. Use it as a context
+    manager, or call close(), to release it when the batch is done.
+    """
+
+    @abstractmethod
+    def create(self, doc: Any, value: Dict[str, Any]) -> None:
+        """Creates doc, a reference returned by Storage.document(), with value,
+        unless it already exists. The create may not be sent until flush()."""
+
+    @abstractmethod
+    def flush(self) -> None:
+        """Waits for all the creates so far to finish.
+
+        Raises ContentWriteError if any of them failed, so that the caller
+        doesn't commit crawl entries that refer to missing documents.
+        """
+
+    def close(self) -> None:
+        """Flushes, and releases the writer."""
+        self.flush()
+
+    def __enter__(self) -> "ContentWriter":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+class FirestoreContentWriter(ContentWriter):
+    """Creates content documents in Firestore.
+
+    The creates share round trips through a BulkWriter.
+    """
+
+    # Give up on a create after this many failed attempts.
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, db: firestore.Client):
+        self._lock = threading.Lock()
+        # Paths of the documents whose creates gave up since the last flush.
+        # The BulkWriter reports them from its own threads, while flush()
+        # holds _lock.
+        self._failed: List[str] = []
+        self._failed_lock = threading.Lock()
+        self._bulk_writer = db.bulk_writer()
+        self._bulk_writer.on_write_error(self._on_write_error)
+
+    def create(self, doc: firestore.DocumentReference, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._bulk_writer.create(doc, value)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._bulk_writer.flush()
+        self._raise_failures()
+
+    def close(self) -> None:
+        """Flushes, and shuts down the BulkWriter's threads."""
+        with self._lock:
+            self._bulk_writer.close()
+        self._raise_failures()
+
+    def _raise_failures(self) -> None:
+        with self._failed_lock:
+            failed, self._failed = self._failed, []
+        if failed:
+            raise ContentWriteError(f"Failed to create {', '.join(failed)}")
+
+    def _on_write_error(
+        self, failure: BulkWriteFailure, bulk_writer: BulkWriter
+    ) -> bool:
+        """Returns whether to retry a failed create."""
+        if failure.code == code_pb2.ALREADY_EXISTS:
+            # Content-addressed documents never change, so this one is already
+            # written.
+            return False
+        if failure.attempts < self.MAX_ATTEMPTS:
+            return True
+        logging.error("Failed to write content: %s", failure.message)
+        reference = getattr(failure.operation, "reference", None)
+        with self._failed_lock:
+            self._failed.append(
+                "an unknown document" if reference is None else reference.path
+            )
+        return False
+
+
+class FirestoreStorage(Storage):
+    """Keeps each crawl in a crawl-YYYY-MM-DD collection, and content in the
+    content and text_content collections, as described in the README."""
+
+    def __init__(self, db: firestore.Client):
+        self.db = db
+
+    def document(self, path: str) -> firestore.DocumentReference:
+        return self.db.document(path)
+
+    def crawl_document(self, crawl: str, url: str) -> firestore.DocumentReference:
+        return self.db.collection(f"crawl-{crawl}").document(url_digest(url).hex())
+
+    def read_crawl_entries(
+        self, keys: Sequence[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], Optional[CrawlEntry]]:
+        refs = {key: self.crawl_document(*key) for key in keys}
+        snapshots = {
+            snapshot.reference.path: snapshot
+            for snapshot in self.db.get_all(list(refs.values()))
+        }
+        return {
+            key: CrawlEntry.from_snapshot(snapshots[ref.path])
+            for key, ref in refs.items()
+        }
+
+    def crawl_entries(self, crawl: str) -> Iterator[Tuple[bytes, CrawlEntry]]:
+        for snapshot in (
+            self.db.collection(f"crawl-{crawl}")
+            .select(["status_code", "headers", "content", "text_content", "history"])
+            .stream()
+        ):
+            entry = CrawlEntry.from_snapshot(snapshot)
+            if entry is not None:
+                yield bytes.fromhex(snapshot.id), entry
+
+    def write_crawl_entry(
+        self,
+        crawl: str,
+        url: str,
+        value: Dict[str, Any],
+        batch: Optional[firestore.WriteBatch] = None,
+    ) -> None:
+        doc = self.crawl_document(crawl, url)
+        if batch is None:
+            doc.set(value)
+        else:
+            batch.set(doc, value)
+
+    def batch(self) -> firestore.WriteBatch:
+        return self.db.batch()
+
+    def content_writer(self) -> FirestoreContentWriter:
+        return FirestoreContentWriter(self.db)
+
+
+class SqliteSnapshot:
+    """The parts of firestore.DocumentSnapshot that the cache uses."""
+
+    def __init__(self, reference: "SqliteDocument", data: Optional[Dict[str, Any]]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return self._data
+
+    def get(self, field: str) -> Any:
+        return (self._data or {}).get(field)
+
+
+class SqliteDocument:
+    """A reference to a content document in a SqliteStorage."""
+
+    def __init__(self, storage: "SqliteStorage", path: str):
+        self._storage = storage
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, SqliteDocument) and self.path == other.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+    def __repr__(self) -> str:
+        return f"SqliteDocument({self.path!r})"
+
+    def get(self, field_paths: Optional[Sequence[str]] = None) -> SqliteSnapshot:
+        return SqliteSnapshot(self, self._storage.read_fields(self.path, field_paths))
+
+    def create(self, value: Dict[str, Any]) -> None:
+        if not self._storage.create_document(self.path, value):
+            raise google.api_core.exceptions.AlreadyExists(self.path)
+
+
+class SqliteBatch:
+    """Statements that are executed in one transaction by commit()."""
+
+    def __init__(self, storage: "SqliteStorage"):
+        self._storage = storage
+        self._statements: List[Tuple[str, Tuple[Any, ...]]] = []
+
+    def __len__(self) -> int:
+        return len(self._statements)
+
+    def add(self, sql: str, params: Tuple[Any, ...]) -> None:
+        self._statements.append((sql, params))
+
+    def commit(self) -> None:
+        self._storage.execute_many(self._statements)
+        self._statements = []
+
+
+class SqliteContentWriter(ContentWriter):
+    """Creates content documents in a SqliteStorage.
+
+    Each create is written immediately, so flush() has nothing to wait for.
+    """
+
+    def __init__(self, storage: "SqliteStorage"):
+        self._storage = storage
+
+    def create(self, doc: SqliteDocument, value: Dict[str, Any]) -> None:
+        self._storage.create_document(doc.path, value)
+
+    def flush(self) -> None:
+        pass
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS crawl_entries (
+    crawl TEXT NOT NULL,
+    url_digest BLOB NOT NULL,
+    url TEXT NOT NULL,
+    status_code INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    content TEXT,
+    text_content TEXT,
+    history TEXT,
+    PRIMARY KEY (crawl, url_digest)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS documents (
+    path TEXT PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fields (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value,
+    PRIMARY KEY (path, name)
+) WITHOUT ROWID;
+"""
+
+
+class SqliteStorage(Storage):
+    """Keeps crawls and content in a SQLite database, so the cache can fetch
+    and store pages without any cloud services.
+
+    Crawl entries are rows of crawl_entries. Each content document is a row of
+    documents, and its fields are rows of fields, so reads of a few fields
+    don't load the rest. Bytes are stored as BLOBs and everything else as
+    JSON.
+
+    The connection is shared by all threads, behind a lock.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def document(self, path: str) -> SqliteDocument:
+        return SqliteDocument(self, path)
+
+    def read_crawl_entries(
+        self, keys: Sequence[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], Optional[CrawlEntry]]:
+        entries: Dict[Tuple[str, str], Optional[CrawlEntry]] = {
+            key: None for key in keys
+        }
+        urls_by_digest = {(crawl, url_digest(url)): url for crawl, url in keys}
+        with self._lock:
+            for crawl in {crawl for crawl, _ in keys}:
+                digests = [
+                    digest
+                    for (key_crawl, digest) in urls_by_digest
+                    if key_crawl == crawl
+                ]
+                rows = self._connection.execute(
+                    "SELECT url_digest, status_code, headers, content, text_content, "
+                    + "history FROM crawl_entries WHERE crawl = ? AND url_digest IN "
+                    + f"({', '.join('?' * len(digests))})",
+                    (crawl, *digests),
+                )
+                for digest, *row in rows:
+                    url = urls_by_digest[(crawl, digest)]
+                    entries[(crawl, url)] = self._crawl_entry(*row)
+        return entries
+
+    def crawl_entries(self, crawl: str) -> Iterator[Tuple[bytes, CrawlEntry]]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT url_digest, status_code, headers, content, text_content, "
+                + "history FROM crawl_entries WHERE crawl = ?",
+                (crawl,),
+            ).fetchall()
+        for digest, *row in rows:
+            yield digest, self._crawl_entry(*row)
+
+    @staticmethod
+    def _crawl_entry(
+        status_code: int,
+        headers: str,
+        content: Optional[str],
+        text_content: Optional[str],
+        history: Optional[str],
+    ) -> CrawlEntry:
+        return CrawlEntry(
+            status_code=status_code,
+            headers=json.loads(headers),
+            content_path=content,
+            text_content_path=text_content,
+            history=RevisitHistory.from_dict(json.loads(history or "null")),
+        )
+
+    def write_crawl_entry(
+        self,
+        crawl: str,
+        url: str,
+        value: Dict[str, Any],
+        batch: Optional[SqliteBatch] = None,
+    ) -> None:
+        content = value.get("content")
+        text_content = value.get("text_content")
+        history = value.get("history")
+        statement = (
+            "INSERT OR REPLACE INTO crawl_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                crawl,
+                url_digest(url),
+                value["url"],
+                value["status_code"],
+                json.dumps(value.get("headers") or {}),
+                content.path if content is not None else None,
+                text_content.path if text_content is not None else None,
+                json.dumps(history) if history is not None else None,
+            ),
+        )
+        if batch is None:
+            self.execute_many([statement])
+        else:
+            batch.add(*statement)
+
+    def batch(self) -> SqliteBatch:
+        return SqliteBatch(self)
+
+    def content_writer(self) -> SqliteContentWriter:
+        return SqliteContentWriter(self)
+
+    def read_fields(
+        self, path: str, names: Optional[Sequence[str]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Returns the named fields of the document at path, or all of them, or
+        None if it doesn't exist."""
+        with self._lock:
+            if not self._connection.execute(
+                "SELECT 1 FROM documents WHERE path = ?", (path,)
+            ).fetchone():
+                return None
+            if names is None:
+                rows = self._connection.execute(
+                    "SELECT name, value FROM fields WHERE path = ?", (path,)
+                )
+            else:
+                rows = self._connection.execute(
+                    "SELECT name, value FROM fields WHERE path = ? AND name IN "
+                    + f"({', '.join('?' * len(names))})",
+                    (path, *names),
+                )
+            return {name: _decode_value(value) for name, value in rows}
+
+    def create_document(self, path: str, value: Dict[str, Any]) -> bool:
+        """Creates the document at path, and returns whether it didn't already
+        exist."""
+        with self._lock, self._connection:
+            created = self._connection.execute(
+                "INSERT OR IGNORE INTO documents VALUES (?)", (path,)
+            ).rowcount
+            if created:
+                self._connection.executemany(
+                    "INSERT INTO fields VALUES (?, ?, ?)",
+                    [
+                        (path, name, _encode_value(field))
+                        for name, field in value.items()
+                    ],
+                )
+        return bool(created)
+
+    def execute_many(self, statements: Sequence[Tuple[str, Tuple[Any, ...]]]) -> None:
+        """Executes statements in one transaction."""
+        with self._lock, self._connection:
+            for sql, params in statements:
+                self._connection.execute(sql, params)
+
+
+def _encode_value(value: Any) -> Union[bytes, str]:
+    if isinstance(value, bytes):
+        return value
+    return json.dumps(value)
+
+
+def _decode_value(value: Union[bytes, str]) -> Any:
+    if isinstance(value, bytes):
+        return value
+    return json.loads(value)
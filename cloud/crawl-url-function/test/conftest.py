@@ -94,3 +94,48 @@ def pull_from_crawl():
 @pytest.fixture
 def pull_from_changed_pages():
     yield from pull_from_topic("changed-pages")
+
+
+@pytest.fixture
+def pull_from_archive_pages():
+    yield from pull_from_topic("archive-pages")
+
+
+@pytest.fixture
+def crawl_batch_subscription():
+    """Creates the pull subscription that main.do_crawl_batch() drains."""
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(
+        config.CLOUD_PROJECT, config.CRAWL_SUBSCRIPTION
+    )
+    with subscriber:
+        subscriber.create_subscription(
+            request={
+                "name": subscription_path,
+                "topic": subscriber.topic_path(config.CLOUD_PROJECT, "crawl"),
+            }
+        )
+        try:
+            yield subscription_path
+        finally:
+            subscriber.delete_subscription(request={"subscription": subscription_path})
+
+
+@pytest.fixture
+def archive_pages_subscription():
+    """Creates the pull subscription that main.do_archive_pages() drains."""
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(
+        config.CLOUD_PROJECT, config.ARCHIVE_SUBSCRIPTION
+    )
+    with subscriber:
+        subscriber.create_subscription(
+            request={
+                "name": subscription_path,
+                "topic": subscriber.topic_path(config.CLOUD_PROJECT, "archive-pages"),
+            }
+        )
+        try:
+            yield subscription_path
+        finally:
+            subscriber.delete_subscription(request={"subscription": subscription_path})
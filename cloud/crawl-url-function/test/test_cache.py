@@ -1,7 +1,17 @@
+import threading
 from hashlib import sha256
 
 import cache
+import codec
+import pytest
 import requests
+import simhash
+import storage
+from google.cloud.firestore_v1.bulk_writer import (
+    BulkWriteFailure,
+    BulkWriterCreateOperation,
+)
+from google.rpc import code_pb2
 
 TEST_LINK_TARGET = "https://www.portland.gov/transportation/link/target"
 
@@ -37,6 +47,57 @@ def test_cached_response_stale(firestore_db):
     ]
 
 
+def test_links_reads_only_links(firestore_db):
+    response = cache.CachedResponse(
+        firestore_db,
+        firestore_db.TEST_PAGE1,
+        prev_crawl="2022-09-26",
+        curr_crawl="2022-09-27",
+    )
+    read_fields = []
+    content_reference = response.content_reference
+
+    class ProjectingReference:
+        def get(self, field_paths=None):
+            read_fields.append(field_paths)
+            return content_reference.get(field_paths=field_paths)
+
+    response.content_reference = ProjectingReference()
+    assert response.links == [
+        "https://www.portland.gov/transportation/page1",
+        "https://www.portland.gov/transportation/page2",
+    ]
+    assert read_fields == [["links"]]
+
+
+def test_responses_for(firestore_db):
+    responses = cache.Cache(firestore_db).responses_for(
+        [firestore_db.TEST_PAGE1, firestore_db.TEST_PAGE2, TEST_LINK_TARGET],
+        prev_crawl="2022-09-26",
+        curr_crawl="2022-09-27",
+    )
+    assert responses.keys() == {
+        firestore_db.TEST_PAGE1,
+        firestore_db.TEST_PAGE2,
+        TEST_LINK_TARGET,
+    }
+    assert responses[firestore_db.TEST_PAGE1].state == cache.CacheState.STALE
+    assert responses[firestore_db.TEST_PAGE1].headers == {
+        "content-type": "text/html",
+        "etag": firestore_db.THE_ETAG,
+    }
+    assert responses[firestore_db.TEST_PAGE2].state == cache.CacheState.STALE
+    assert responses[TEST_LINK_TARGET].state == cache.CacheState.ABSENT
+
+    responses = cache.Cache(firestore_db).responses_for(
+        [firestore_db.TEST_PAGE1, TEST_LINK_TARGET],
+        prev_crawl="2022-09-25",
+        curr_crawl="2022-09-26",
+    )
+    assert responses[firestore_db.TEST_PAGE1].state == cache.CacheState.FRESH
+    assert responses[TEST_LINK_TARGET].state == cache.CacheState.ABSENT
+
+
 def test_cached_response_fetch_304(firestore_db, requests_mock):
     requests_mock.get(
         firestore_db.TEST_PAGE1,
@@ -64,6 +125,37 @@ def test_cached_response_fetch_304(firestore_db, requests_mock):
     ]
 
 
+def test_fetch_prefetches_previous_crawl(firestore_db, requests_mock, monkeypatch):
+    read_started = threading.Event()
+    read_links = cache.read_links
+
+    def recording_read_links(doc):
+        read_started.set()
+        return read_links(doc)
+
+    monkeypatch.setattr(cache, "read_links", recording_read_links)
+
+    def respond(request, context):
+        # The previous crawl's links are read while the request is in flight.
+        assert read_started.wait(timeout=5)
+        context.status_code = 304
+        return ""
+
+    requests_mock.get(firestore_db.TEST_PAGE1, text=respond)
+    response = cache.CachedResponse(
+        firestore_db,
+        firestore_db.TEST_PAGE1,
+        prev_crawl="2022-09-26",
+        curr_crawl="2022-09-27",
+    )
+    fresh = response.fetch(requests.Session())
+    assert fresh.status_code == 200
+    assert fresh.links == [
+        "https://www.portland.gov/transportation/page1",
+        "https://www.portland.gov/transportation/page2",
+    ]
+
+
 def test_cached_response_fetch_200_no_old_text(firestore_db, requests_mock):
     PAGE_CONTENT = f'<a href="{TEST_LINK_TARGET}">Link</a>'.encode()
     requests_mock.get(
@@ -95,12 +187,11 @@ def test_cached_response_fetch_200_no_old_text(firestore_db, requests_mock):
     assert fresh.links == [
         TEST_LINK_TARGET,
     ]
-    assert fresh.content_reference.get().to_dict() == {
-        "links": [
-            TEST_LINK_TARGET,
-        ],
-        "content": PAGE_CONTENT.decode(),
-    }
+    stored = fresh.content_reference.get().to_dict()
+    assert stored["links"] == [TEST_LINK_TARGET]
+    # The content is stored compressed.
+    assert isinstance(stored["content"], bytes)
+    assert codec.decode_text(stored["content"]) == PAGE_CONTENT.decode()
 
 
 def test_cached_response_fetch_200_with_old_text(firestore_db, requests_mock):
@@ -139,15 +230,91 @@ def test_cached_response_fetch_200_with_old_text(firestore_db, requests_mock):
     assert fresh.links == [
         TEST_LINK_TARGET,
     ]
-    assert fresh.content_reference.get().to_dict() == {
-        "links": [
-            TEST_LINK_TARGET,
-        ],
-        "content": PAGE_CONTENT.decode(),
-    }
-    assert fresh.text_content_reference.get().to_dict() == {
-        "text": PAGE_MARKDOWN,
-    }
+    stored = fresh.content_reference.get().to_dict()
+    assert stored["links"] == [TEST_LINK_TARGET]
+    # The content is stored compressed.
+    assert isinstance(stored["content"], bytes)
+    assert codec.decode_text(stored["content"]) == PAGE_CONTENT.decode()
+    assert cache.read_text(fresh.text_content_reference) == PAGE_MARKDOWN
+
+
+def test_fetch_ignores_near_duplicates(firestore_db, requests_mock):
+    old_text = " ".join(f"Paragraph {i} about street repairs." for i in range(40))
+    firestore_db.collection("text-content").document("2").set({"text": old_text})
+    new_page = old_text.replace("Paragraph 10 ", "Paragraph ten ")
+    requests_mock.get(
+        firestore_db.TEST_PAGE2,
+        headers={"content-type": "text/html"},
+        content=f"<p>{new_page}</p>".encode(),
+    )
+
+    def fetch(near_duplicate_bits):
+        return cache.CachedResponse(
+            firestore_db,
+            firestore_db.TEST_PAGE2,
+            prev_crawl="2022-09-26",
+            curr_crawl="2022-09-27",
+            near_duplicate_bits=near_duplicate_bits,
+        ).fetch(requests.Session())
+
+    fresh = fetch(near_duplicate_bits=None)
+    assert fresh.change == cache.PresenceChange.CHANGED
+    assert fresh.diff.startswith("--- ")
+    # The new text is stored with its fingerprint.
+    stored = fresh.text_content_reference.get().to_dict()
+    assert stored["simhash"] == simhash.simhash(codec.decode_text(stored["text"]))
+
+    fresh = fetch(near_duplicate_bits=3)
+    assert fresh.change == cache.PresenceChange.SAME
+    assert fresh.diff == ""
+    # The previous crawl's text stays the one later crawls compare with, but
+    # the new content, with its links, is kept.
+    assert fresh.content_reference != firestore_db.collection("objects").document("3")
+    assert fresh.content_reference.get().to_dict()["links"] == fresh.links
+    assert fresh.text_content_reference == firestore_db.collection(
+        "text-content"
+    ).document("2")
+
+
+def test_fetch_skips_oversize_pages(firestore_db, requests_mock):
+    requests_mock.get(
+        TEST_LINK_TARGET,
+        headers={"content-type": "text/html"},
+        content=b"<p>Huge</p>" * 1000,
+    )
+    response = cache.CachedResponse(
+        firestore_db,
+        TEST_LINK_TARGET,
+        prev_crawl="2022-09-26",
+        curr_crawl="2022-09-27",
+        max_body_bytes=1000,
+    )
+    fresh = response.fetch(requests.Session())
+    assert fresh.status_code == 200
+    assert fresh.content_reference is None
+    assert fresh.links is None
+
+
+def test_fetch_keeps_stale_pages_that_grow_oversize(firestore_db, requests_mock):
+    requests_mock.get(
+        firestore_db.TEST_PAGE2,
+        headers={"content-type": "text/html"},
+        content=b"<p>Huge</p>" * 1000,
+    )
+    fresh = cache.CachedResponse(
+        firestore_db,
+        firestore_db.TEST_PAGE2,
+        prev_crawl="2022-09-26",
+        curr_crawl="2022-09-27",
+        max_body_bytes=1000,
+    ).fetch(requests.Session())
+    assert fresh.change == cache.PresenceChange.SAME
+    assert fresh.diff == ""
+    assert fresh.headers["etag"] == firestore_db.THE_ETAG
+    assert fresh.content_reference == firestore_db.collection("objects").document("3")
+    assert fresh.text_content_reference == firestore_db.collection(
+        "text-content"
+    ).document("2")
 
 
 def test_write_fresh_response(firestore_db):
@@ -158,7 +325,7 @@ def test_write_fresh_response(firestore_db):
     response.text_content_reference = firestore_db.collection("text_content").document(
         "3"
     )
-    response.write_to_firestore(firestore_db, "2022-09-27")
+    response.write(firestore_db, "2022-09-27")
     assert firestore_db.collection("crawl-2022-09-27").document(
         sha256(TEST_LINK_TARGET.encode()).hexdigest()
     ).get().to_dict() == {
@@ -168,3 +335,62 @@ def test_write_fresh_response(firestore_db):
         "content": response.content_reference,
         "text_content": response.text_content_reference,
     }
+
+
+def test_prev_crawl_index(firestore_db):
+    index = cache.Cache(firestore_db).prev_crawl_index("2022-09-26")
+    assert len(index) == 2
+    entry = index.get(firestore_db.TEST_PAGE2)
+    assert entry is not None
+    assert entry.status_code == 200
+    assert entry.content_path == firestore_db.collection("objects").document("3").path
+    assert (
+        entry.text_content_path
+        == firestore_db.collection("text-content").document("2").path
+    )
+    assert index.get(TEST_LINK_TARGET) is None
+
+    response = cache.Cache(firestore_db).response_for(
+        url=firestore_db.TEST_PAGE1, prev_crawl="2022-09-26", curr_crawl="2022-09-27"
+    )
+    assert response.state == cache.CacheState.STALE
+    assert response.content_reference == firestore_db.collection("objects").document(
+        "1"
+    )
+
+
+def test_create_if_absent(firestore_db):
+    doc = firestore_db.collection("text-content").document("2")
+    cache.create_if_absent(doc, {"text": "Different text\n"})
+    # Content-addressed documents are never overwritten.
+    assert doc.get().get("text") == "This is some text\n"
+
+    doc = firestore_db.collection("text_content").document("new")
+    cache.create_if_absent(doc, {"text": "New text\n"})
+    assert doc.get().get("text") == "New text\n"
+
+
+def test_content_writer_retries(firestore_db):
+    doc = firestore_db.collection("content").document("failed")
+
+    def failure(code: int, attempts: int) -> BulkWriteFailure:
+        return BulkWriteFailure(
+            operation=BulkWriterCreateOperation(
+                reference=doc, document_data={}, attempts=attempts
+            ),
+            code=code,
+            message="",
+        )
+
+    content_writer = storage.FirestoreContentWriter(firestore_db)
+    on_write_error = content_writer._on_write_error
+    assert not on_write_error(failure(code_pb2.ALREADY_EXISTS, 1), None)
+    assert on_write_error(failure(code_pb2.UNAVAILABLE, 1), None)
+    content_writer.flush()
+    assert not on_write_error(
+        failure(code_pb2.UNAVAILABLE, storage.FirestoreContentWriter.MAX_ATTEMPTS), None
+    )
+    # The page that refers to the document mustn't be committed.
+    with pytest.raises(storage.ContentWriteError, match="content/failed"):
+        content_writer.flush()
+    content_writer.close()
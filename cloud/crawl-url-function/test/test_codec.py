@@ -0,0 +1,19 @@
+from codec import decode_text, encode_text, fits_in_document
+
+
+def test_round_trip():
+    text = "<p>Some repetitive text</p>\n" * 100
+    encoded = encode_text(text)
+    assert len(encoded) < len(text) / 10
+    assert decode_text(encoded) == text
+    assert decode_text(encode_text("")) == ""
+
+
+def test_decodes_uncompressed_and_missing_fields():
+    assert decode_text("Stored before compression") == "Stored before compression"
+    assert decode_text(None) == ""
+
+
+def test_fits_in_document():
+    assert fits_in_document(b"x" * 1000)
+    assert not fits_in_document(b"x" * 1_000_000)
@@ -0,0 +1,106 @@
+from concurrent import futures
+
+from dedupe import CrawlProgress, UrlHashSet
+
+PAGE1 = "https://www.portland.gov/transportation"
+PAGE2 = "https://www.portland.gov/transportation/page2"
+
+
+def test_url_hash_set():
+    urls = UrlHashSet()
+    urls.add(PAGE2)
+    urls.add(PAGE1)
+    urls.add(PAGE2)
+    assert len(urls) == 2
+    assert PAGE1 in urls
+    assert PAGE2 in urls
+    assert PAGE1 + "/other" not in urls
+    urls.discard(PAGE1)
+    assert PAGE1 not in urls
+    assert len(urls) == 1
+
+
+def test_url_hash_set_round_trip():
+    urls = UrlHashSet()
+    urls.update(f"{PAGE1}/{i}" for i in range(100))
+    data = urls.to_bytes()
+    assert len(data) == 8 * 100
+    loaded = UrlHashSet.from_bytes(data)
+    assert len(loaded) == 100
+    assert all(f"{PAGE1}/{i}" in loaded for i in range(100))
+    assert PAGE2 not in loaded
+
+
+def test_crawl_progress_switches_crawls():
+    progress = CrawlProgress(None, checkpoint_interval=10)
+    progress.set_crawl("2022-09-27")
+    progress.mark_queued(PAGE1)
+    progress.mark_crawled(PAGE2)
+    progress.set_crawl("2022-09-27")
+    assert PAGE1 in progress.queued
+    assert PAGE2 in progress.crawled
+    progress.set_crawl("2022-10-04")
+    assert PAGE1 not in progress.queued
+    assert PAGE2 not in progress.crawled
+
+
+def test_crawl_progress_checkpoints_merge(firestore_db):
+    doc = firestore_db.collection("crawl_state").document("progress")
+    seeder = CrawlProgress(doc, checkpoint_interval=10)
+    worker = CrawlProgress(doc, checkpoint_interval=10)
+    worker.load()
+    seeder.set_crawl("2022-09-27")
+    seeder.mark_queued(PAGE1)
+    seeder.checkpoint()
+    # The worker loaded before the seeder checkpointed, but doesn't overwrite it.
+    worker.set_crawl("2022-09-27")
+    worker.mark_crawled(PAGE2)
+    worker.checkpoint()
+    assert PAGE1 in worker.queued
+    loaded = CrawlProgress(doc, checkpoint_interval=10)
+    loaded.load()
+    assert PAGE1 in loaded.queued
+    assert PAGE2 in loaded.crawled
+
+    # Progress for an older crawl gives way to the newer crawl's.
+    seeder.set_crawl("2022-10-04")
+    seeder.mark_queued(PAGE2)
+    seeder.checkpoint()
+    worker.checkpoint()
+    assert worker.crawl == "2022-10-04"
+    assert PAGE2 in worker.queued
+    assert PAGE2 not in worker.crawled
+    loaded.load()
+    assert loaded.crawl == "2022-10-04"
+    assert PAGE1 not in loaded.queued
+
+
+def test_crawl_progress_checkpoints_keep_discarded_urls_out(firestore_db):
+    doc = firestore_db.collection("crawl_state").document("progress")
+    progress = CrawlProgress(doc, checkpoint_interval=2)
+    progress.set_crawl("2022-09-27")
+    progress.mark_queued(PAGE1)
+    progress.checkpoint()
+    # The crawl of PAGE1 failed, so other links may queue it again.
+    progress.discard_queued(PAGE1)
+    progress.checkpoint()
+    assert PAGE1 not in progress.queued
+    loaded = CrawlProgress(doc, checkpoint_interval=2)
+    loaded.load()
+    assert PAGE1 not in loaded.queued
+    assert loaded.claim(PAGE1)
+
+
+def test_crawl_progress_claims_once():
+    progress = CrawlProgress(None, checkpoint_interval=10)
+    progress.set_crawl("2022-09-27")
+    progress.mark_crawled(PAGE2)
+    urls = [PAGE1, PAGE2] + [f"{PAGE1}/{i % 50}" for i in range(1000)]
+    with futures.ThreadPoolExecutor(max_workers=8) as executor:
+        claimed = [
+            url for url, ok in zip(urls, executor.map(progress.claim, urls)) if ok
+        ]
+    # Only the first of the threads that found each new URL claimed it.
+    assert sorted(claimed) == sorted([PAGE1] + [f"{PAGE1}/{i}" for i in range(50)])
+    assert PAGE1 in progress.queued
+    assert not progress.claim(PAGE1)
@@ -0,0 +1,38 @@
+from hashlib import sha256
+
+import requests
+from download import read_body
+
+URL = "https://www.portland.gov/transportation/big"
+
+
+def get(requests_mock, **kwargs):
+    requests_mock.get(URL, **kwargs)
+    return requests.get(URL, stream=True)
+
+
+def test_read_body(requests_mock):
+    content = b"<p>page</p>" * 10000
+    digest = sha256()
+    body = read_body(
+        get(requests_mock, content=content),
+        max_bytes=len(content),
+        update=digest.update,
+    )
+    assert body == content
+    assert digest.hexdigest() == sha256(content).hexdigest()
+
+
+def test_oversize_body(requests_mock):
+    response = get(requests_mock, content=b"x" * 200_000)
+    assert read_body(response, max_bytes=100_000) is None
+    # Only the chunks up to the limit were read.
+    assert response.raw.tell() < 200_000
+
+
+def test_oversize_content_length(requests_mock):
+    response = get(
+        requests_mock, content=b"small", headers={"content-length": "1000000"}
+    )
+    assert read_body(response, max_bytes=100_000) is None
+    assert response.raw.tell() == 0
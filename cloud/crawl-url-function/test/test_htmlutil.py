@@ -1,11 +1,21 @@
-from htmlutil import clean_content, urljoin
+import html2text
+import htmlutil
+from htmlutil import (
+    HtmlProcessor,
+    NoiseRules,
+    clean_content,
+    content_type_charset,
+    scrape_links,
+)
 
-
-def test_urljoin():
-    assert (
-        urljoin("http://example.com/transportation", "tel:1234567890").href
-        == "tel:1234567890"
-    )
+PAGE = b"""<html><head><meta charset="utf-8"><title>Streets</title>
+<script>var link = "<a href='/in-script'>";</script></head><body>
+<h1>Caf&eacute; &amp; streets</h1>
+<p><a href="page2#top">Next</a> <a href="/ads" rel="sponsored nofollow">Ad</a>
+<a href="https://www.portland.gov/transportation?utm_source=x&amp;page=2">More</a>
+<a name="anchor">No href</a></p>
+<ul><li>One</li><li>Two</li></ul>
+</body></html>"""
 
 
 def test_drupal():
@@ -62,3 +72,115 @@ def test_drawer():
     aria-labelledby="drawer__open"
 """
     )
+
+
+def test_html_processor():
+    processor = HtmlProcessor(PAGE, "https://www.portland.gov/transportation/page1")
+    assert list(processor.scrape_links()) == [
+        "https://www.portland.gov/transportation/page2",
+        "https://www.portland.gov/transportation?page=2",
+    ]
+    # The markdown is exactly html2text's.
+    assert processor.get_markdown() == html2text.html2text(
+        PAGE.decode(), baseurl="https://www.portland.gov/transportation/page1"
+    )
+    assert processor.encoding == "utf-8"
+
+
+def test_html_processor_links_without_markdown(monkeypatch):
+    def fail(self, data):
+        raise ValueError("html2text failed")
+
+    monkeypatch.setattr(html2text.HTML2Text, "handle", fail)
+    processor = HtmlProcessor(PAGE, "https://www.portland.gov/transportation/page1")
+    assert list(processor.scrape_links()) == [
+        "https://www.portland.gov/transportation/page2",
+        "https://www.portland.gov/transportation?page=2",
+    ]
+
+
+def test_html_processor_links_before_markdown():
+    processor = HtmlProcessor(PAGE, "https://www.portland.gov/transportation/page1")
+    links = list(processor.scrape_links())
+    processor.get_markdown()
+    assert list(processor.scrape_links()) == links
+
+
+def test_scrape_links(monkeypatch):
+    # Links split across chunks are still found.
+    monkeypatch.setattr(htmlutil, "LINK_CHUNK_BYTES", 7)
+    assert list(
+        scrape_links(PAGE, "https://www.portland.gov/transportation/page1")
+    ) == [
+        "https://www.portland.gov/transportation/page2",
+        "https://www.portland.gov/transportation?page=2",
+    ]
+    assert list(scrape_links(b"", "https://www.portland.gov/")) == []
+
+
+def test_scrape_links_encoding():
+    page = '<meta charset="windows-1252"><a href="/caf\xe9">Caf\xe9</a>'.encode(
+        "windows-1252"
+    )
+    expected = ["https://www.portland.gov/caf%C3%A9"]
+    assert list(scrape_links(page, "https://www.portland.gov/")) == expected
+    assert (
+        list(scrape_links(page, "https://www.portland.gov/", "windows-1252"))
+        == expected
+    )
+    assert (
+        list(scrape_links(page, "https://www.portland.gov/", "x-unknown")) == expected
+    )
+
+
+def test_content_type_charset():
+    assert content_type_charset("text/html; charset=UTF-8") == "UTF-8"
+    assert content_type_charset('text/html;charset="windows-1252"') == "windows-1252"
+    assert content_type_charset("text/html; param") is None
+    assert content_type_charset(None) is None
+
+
+def test_html_processor_declared_charset(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("The encoding shouldn't need detecting")
+
+    monkeypatch.setattr(htmlutil, "UnicodeDammit", fail)
+    page = '<meta charset="windows-1252"><p>Caf\xe9</p>'.encode("windows-1252")
+    processor = HtmlProcessor(page, "https://www.portland.gov/")
+    assert processor.encoding == "cp1252"
+    assert processor.text.endswith("Caf\xe9</p>")
+    # The Content-Type header wins over the page.
+    processor = HtmlProcessor(
+        page.decode("windows-1252").encode("utf-8"),
+        "https://www.portland.gov/",
+        "text/html; charset=utf-8",
+    )
+    assert processor.encoding == "utf-8"
+    assert processor.text.endswith("Caf\xe9</p>")
+
+
+def test_html_processor_wrong_charset():
+    # The page isn't UTF-8, whatever it says.
+    page = '<meta charset="utf-8"><p>Caf\xe9 \u201cquoted\u201d</p>'.encode(
+        "windows-1252"
+    )
+    processor = HtmlProcessor(page, "https://www.portland.gov/", "text/html")
+    # So it's detected instead.
+    assert processor.encoding != "utf-8"
+    assert processor.text == page.decode(processor.encoding)
+
+
+def test_noise_rules():
+    rules = NoiseRules(
+        [
+            ("session", rb"session=[0-9]+", b"session=0"),
+            ("timestamp", rb"<time>(?:[^<]+)</time>", b""),
+        ]
+    )
+    assert (
+        rules.clean(b"<a href='/?session=123'>a</a><time>1:00</time>?session=4")
+        == b"<a href='/?session=0'>a</a>?session=0"
+    )
+    assert rules.take_hits() == {"session": 2, "timestamp": 1}
+    assert rules.take_hits() == {}
+    assert NoiseRules([]).clean(b"unchanged") == b"unchanged"
@@ -0,0 +1,93 @@
+import difflib
+import random
+import re
+from typing import Any, Dict, List
+
+from linediff import diff_opcodes, unified_diff
+
+
+def apply_diff(a, diff_lines):
+    """Applies a unified diff to a, checking its context and hunk headers."""
+    result = []
+    i = 0
+    lines = iter(diff_lines)
+    for line in lines:
+        if line.startswith("@@"):
+            a_start, a_len, b_start, b_len = hunk_header(line)
+            result += a[i:a_start]
+            i = a_start
+            a_seen = b_seen = 0
+            while a_seen < a_len or b_seen < b_len:
+                line = next(lines)
+                if line[0] in " -":
+                    assert a[i] == line[1:]
+                    i += 1
+                    a_seen += 1
+                if line[0] in " +":
+                    result.append(line[1:])
+                    b_seen += 1
+            assert (a_seen, b_seen) == (a_len, b_len)
+            assert len(result) == b_start + b_len
+    return result + a[i:]
+
+
+def hunk_header(line):
+    match = re.fullmatch(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@\n", line)
+    assert match
+    a_start, a_len, b_start, b_len = match.groups()
+    a_len = 1 if a_len is None else int(a_len)
+    b_len = 1 if b_len is None else int(b_len)
+    # Empty ranges are numbered from the line before them.
+    a_start = int(a_start) - (1 if a_len else 0)
+    b_start = int(b_start) - (1 if b_len else 0)
+    return a_start, a_len, b_start, b_len
+
+
+def test_matches_difflib():
+    a = [f"line {i}\n" for i in range(30)]
+    b = list(a)
+    b[5] = "changed\n"
+    del b[20]
+    b.insert(25, "added\n")
+    for old, new in [(a, b), (a, []), ([], b), (a, a)]:
+        args: Dict[str, Any] = dict(
+            fromfile="url", fromfiledate="1", tofile="url", tofiledate="2"
+        )
+        assert list(unified_diff(old, new, **args)) == list(
+            difflib.unified_diff(old, new, **args)
+        )
+
+
+def test_random_diffs_apply():
+    rng = random.Random(0)
+    for _ in range(200):
+        a = [f"{rng.randrange(5)}\n" for _ in range(rng.randrange(20))]
+        b = [f"{rng.randrange(5)}\n" for _ in range(rng.randrange(20))]
+        diff = list(unified_diff(a, b, n=rng.randrange(4)))
+        assert apply_diff(a, diff) == b
+        # Myers' diffs are minimal.
+        opcodes, exact = diff_opcodes(a, b)
+        assert exact
+        matched = sum(i2 - i1 for tag, i1, i2, j1, j2 in opcodes if tag == "equal")
+        best = difflib.SequenceMatcher(None, a, b, autojunk=False)
+        assert matched >= sum(block.size for block in best.get_matching_blocks())
+
+
+def test_falls_back_when_over_limits():
+    a = ["header\n"] + [f"old {i}\n" for i in range(50)] + ["footer\n"]
+    b = ["header\n"] + [f"new {i}\n" for i in range(50)] + ["footer\n"]
+    all_limits: List[Dict[str, Any]] = [
+        dict(max_edits=10),
+        dict(max_lines=20),
+        dict(timeout=-1),
+    ]
+    for limits in all_limits:
+        diff = list(unified_diff(a, b, **limits))
+        assert diff[0].startswith("Too many changes")
+        assert diff[3] == "@@ -1,52 +1,52 @@\n"
+        assert apply_diff(a, diff[1:]) == b
+    assert diff_opcodes(a, b, max_edits=10)[0] == [
+        ("equal", 0, 1, 0, 1),
+        ("replace", 1, 51, 1, 51),
+        ("equal", 51, 52, 51, 52),
+    ]
@@ -1,20 +1,25 @@
 import base64
 import json
-from datetime import datetime, timedelta, timezone
+from concurrent import futures
+from datetime import datetime, timezone
 from hashlib import sha256
 
 import config
 import main
 import pytest
+import requests
 from cloudevents.http import CloudEvent
 from google.cloud import pubsub_v1
+from cache import Cache
+from ratelimit import RateLimiter
 
-main.crawl_delay = timedelta(seconds=0)
+main.rate_limiter = RateLimiter(0)
 
 
 @pytest.fixture(autouse=True)
-def reset_crawled_urls():
-    main.crawled_urls.clear()
+def reset_crawl_state():
+    main.crawl_progress.reset("")
+    main.crawl_manifest.invalidate()
 
 
 def test_crawl_url(
@@ -29,10 +34,6 @@ def test_crawl_url(
         headers={"etag": firestore_db.THE_ETAG + " next", "content-type": "text/html"},
         content=PAGE_CONTENT,
     )
-    requests_mock.get(
-        "https://web.archive.org/save/https://www.portland.gov/transportation",
-        status_code=200,
-    )
 
     event = CloudEvent(
         {"type": "", "source": ""},
@@ -74,6 +75,7 @@ def test_crawl_url(
         "text_content": firestore_db.collection("text_content").document(
             sha256(PAGE_MARKDOWN).hexdigest()
         ),
+        "history": {"change_rate": 1.0, "unchanged_crawls": 0, "skipped_crawls": 0},
     }
 
     assert json.loads(pull_from_crawl().message.data) == {
@@ -92,7 +94,332 @@ def test_crawl_url(
 -This is some text
 +[Link](https://www.portland.gov/transportation/page3)
 +
-"""
+""",
+    }
+
+
+def test_crawl_batch(
+    firestore_db, requests_mock, crawl_batch_subscription, pull_from_crawl
+):
+    TEST_LINK_TARGET = "https://www.portland.gov/transportation/page3"
+    PAGE_CONTENT = f'<a href="{TEST_LINK_TARGET}">Link</a>'.encode()
+    requests_mock.get(
+        firestore_db.TEST_PAGE1,
+        request_headers={"if-none-match": firestore_db.THE_ETAG},
+        headers={"etag": firestore_db.THE_ETAG + " next", "content-type": "text/html"},
+        content=PAGE_CONTENT,
+    )
+
+    publisher = pubsub_v1.PublisherClient()
+    crawl_topic_path = publisher.topic_path(config.CLOUD_PROJECT, "crawl")
+    message = json.dumps(
+        {
+            "prev_crawl": "2022-09-26",
+            "crawl": "2022-09-27",
+            "url": firestore_db.TEST_PAGE1,
+        }
+    ).encode()
+    # The duplicate should only be crawled once.
+    for _ in range(2):
+        publisher.publish(crawl_topic_path, message).result()
+
+    assert main.do_crawl_batch(max_messages=10) == 1
+
+    assert firestore_db.collection("crawl-2022-09-27").document(
+        sha256(firestore_db.TEST_PAGE1.encode()).hexdigest()
+    ).get().get("content") == firestore_db.collection("content").document(
+        sha256(PAGE_CONTENT).hexdigest()
+    )
+    # pull_from_crawl also sees the two messages published above.
+    assert sorted(
+        json.loads(pull_from_crawl().message.data)["url"] for _ in range(3)
+    ) == [
+        firestore_db.TEST_PAGE1,
+        firestore_db.TEST_PAGE1,
+        TEST_LINK_TARGET,
+    ]
+
+    # The queued link went to the batch subscription too. Take it, and nothing
+    # else is left: both copies of the crawled URL were acknowledged.
+    subscriber = pubsub_v1.SubscriberClient()
+    with subscriber:
+        received = subscriber.pull(
+            request={"subscription": crawl_batch_subscription, "max_messages": 10},
+            timeout=10,
+        ).received_messages
+        assert [json.loads(m.message.data)["url"] for m in received] == [
+            TEST_LINK_TARGET
+        ]
+        subscriber.acknowledge(
+            request={
+                "subscription": crawl_batch_subscription,
+                "ack_ids": [m.ack_id for m in received],
+            }
+        )
+    assert main.do_crawl_batch(max_messages=10) == 0
+    stats = firestore_db.collection("crawl_stats").document("2022-09-27").get()
+    assert stats.get("stages")["fetch"]["count"] == 1
+
+
+def test_crawl_batch_packed_urls(firestore_db, requests_mock, crawl_batch_subscription):
+    requests_mock.get(
+        firestore_db.TEST_PAGE1,
+        request_headers={"if-none-match": firestore_db.THE_ETAG},
+        status_code=304,
+    )
+    requests_mock.get(firestore_db.TEST_PAGE2, status_code=404)
+
+    publisher = pubsub_v1.PublisherClient()
+    crawl_topic_path = publisher.topic_path(config.CLOUD_PROJECT, "crawl")
+    for data in (
+        {"urls": [firestore_db.TEST_PAGE1, firestore_db.TEST_PAGE2]},
+        {"url": "https://www.portland.gov/transportation/page3"},
+    ):
+        data.update(prev_crawl="2022-09-26", crawl="2022-09-27")
+        publisher.publish(crawl_topic_path, json.dumps(data).encode()).result()
+
+    # The second message doesn't fit in the batch, so it's left for later.
+    assert main.do_crawl_batch(max_messages=10, max_urls=2) == 2
+
+    assert sorted(
+        doc.get().get("url")
+        for doc in firestore_db.collection("crawl-2022-09-27").list_documents()
+    ) == [firestore_db.TEST_PAGE1, firestore_db.TEST_PAGE2]
+
+
+def test_crawl_batch_drops_old_crawls(
+    firestore_db, requests_mock, crawl_batch_subscription
+):
+    requests_mock.get(
+        firestore_db.TEST_PAGE1,
+        request_headers={"if-none-match": firestore_db.THE_ETAG},
+        status_code=304,
+    )
+    firestore_db.collection("crawl_state").document("crawls").set(
+        {
+            "crawls": {
+                "2022-09-26": {"status": "complete"},
+                "2022-09-27": {"status": "running", "prev_crawl": "2022-09-26"},
+            }
+        }
+    )
+    main.crawl_progress.set_crawl("2022-09-27")
+    main.crawl_progress.mark_crawled(firestore_db.TEST_PAGE2)
+
+    publisher = pubsub_v1.PublisherClient()
+    crawl_topic_path = publisher.topic_path(config.CLOUD_PROJECT, "crawl")
+    for data in (
+        {"url": firestore_db.TEST_PAGE2, "crawl": "2022-09-20"},
+        {"url": firestore_db.TEST_PAGE1, "crawl": "2022-09-27"},
+    ):
+        data.update(prev_crawl="2022-09-26")
+        publisher.publish(crawl_topic_path, json.dumps(data).encode()).result()
+
+    # The redelivered message from an old crawl doesn't reset the progress.
+    assert main.do_crawl_batch(max_messages=10) == 1
+    assert main.crawl_progress.crawl == "2022-09-27"
+    assert firestore_db.TEST_PAGE2 in main.crawl_progress.crawled
+
+
+def test_failed_publish_can_be_queued_again(monkeypatch):
+    failed: futures.Future = futures.Future()
+    failed.set_exception(RuntimeError("Pub/Sub is down"))
+    sync_publisher = main.SynchronousPublisher(main.publisher)
+    monkeypatch.setattr(sync_publisher, "publish", lambda topic, data: failed)
+    link_publisher = main.OutboundLinkPublisher(
+        sync_publisher, "2022-09-26", "2022-09-27"
+    )
+    link_publisher.publish_many(["https://www.portland.gov/transportation/page3"])
+    assert (
+        "https://www.portland.gov/transportation/page3"
+        not in main.crawl_progress.queued
+    )
+
+
+def test_crawl_batch_lets_failed_urls_be_queued_again(
+    firestore_db, requests_mock, crawl_batch_subscription, monkeypatch
+):
+    requests_mock.get(
+        firestore_db.TEST_PAGE1,
+        request_headers={"if-none-match": firestore_db.THE_ETAG},
+        status_code=304,
+    )
+    publisher = pubsub_v1.PublisherClient()
+    crawl_topic_path = publisher.topic_path(config.CLOUD_PROJECT, "crawl")
+    message = {
+        "url": firestore_db.TEST_PAGE1,
+        "crawl": "2022-09-27",
+        "prev_crawl": "2022-09-26",
+    }
+    publisher.publish(crawl_topic_path, json.dumps(message).encode()).result()
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("Crawl failed")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(main, "crawl_one", fail)
+        assert main.do_crawl_batch(max_messages=10) == 0
+    assert firestore_db.TEST_PAGE1 not in main.crawl_progress.crawled
+
+    # A link from another page queues it again.
+    sync_publisher = main.SynchronousPublisher(main.publisher)
+    main.OutboundLinkPublisher(sync_publisher, "2022-09-26", "2022-09-27").publish_many(
+        [firestore_db.TEST_PAGE1]
+    )
+    sync_publisher.wait()
+    assert firestore_db.TEST_PAGE1 in main.crawl_progress.queued
+    assert main.do_crawl_batch(max_messages=10) == 1
+    assert firestore_db.TEST_PAGE1 in main.crawl_progress.crawled
+
+
+def test_crawl_url_queues_urls_it_runs_out_of_time_for_again(
+    firestore_db, pull_from_crawl, monkeypatch
+):
+    monkeypatch.setattr(config, "CRAWL_BATCH_TIME_BUDGET", -1)
+    message = {
+        "urls": [firestore_db.TEST_PAGE1, firestore_db.TEST_PAGE2],
+        "crawl": "2022-09-27",
+        "prev_crawl": "2022-09-26",
+    }
+    main.do_crawl_url(
+        CloudEvent(
+            {"type": "", "source": ""},
+            {"message": {"data": base64.b64encode(json.dumps(message).encode())}},
+        )
+    )
+    assert firestore_db.collection("crawl-2022-09-27").list_documents() == []
+    assert json.loads(pull_from_crawl().message.data) == message
+
+
+def test_crawl_batch_returns_messages_it_runs_out_of_time_for(
+    firestore_db, requests_mock, crawl_batch_subscription, monkeypatch
+):
+    requests_mock.get(
+        firestore_db.TEST_PAGE1,
+        request_headers={"if-none-match": firestore_db.THE_ETAG},
+        status_code=304,
+    )
+    publisher = pubsub_v1.PublisherClient()
+    crawl_topic_path = publisher.topic_path(config.CLOUD_PROJECT, "crawl")
+    message = {
+        "url": firestore_db.TEST_PAGE1,
+        "crawl": "2022-09-27",
+        "prev_crawl": "2022-09-26",
+    }
+    publisher.publish(crawl_topic_path, json.dumps(message).encode()).result()
+
+    monkeypatch.setattr(config, "CRAWL_BATCH_TIME_BUDGET", -1)
+    assert main.do_crawl_batch(max_messages=10) == 0
+    assert firestore_db.TEST_PAGE1 not in main.crawl_progress.crawled
+
+    monkeypatch.setattr(config, "CRAWL_BATCH_TIME_BUDGET", 40)
+    assert main.do_crawl_batch(max_messages=10) == 1
+
+
+def test_start_crawl_resumes(firestore_db, pull_from_crawl, monkeypatch):
+    monkeypatch.setattr(config, "SEED_URLS_PER_MESSAGE", 1)
+    monkeypatch.setattr(config, "SEED_TIME_BUDGET", -1)
+    # Runs out of time after the first seeded message.
+    assert not main.do_start_crawl()
+    curr_crawl = datetime.now(tz=timezone.utc).date().isoformat()
+    assert main.crawl_manifest.seed_cursor(curr_crawl) is not None
+    assert not main.crawl_manifest.seeded(curr_crawl)
+
+    monkeypatch.setattr(config, "SEED_TIME_BUDGET", 45)
+    assert main.do_start_crawl()
+    assert main.crawl_manifest.seeded(curr_crawl)
+    # Seeding is already done.
+    assert main.do_start_crawl()
+
+    assert json.loads(pull_from_crawl().message.data) == {
+        "url": firestore_db.TEST_PAGE1,
+        "crawl": curr_crawl,
+        "prev_crawl": "2022-09-26",
+    }
+    # TEST_PAGE1 was already queued, so it isn't seeded again.
+    assert json.loads(pull_from_crawl().message.data) == {
+        "urls": [firestore_db.TEST_PAGE2],
+        "crawl": curr_crawl,
+        "prev_crawl": "2022-09-26",
+    }
+
+
+def test_start_crawl_seeds_hot_pages_first(firestore_db, pull_from_crawl):
+    prev_collection = firestore_db.collection("crawl-2022-09-26")
+    prev_collection.document(
+        sha256(firestore_db.TEST_PAGE2.encode()).hexdigest()
+    ).update(
+        {"history": {"change_rate": 1.0, "unchanged_crawls": 0, "skipped_crawls": 0}}
+    )
+    for url, status_code, change_rate in (
+        ("https://www.portland.gov/transportation/gone", 404, 1.0),
+        ("https://www.portland.gov/transportation/cold", 200, 0.0),
+    ):
+        prev_collection.document(sha256(url.encode()).hexdigest()).set(
+            {
+                "url": url,
+                "status_code": status_code,
+                "history": {
+                    "change_rate": change_rate,
+                    "unchanged_crawls": 0,
+                    "skipped_crawls": 0,
+                },
+            }
+        )
+    assert main.do_start_crawl()
+
+    assert [
+        json.loads(pull_from_crawl().message.data).get("urls") for _ in range(3)
+    ] == [
+        # The crawl's root.
+        None,
+        [firestore_db.TEST_PAGE2],
+        ["https://www.portland.gov/transportation/cold"],
+    ]
+
+
+def test_crawl_skips_pages_not_due(firestore_db, requests_mock, monkeypatch):
+    # Unchanged for 8 crawls, so this page is revalidated every 3 crawls.
+    firestore_db.collection("crawl-2022-09-26").document(
+        sha256(firestore_db.TEST_PAGE1.encode()).hexdigest()
+    ).update(
+        {"history": {"change_rate": 0.0, "unchanged_crawls": 8, "skipped_crawls": 0}}
+    )
+    # Don't use an index of the previous crawl from before the update.
+    monkeypatch.setattr(main, "cache", Cache(firestore_db))
+
+    event = CloudEvent(
+        {"type": "", "source": ""},
+        {
+            "message": {
+                "data": base64.b64encode(
+                    json.dumps(
+                        {
+                            "prev_crawl": "2022-09-26",
+                            "crawl": "2022-09-27",
+                            "url": firestore_db.TEST_PAGE1,
+                        }
+                    ).encode()
+                )
+            }
+        },
+    )
+    main.do_crawl_url(event)
+
+    # The page wasn't fetched, but it's still carried into the current crawl.
+    assert not requests_mock.called
+    doc = (
+        firestore_db.collection("crawl-2022-09-27")
+        .document(sha256(firestore_db.TEST_PAGE1.encode()).hexdigest())
+        .get()
+        .to_dict()
+    )
+    assert doc["headers"]["etag"] == firestore_db.THE_ETAG
+    assert doc["content"] == firestore_db.collection("objects").document("1")
+    assert doc["history"] == {
+        "change_rate": 0.0,
+        "unchanged_crawls": 8,
+        "skipped_crawls": 1,
     }
 
 
@@ -104,14 +431,15 @@ def test_get_crawl(firestore_db):
     assert curr_crawl == datetime.now(tz=timezone.utc).date().isoformat()
 
 
-def test_added_page(firestore_db, requests_mock, pull_from_changed_pages):
+def test_added_page(
+    firestore_db, requests_mock, pull_from_changed_pages, pull_from_archive_pages
+):
     PAGE_URL = "https://www.portland.gov/transportation/new_page"
     requests_mock.get(
         PAGE_URL,
         headers={"etag": "an-etag", "content-type": "text/html"},
         content="I am a page".encode(),
     )
-    requests_mock.get("https://web.archive.org/save/" + PAGE_URL, status_code=200)
 
     event = CloudEvent(
         {"type": "", "source": ""},
@@ -137,17 +465,20 @@ def test_added_page(firestore_db, requests_mock, pull_from_changed_pages):
         "change": "ADD",
         "diff": "",
     }
+    assert json.loads(pull_from_archive_pages().message.data) == {
+        "crawl": "2022-09-27",
+        "url": PAGE_URL,
+    }
 
 
-def test_removed_page(firestore_db, requests_mock, pull_from_changed_pages):
+def test_removed_page(
+    firestore_db, requests_mock, pull_from_changed_pages, pull_from_archive_pages
+):
     requests_mock.get(
         firestore_db.TEST_PAGE1,
         request_headers={"if-none-match": firestore_db.THE_ETAG},
         status_code=404,
     )
-    requests_mock.get(
-        "https://web.archive.org/save/" + firestore_db.TEST_PAGE1, status_code=200
-    )
 
     event = CloudEvent(
         {"type": "", "source": ""},
@@ -173,6 +504,10 @@ def test_removed_page(firestore_db, requests_mock, pull_from_changed_pages):
         "change": "DEL",
         "diff": "",
     }
+    assert json.loads(pull_from_archive_pages().message.data) == {
+        "crawl": "2022-09-27",
+        "url": firestore_db.TEST_PAGE1,
+    }
 
 
 def test_unchanged_page(firestore_db, requests_mock, pull_from_changed_pages):
@@ -216,3 +551,96 @@ def test_unchanged_page(firestore_db, requests_mock, pull_from_changed_pages):
     publisher.publish(changed_pages_topic_path, json.dumps(test_pub).encode())
 
     assert json.loads(pull_from_changed_pages().message.data) == test_pub
+
+
+def test_get_crawl_from_manifest(firestore_db):
+    today = datetime.now(tz=timezone.utc).date().isoformat()
+    firestore_db.collection("crawl_state").document("crawls").set(
+        {
+            "crawls": {
+                "2022-09-19": {"status": "complete"},
+                "2022-09-23": {"status": "complete"},
+                today: {"status": "running", "prev_crawl": "2022-09-23"},
+            }
+        }
+    )
+    main.crawl_manifest.invalidate()
+    curr_crawl, prev_crawl = main.get_crawl(
+        {"url": "https://www.portland.gov/transportation"}
+    )
+    # The manifest wins over the crawl-2022-09-26 collection.
+    assert prev_crawl == "2022-09-23"
+    assert curr_crawl == today
+
+
+def test_archive_pages(firestore_db, requests_mock, archive_pages_subscription):
+    main.archive_rate_limiter = RateLimiter(0)
+    ARCHIVED_URL = (
+        f"https://web.archive.org/web/20220927000000/{firestore_db.TEST_PAGE1}"
+    )
+    requests_mock.get(
+        "https://web.archive.org/save/" + firestore_db.TEST_PAGE1,
+        status_code=302,
+        headers={"location": ARCHIVED_URL},
+    )
+    requests_mock.get(
+        "https://web.archive.org/save/" + firestore_db.TEST_PAGE2,
+        status_code=520,
+    )
+    publisher = pubsub_v1.PublisherClient()
+    archive_pages_topic_path = publisher.topic_path(
+        config.CLOUD_PROJECT, "archive-pages"
+    )
+    for page in (firestore_db.TEST_PAGE1, firestore_db.TEST_PAGE2):
+        publisher.publish(
+            archive_pages_topic_path,
+            json.dumps({"crawl": "2022-09-27", "url": page}).encode(),
+        ).result()
+
+    assert main.do_archive_pages(max_messages=10) == 1
+
+    archive = firestore_db.collection("archive-2022-09-27")
+    page1 = (
+        archive.document(sha256(firestore_db.TEST_PAGE1.encode()).hexdigest())
+        .get()
+        .to_dict()
+    )
+    assert page1["status_code"] == 302
+    assert page1["archived_url"] == ARCHIVED_URL
+    assert page1["attempts"] == 1
+    page2 = (
+        archive.document(sha256(firestore_db.TEST_PAGE2.encode()).hexdigest())
+        .get()
+        .to_dict()
+    )
+    assert page2["status_code"] == 520
+    assert page2["error"] == "HTTP 520"
+    assert "archived_url" not in page2
+
+
+def test_archive_pages_stops_at_retryable_failures(
+    firestore_db, requests_mock, archive_pages_subscription, monkeypatch
+):
+    main.archive_rate_limiter = RateLimiter(0)
+    requests_mock.get(
+        "https://web.archive.org/save/" + firestore_db.TEST_PAGE1,
+        exc=requests.exceptions.ConnectTimeout,
+    )
+    publisher = pubsub_v1.PublisherClient()
+    archive_pages_topic_path = publisher.topic_path(
+        config.CLOUD_PROJECT, "archive-pages"
+    )
+    for page in (firestore_db.TEST_PAGE1, firestore_db.TEST_PAGE2):
+        publisher.publish(
+            archive_pages_topic_path,
+            json.dumps({"crawl": "2022-09-27", "url": page}).encode(),
+        ).result()
+
+    # The timeout leaves the second page for later.
+    assert main.do_archive_pages(max_messages=10) == 0
+    assert requests_mock.call_count == 1
+
+    # So does running out of time.
+    monkeypatch.setattr(config, "ARCHIVE_BATCH_TIME_BUDGET", -1)
+    assert main.do_archive_pages(max_messages=10) == 0
+    assert requests_mock.call_count == 1
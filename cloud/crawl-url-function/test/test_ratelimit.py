@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+from ratelimit import AdaptiveRateLimiter, OutOfTime, RateLimiter, parse_retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+def test_spaces_out_fetches():
+    clock = FakeClock()
+    limiter = RateLimiter(1, clock=clock, sleep=clock.sleep)
+    limiter.acquire()
+    assert clock.now == 100
+    limiter.acquire()
+    assert clock.now == 101
+    # Time spent on other work counts towards the delay.
+    clock.now += 0.75
+    limiter.acquire()
+    assert clock.now == 102
+
+
+def test_reservations_queue_up():
+    clock = FakeClock()
+    limiter = RateLimiter(1, clock=clock, sleep=clock.sleep)
+    assert [limiter.reserve() for _ in range(3)] == [0, 1, 2]
+
+
+def test_burst():
+    clock = FakeClock()
+    limiter = RateLimiter(1, burst=2, clock=clock, sleep=clock.sleep)
+    assert [limiter.reserve() for _ in range(4)] == [0, 0, 1, 2]
+
+
+def test_idle_time_doesnt_accumulate_past_burst():
+    clock = FakeClock()
+    limiter = RateLimiter(1, clock=clock, sleep=clock.sleep)
+    clock.now += 60
+    assert [limiter.reserve() for _ in range(2)] == [0, 1]
+
+
+def test_defer():
+    clock = FakeClock()
+    limiter = RateLimiter(1, clock=clock, sleep=clock.sleep)
+    limiter.acquire()
+    limiter.defer(30)
+    limiter.acquire()
+    assert clock.now == 130
+    # Deferring to before the next slot does nothing.
+    limiter.defer(0.5)
+    assert limiter.reserve() == 1
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("soon") is None
+    later = datetime.now(timezone.utc) + timedelta(seconds=60)
+    seconds = parse_retry_after(format_datetime(later, usegmt=True))
+    assert seconds is not None and 55 < seconds <= 60
+
+
+def test_adaptive_backs_off_and_recovers():
+    clock = FakeClock()
+    limiter = AdaptiveRateLimiter(
+        1, min_interval=0.5, max_interval=8, clock=clock, sleep=clock.sleep
+    )
+    limiter.record(200, latency=0.1)
+    assert limiter.interval == 0.9
+    limiter.record(503, latency=0.1)
+    assert limiter.interval == 1.8
+    limiter.record(429, latency=0.1, retry_after=1)
+    limiter.record(429, latency=0.1)
+    limiter.record(429, latency=0.1)
+    assert limiter.interval == 8
+    assert limiter.rate == 1 / 8
+    for _ in range(100):
+        limiter.record(200, latency=0.1)
+    assert limiter.interval == 0.5
+
+
+def test_adaptive_backs_off_on_slow_responses():
+    clock = FakeClock()
+    limiter = AdaptiveRateLimiter(
+        1, min_interval=0.5, max_interval=8, clock=clock, sleep=clock.sleep
+    )
+    limiter.record(200, latency=1)
+    assert limiter.interval == 1
+    limiter.record(200, latency=10)
+    assert limiter.interval == 2
+
+
+def test_deadline():
+    clock = FakeClock()
+    limiter = RateLimiter(1, clock=clock, sleep=clock.sleep)
+    limiter.acquire(deadline=100)
+    assert limiter.reserve(deadline=100.5) is None
+    with pytest.raises(OutOfTime):
+        limiter.acquire(deadline=100.5)
+    assert clock.now == 100
+    # Nothing was reserved by the failed attempts.
+    limiter.acquire(deadline=101)
+    assert clock.now == 101
+
+
+def test_max_defer():
+    clock = FakeClock()
+    limiter = RateLimiter(1, clock=clock, sleep=clock.sleep, max_defer=60)
+    limiter.defer(86400)
+    limiter.acquire()
+    assert clock.now == 160
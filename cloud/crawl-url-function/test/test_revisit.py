@@ -0,0 +1,55 @@
+import pytest
+from revisit import RevisitHistory, RevisitPolicy
+
+POLICY = RevisitPolicy(max_interval=4, hot_change_rate=0.25)
+
+
+def test_history_round_trip():
+    history = RevisitHistory(change_rate=0.5, unchanged_crawls=2, skipped_crawls=1)
+    assert RevisitHistory.from_dict(history.to_dict()).to_dict() == history.to_dict()
+    assert RevisitHistory.from_dict(None) is None
+    assert RevisitHistory.from_dict({}) is None
+
+
+def test_history_after_fetch():
+    history = RevisitHistory.first_fetch(changed=True)
+    assert history.to_dict() == {
+        "change_rate": 1.0,
+        "unchanged_crawls": 0,
+        "skipped_crawls": 0,
+    }
+    history = history.after_fetch(changed=False).after_skip().after_fetch(False)
+    assert history.change_rate == pytest.approx(0.7 * 0.7)
+    assert history.unchanged_crawls == 2
+    assert history.skipped_crawls == 0
+    history = history.after_fetch(changed=True)
+    assert history.unchanged_crawls == 0
+    assert history.change_rate == pytest.approx(0.7 * 0.7 * 0.7 + 0.3)
+
+
+def test_interval_grows_while_unchanged():
+    assert POLICY.interval(None) == 1
+    assert [
+        POLICY.interval(RevisitHistory(unchanged_crawls=unchanged))
+        for unchanged in (0, 3, 4, 8, 12, 100)
+    ] == [1, 1, 2, 3, 4, 4]
+
+
+def test_is_due():
+    assert POLICY.is_due(None)
+    history = RevisitHistory(unchanged_crawls=8)
+    assert not POLICY.is_due(history)
+    assert not POLICY.is_due(history.after_skip())
+    assert POLICY.is_due(history.after_skip().after_skip())
+    # Never skip pages when max_interval is 1.
+    assert RevisitPolicy(max_interval=1, hot_change_rate=0.25).is_due(history)
+
+
+def test_is_hot():
+    assert not POLICY.is_hot(None)
+    assert POLICY.is_hot(RevisitHistory.first_fetch(changed=True))
+    assert not POLICY.is_hot(RevisitHistory.first_fetch(changed=False))
+    history = RevisitHistory.first_fetch(changed=True)
+    for _ in range(4):
+        history = history.after_fetch(changed=False)
+    assert not POLICY.is_hot(history)
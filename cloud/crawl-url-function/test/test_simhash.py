@@ -0,0 +1,23 @@
+from simhash import distance, simhash
+
+TEXT = " ".join(
+    f"Paragraph {i} of the page about street maintenance." for i in range(50)
+)
+
+
+def test_similar_texts_are_close():
+    edited = TEXT.replace("Paragraph 20 ", "Paragraph twenty ")
+    assert distance(simhash(TEXT), simhash(edited)) <= 3
+    # Case and punctuation don't matter.
+    assert simhash(TEXT.upper().replace(".", "!")) == simhash(TEXT)
+
+
+def test_different_texts_are_far():
+    other = " ".join(f"Section {i} describes parking permits." for i in range(50))
+    assert distance(simhash(TEXT), simhash(other)) > 10
+
+
+def test_fits_in_signed_64_bits():
+    for text in [TEXT, "", "one", "two words"]:
+        assert -(1 << 63) <= simhash(text) < 1 << 63
+    assert distance(-1, 0) == 64
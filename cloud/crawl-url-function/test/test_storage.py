@@ -0,0 +1,72 @@
+import cache
+import pytest
+import requests
+from storage import SqliteStorage
+
+URL = "https://www.portland.gov/transportation/page"
+LINK = "https://www.portland.gov/transportation/link/target"
+
+
+@pytest.fixture
+def sqlite_storage():
+    storage = SqliteStorage(":memory:")
+    yield storage
+    storage.close()
+
+
+def crawl(storage, curr_crawl, prev_crawl, index_prev_crawl=True):
+    """Crawls URL into curr_crawl, and returns its FreshResponse."""
+    response = cache.Cache(storage, index_prev_crawl=index_prev_crawl).response_for(
+        url=URL, curr_crawl=curr_crawl, prev_crawl=prev_crawl
+    )
+    with storage.content_writer() as content_writer:
+        fresh = response.fetch(requests.Session(), content_writer=content_writer)
+    batch = storage.batch()
+    fresh.write(storage, curr_crawl, batch)
+    batch.commit()
+    return fresh
+
+
+@pytest.mark.parametrize("index_prev_crawl", [True, False])
+def test_crawls_offline(sqlite_storage, requests_mock, index_prev_crawl):
+    requests_mock.get(
+        URL,
+        headers={"content-type": "text/html", "etag": "1"},
+        content=f'<p>First version</p><a href="{LINK}">Link</a>'.encode(),
+    )
+    fresh = crawl(sqlite_storage, "2022-09-26", "2022-09-25", index_prev_crawl)
+    assert fresh.change == cache.PresenceChange.NEW
+    assert fresh.links == [LINK]
+
+    response = cache.Cache(sqlite_storage).response_for(
+        url=URL, curr_crawl="2022-09-26", prev_crawl="2022-09-25"
+    )
+    assert response.state == cache.CacheState.FRESH
+
+    requests_mock.get(URL, request_headers={"if-none-match": "1"}, status_code=304)
+    fresh = crawl(sqlite_storage, "2022-09-27", "2022-09-26", index_prev_crawl)
+    assert fresh.change == cache.PresenceChange.SAME
+    assert fresh.headers["etag"] == "1"
+    assert fresh.links == [LINK]
+
+    requests_mock.get(
+        URL,
+        headers={"content-type": "text/html", "etag": "2"},
+        content=b"<p>Second version</p>",
+    )
+    fresh = crawl(sqlite_storage, "2022-09-28", "2022-09-27", index_prev_crawl)
+    assert fresh.change == cache.PresenceChange.CHANGED
+    assert "-First version" in fresh.diff
+    assert "+Second version" in fresh.diff
+    assert fresh.links == []
+    assert fresh.history.unchanged_crawls == 0
+
+
+def test_documents(sqlite_storage):
+    doc = sqlite_storage.document("text_content/1")
+    assert not doc.get().exists
+    cache.create_if_absent(doc, {"text": b"compressed", "simhash": -5})
+    cache.create_if_absent(doc, {"text": b"different"})
+    assert doc.get().to_dict() == {"text": b"compressed", "simhash": -5}
+    assert doc.get(field_paths=["simhash"]).to_dict() == {"simhash": -5}
+    assert doc == sqlite_storage.document("text_content/1")
@@ -0,0 +1,64 @@
+import pytest
+from timing import Histogram, StageTimer, percentile
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_span_records_duration():
+    clock = FakeClock()
+    timer = StageTimer(clock=clock)
+    with timer.span("fetch"):
+        clock.now += 0.25
+    with pytest.raises(ValueError):
+        with timer.span("fetch"):
+            clock.now += 2
+            raise ValueError()
+    assert timer.summary() == {
+        "fetch": {
+            "count": 2,
+            "seconds": 2.25,
+            "mean_seconds": 1.125,
+            "max_seconds": 2,
+        }
+    }
+
+
+def test_histogram_buckets():
+    histogram = Histogram()
+    for seconds in (0.0005, 0.001, 0.05, 0.05, 100):
+        histogram.add(seconds)
+    buckets = histogram.firestore_update()["buckets"]
+    assert {name: increment.value for name, increment in buckets.items()} == {
+        "1ms": 2,
+        "100ms": 2,
+        "inf": 1,
+    }
+    stored = {"1ms": 2, "100ms": 2, "inf": 1}
+    assert percentile(stored, 0.5) == "100ms"
+    assert percentile(stored, 0.9) == "inf"
+    assert percentile({}, 0.5) == "-"
+
+
+def test_flush(firestore_db):
+    clock = FakeClock()
+    timer = StageTimer(clock=clock)
+    doc = firestore_db.collection("crawl_stats").document("2022-09-27")
+    for seconds in (0.5, 1.5):
+        with timer.span("parse"):
+            clock.now += seconds
+        timer.flush(doc)
+    # Nothing to add.
+    timer.flush(doc)
+    assert timer.summary() == {}
+
+    stats = doc.get().to_dict()["stages"]["parse"]
+    assert stats["count"] == 2
+    assert stats["seconds"] == 2
+    assert stats["max_seconds"] == 1.5
+    assert stats["buckets"] == {"1000ms": 1, "3000ms": 1}
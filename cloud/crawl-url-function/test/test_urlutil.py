@@ -0,0 +1,56 @@
+import pytest
+from urlutil import canonicalize_link, clean_url, urljoin
+
+BASE = "https://www.portland.gov/transportation/page1"
+
+
+def test_urljoin():
+    assert (
+        urljoin("http://example.com/transportation", "tel:1234567890").href
+        == "tel:1234567890"
+    )
+
+
+@pytest.mark.parametrize(
+    "href",
+    [
+        "https://www.portland.gov",
+        "https://www.portland.gov/transportation",
+        "https://WWW.portland.gov/a/../b",
+        "https://www.portland.gov/a/.",
+        "https://www.portland.gov:443/x",
+        "http://0x7f.1/",
+        "https://www.portland.gov/x?utm_source=a&b=2#top",
+        "https://www.portland.gov/café",
+        "/transportation/../x",
+        "//www.example.com/x",
+        "page2",
+        "../up",
+        "?q=1",
+        "#top",
+        "  /x  ",
+        "tel:5031234567",
+        "https:foo",
+        "https://ex ample.com/",
+    ],
+)
+def test_canonicalize_link(href):
+    try:
+        expected = clean_url(urljoin(BASE, href.strip())).href
+    except ValueError:
+        expected = None
+    assert canonicalize_link(BASE, href) == expected
+    # Cached results are the same.
+    assert canonicalize_link(BASE, href) == expected
+
+
+def test_path_absolute_links_share_cache_entries():
+    assert canonicalize_link(BASE, "/shared/link?a=1") == (
+        "https://www.portland.gov/shared/link?a=1"
+    )
+    assert canonicalize_link("https://www.portland.gov/other/", "/shared/link?a=1") == (
+        "https://www.portland.gov/shared/link?a=1"
+    )
+    assert canonicalize_link("https://example.com/", "/shared/link?a=1") == (
+        "https://example.com/shared/link?a=1"
+    )
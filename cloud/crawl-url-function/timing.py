@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from google.cloud import firestore
+
+# Upper bounds of the histogram buckets, in milliseconds. The last bucket holds
+# everything slower.
+BUCKET_BOUNDS_MS = [1, 3, 10, 30, 100, 300, 1000, 3000, 10000, 30000]
+
+
+def bucket_name(index: int) -> str:
+    if index < len(BUCKET_BOUNDS_MS):
+        return f"{BUCKET_BOUNDS_MS[index]}ms"
+    return "inf"
+
+
+class Histogram:
+    """The distribution of one stage's durations."""
+
+    __slots__ = ("count", "seconds", "max_seconds", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.buckets[bisect_left(BUCKET_BOUNDS_MS, seconds * 1000)] += 1
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "seconds": round(self.seconds, 3),
+            "mean_seconds": round(self.seconds / self.count, 3) if self.count else 0,
+            "max_seconds": round(self.max_seconds, 3),
+        }
+
+    def firestore_update(self) -> Dict[str, Any]:
+        """Returns transforms that add this histogram to one stored in
+        Firestore."""
+        return {
+            "count": firestore.Increment(self.count),
+            "seconds": firestore.Increment(self.seconds),
+            "max_seconds": firestore.Maximum(self.max_seconds),
+            "buckets": {
+                bucket_name(i): firestore.Increment(count)
+                for i, count in enumerate(self.buckets)
+                if count
+            },
+        }
+
+
+class StageTimer:
+    """Records how long each stage of crawling takes.
+
+    Wrap each stage in `with timer.span("stage"):`. The histograms accumulate
+    until flush() writes them out, and it's safe to record from several
+    threads.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.perf_counter):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.histograms: Dict[str, Histogram] = {}
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.record(stage, self._clock() - start)
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.add(seconds)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                stage: histogram.summary()
+                for stage, histogram in sorted(self.histograms.items())
+            }
+
+    def flush(
+        self,
+        doc: Optional[firestore.DocumentReference],
+        batch: Optional[firestore.WriteBatch] = None,
+    ) -> None:
+        """Logs the stages recorded since the last flush, adds them to the totals
+        in doc, and starts over.
+
+        If batch is given, the write to doc is added to it instead of being sent
+        immediately.
+        """
+        with self._lock:
+            histograms, self.histograms = self.histograms, {}
+        if not histograms:
+            return
+        summary = {
+            stage: histogram.summary()
+            for stage, histogram in sorted(histograms.items())
+        }
+        logging.info(
+            "Stage timings: %s",
+            ", ".join(
+                f"{stage} {stats['count']}x{stats['mean_seconds']}s"
+                for stage, stats in summary.items()
+            ),
+            extra={"json_fields": {"stage_timings": summary}},
+        )
+        if doc is None:
+            return
+        value = {
+            "stages": {
+                stage: histogram.firestore_update()
+                for stage, histogram in histograms.items()
+            },
+            "updated": firestore.SERVER_TIMESTAMP,
+        }
+        if batch is None:
+            doc.set(value, merge=True)
+        else:
+            batch.set(doc, value, merge=True)
+
+
+def percentile(buckets: Dict[str, int], fraction: float) -> str:
+    """Returns the name of the bucket that holds the given fraction of a
+    stored histogram's samples."""
+    names: List[str] = [bucket_name(i) for i in range(len(BUCKET_BOUNDS_MS) + 1)]
+    total = sum(buckets.get(name, 0) for name in names)
+    seen = 0
+    for name in names:
+        seen += buckets.get(name, 0)
+        if total and seen >= fraction * total:
+            return name
+    return "-"
+
+
+# The process-wide timer, shared by the cache and the entry points.
+stage_timer = StageTimer()
+span = stage_timer.span
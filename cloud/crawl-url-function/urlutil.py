@@ -0,0 +1,74 @@
+import functools
+import re
+import urllib.parse
+from typing import Optional
+
+import whatwg_url
+
+# How many distinct links canonicalize_link() remembers. The same navigation
+# and footer links appear on every page.
+LINK_CACHE_SIZE = 16384
+
+# Links that are already canonical: absolute http(s) URLs with a lowercase,
+# non-numeric host, and a path that needs no escaping, with no port, query or
+# fragment.
+_CANONICAL_LINK = re.compile(
+    r"https?://(?:[a-z0-9-]+\.)*[a-z][a-z0-9-]*(?:/[A-Za-z0-9_~.-]*)*"
+)
+_DOT_SEGMENT = re.compile(r"/\.\.?(?:/|$)")
+_HAS_AUTHORITY = re.compile(r"[A-Za-z][A-Za-z0-9+.-]*://")
+_ORIGIN = re.compile(r"[A-Za-z][A-Za-z0-9+.-]*://[^/?#\\]*")
+
+
+def canonicalize_link(base: str, href: str) -> Optional[str]:
+    """Returns the canonical absolute URL that href links to from base, or None
+    if it doesn't parse.
+
+    This is clean_url(urljoin(base, href)), memoized. Links whose resolution
+    doesn't depend on all of base share cache entries across pages, and links
+    that are already canonical skip parsing altogether.
+    """
+    href = href.strip()
+    if _CANONICAL_LINK.fullmatch(href) and not _DOT_SEGMENT.search(href):
+        if href.count("/") == 2:
+            # An empty path is "/".
+            return href + "/"
+        return href
+    if _HAS_AUTHORITY.match(href):
+        # Only the base's scheme could matter, and only if href's is the same.
+        return _canonicalize(None, href)
+    if href.startswith("/") and not href.startswith("//"):
+        # A path-absolute link only depends on the base's origin.
+        origin = _ORIGIN.match(base)
+        if origin is not None:
+            return _canonicalize(origin.group(), href)
+    return _canonicalize(base, href)
+
+
+@functools.lru_cache(maxsize=LINK_CACHE_SIZE)
+def _canonicalize(base: Optional[str], href: str) -> Optional[str]:
+    try:
+        url = urljoin(base, href)
+    except whatwg_url.UrlParserError:
+        return None
+    return clean_url(url).href
+
+
+def urljoin(base: Optional[str], relative: str) -> whatwg_url.Url:
+    """Join a base URL and a relative URL, removing any fragments."""
+    url = whatwg_url.parse_url(relative, base=base)
+    url.fragment = None
+    return url
+
+
+def clean_url(url: whatwg_url.Url) -> whatwg_url.Url:
+    """Removes query parameters that don't affect the resulting page."""
+    if url.query is None:
+        return url
+    query = urllib.parse.parse_qs(url.query)
+    query.pop("utm_medium", None)
+    query.pop("utm_source", None)
+    query.pop("_ga", None)
+    query.pop("_gl", None)
+    url.query = urllib.parse.urlencode(query, doseq=True) or None
+    return url
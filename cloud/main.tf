@@ -49,6 +49,22 @@ resource "google_pubsub_topic" "changed-pages" {
   }
 }
 
+resource "google_pubsub_schema" "archive-pages" {
+  name       = "archive-pages"
+  type       = "AVRO"
+  definition = file("archive-pages.avsc")
+}
+
+resource "google_pubsub_topic" "archive-pages" {
+  name = "archive-pages"
+
+  depends_on = [google_pubsub_schema.archive-pages]
+  schema_settings {
+    schema   = google_pubsub_schema.archive-pages.id
+    encoding = "JSON"
+  }
+}
+
 resource "google_bigquery_dataset" "crawl" {
   dataset_id  = "crawl"
   description = "Holds crawl results"
@@ -151,14 +167,14 @@ output "start-crawl-uri" {
   value = google_cloudfunctions2_function.start-crawl.service_config[0].uri
 }
 
-resource "google_cloudfunctions2_function" "crawl-url" {
-  name        = "crawl-url"
-  description = "Crawl one URL from the crawl PubSub topic"
+resource "google_cloudfunctions2_function" "crawl-batch" {
+  name        = "crawl-batch"
+  description = "Crawl a batch of URLs pulled from the crawl PubSub topic"
   location    = "us-west1"
 
   build_config {
     runtime     = "python310"
-    entry_point = "crawl_url"
+    entry_point = "crawl_batch"
     source {
       storage_source {
         bucket = google_storage_bucket.function-source.name
@@ -167,13 +183,6 @@ resource "google_cloudfunctions2_function" "crawl-url" {
     }
   }
 
-  event_trigger {
-    pubsub_topic   = google_pubsub_topic.crawl.id
-    event_type     = "google.cloud.pubsub.topic.v1.messagePublished"
-    retry_policy   = "RETRY_POLICY_DO_NOT_RETRY"
-    trigger_region = "us-west1"
-  }
-
   service_config {
     max_instance_count = 1
     available_memory   = "256Mi"
@@ -181,30 +190,87 @@ resource "google_cloudfunctions2_function" "crawl-url" {
   }
 }
 
-resource "google_pubsub_subscription" "crawl-to-crawl-url" {
-  name  = "eventarc-us-west1-crawl-url-528516-sub-455"
-  topic = google_pubsub_topic.crawl.name
-  ack_deadline_seconds = 600
+resource "google_pubsub_subscription" "crawl-batch" {
+  name                       = "crawl-batch"
+  topic                      = google_pubsub_topic.crawl.name
+  ack_deadline_seconds       = 600
   message_retention_duration = "86400s"
 
-  labels = {
-    goog-eventarc = ""
+  retry_policy {
+    maximum_backoff = "600s"
+    minimum_backoff = "10s"
   }
+}
 
-  push_config {
-    push_endpoint = google_cloudfunctions2_function.crawl-url.service_config[0].uri
+resource "google_cloud_scheduler_job" "crawl-batch" {
+  name        = "crawl-batch"
+  description = "Drain the crawl subscription in batches while a crawl is running"
+  # Every minute for the 12 hours after start-pbot-crawl.
+  schedule         = "* 2-13 * * 5"
+  time_zone        = "Etc/UTC"
+  attempt_deadline = "120s"
 
+  http_target {
+    http_method = "POST"
+    uri         = google_cloudfunctions2_function.crawl-batch.service_config[0].uri
     oidc_token {
-      audience              = google_cloudfunctions2_function.crawl-url.service_config[0].uri
-      service_account_email = "918189120933-compute@developer.gserviceaccount.com"
+      service_account_email = "scheduler-service-account@pbot-site-crawler.iam.gserviceaccount.com"
+      audience              = google_cloudfunctions2_function.crawl-batch.service_config[0].uri
     }
-    attributes = {
-      x-goog-version = "v1"
+  }
+}
+
+resource "google_cloudfunctions2_function" "archive-pages" {
+  name        = "archive-pages"
+  description = "Ask the Web Archive to save a batch of changed pages"
+  location    = "us-west1"
+
+  build_config {
+    runtime     = "python310"
+    entry_point = "archive_pages"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.function-source.name
+        object = google_storage_bucket_object.crawl-url-function.name
+      }
     }
   }
+
+  service_config {
+    max_instance_count = 1
+    available_memory   = "256Mi"
+    timeout_seconds    = 300
+  }
+}
+
+resource "google_pubsub_subscription" "archive-pages" {
+  name                       = "archive-pages"
+  topic                      = google_pubsub_topic.archive-pages.name
+  ack_deadline_seconds       = 600
+  message_retention_duration = "604800s"
+
+  # Nacked pages back off exponentially between attempts.
   retry_policy {
     maximum_backoff = "600s"
-    minimum_backoff = "10s"
+    minimum_backoff = "60s"
+  }
+}
+
+resource "google_cloud_scheduler_job" "archive-pages" {
+  name        = "archive-pages"
+  description = "Drain the archive-pages subscription during and after each crawl"
+  # Every 2 minutes on the crawl's day and the day after.
+  schedule         = "*/2 * * * 5,6"
+  time_zone        = "Etc/UTC"
+  attempt_deadline = "320s"
+
+  http_target {
+    http_method = "POST"
+    uri         = google_cloudfunctions2_function.archive-pages.service_config[0].uri
+    oidc_token {
+      service_account_email = "scheduler-service-account@pbot-site-crawler.iam.gserviceaccount.com"
+      audience              = google_cloudfunctions2_function.archive-pages.service_config[0].uri
+    }
   }
 }
 
@@ -215,8 +281,12 @@ resource "google_cloud_scheduler_job" "start-pbot-crawl" {
   time_zone        = "Etc/UTC"
   attempt_deadline = "600s"
 
+  # start_crawl returns 503 when seeding runs out of time, and each retry
+  # resumes from its checkpoint.
   retry_config {
-    retry_count = 3
+    retry_count          = 10
+    min_backoff_duration = "10s"
+    max_backoff_duration = "60s"
   }
 
   http_target {
@@ -231,3 +301,22 @@ resource "google_cloud_scheduler_job" "start-pbot-crawl" {
 
 # Building the webserver image is even more complicated: just keep using the
 # Makefile for that.
+
+resource "google_logging_metric" "crawl-rate" {
+  name        = "crawl-rate"
+  description = "The adaptive crawl rate, in fetches per second, each time it changes"
+  filter      = "resource.type=\"cloud_run_revision\" AND jsonPayload.crawl_rate:*"
+  metric_descriptor {
+    metric_kind = "DELTA"
+    value_type  = "DISTRIBUTION"
+    unit        = "1/s"
+  }
+  value_extractor = "EXTRACT(jsonPayload.crawl_rate)"
+  bucket_options {
+    exponential_buckets {
+      num_finite_buckets = 16
+      growth_factor      = 1.5
+      scale              = 0.02
+    }
+  }
+}
@@ -0,0 +1,39 @@
+#! /usr/bin/env python3
+
+import argparse
+import sys
+from pathlib import Path
+
+from google.cloud import firestore
+
+sys.path += [str(Path(__file__).parent.parent / "crawl-url-function")]
+from timing import percentile  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Show where a crawl spent its time, by stage."
+)
+parser.add_argument("crawl", help="The crawl's date, in YYYY-MM-DD format.")
+args = parser.parse_args()
+
+db = firestore.Client()
+stats = db.collection("crawl_stats").document(args.crawl).get().to_dict() or {}
+
+print("stage\tcount\ttotal\tmean\tp50\tp90\tmax")
+for stage, stage_stats in sorted(
+    stats.get("stages", {}).items(), key=lambda item: -item[1].get("seconds", 0)
+):
+    count = stage_stats.get("count", 0)
+    seconds = stage_stats.get("seconds", 0)
+    buckets = stage_stats.get("buckets", {})
+    print(
+        f"{stage}\t{count}\t{seconds:.1f}s\t{seconds / count if count else 0:.3f}s"
+        + f"\t≤{percentile(buckets, 0.5)}\t≤{percentile(buckets, 0.9)}"
+        + f"\t{stage_stats.get('max_seconds', 0):.3f}s"
+    )
+
+noise_rule_hits = stats.get("noise_rule_hits", {})
+if noise_rule_hits:
+    print()
+    print("noise rule\thits")
+    for name, hits in sorted(noise_rule_hits.items(), key=lambda item: -item[1]):
+        print(f"{name}\t{hits}")
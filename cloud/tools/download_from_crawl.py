@@ -4,11 +4,15 @@ import argparse
 import sys
 from datetime import date
 from hashlib import sha256
+from pathlib import Path
 from typing import Union
 
 import google.cloud.firestore_v1.base_query
 from google.cloud import firestore
 
+sys.path += [str(Path(__file__).parent.parent / "crawl-url-function")]
+from codec import decode_text  # noqa: E402
+
 parser = argparse.ArgumentParser(description="Download a file from the crawl.")
 parser.add_argument(
     "crawl_date", type=date.fromisoformat, help="Date of the crawl to download from"
@@ -43,7 +47,7 @@ if args.raw:
     content_snapshot = content_ref.get()
     if not content_snapshot.exists:
         sys.exit(f"Didn't save content for {args.url}")
-    content: str = content_snapshot.get("content")
+    content = decode_text(content_snapshot.to_dict().get("content"))
     args.o.write(content)
 else:
     text_content_ref: firestore.DocumentReference = crawl_info.get("text_content")
@@ -52,5 +56,5 @@ else:
     text_content_snapshot = text_content_ref.get()
     if not text_content_snapshot.exists:
         sys.exit(f"Didn't save text content for {args.url}")
-    text_content: str = text_content_snapshot.get("text")
+    text_content = decode_text(text_content_snapshot.to_dict().get("text"))
     args.o.write(text_content)
@@ -34,5 +34,6 @@ fi
 
 $SCRIPTDIR/create_topic.py --project=$PROJECT --topic=crawl --schema_id=crawl --schema=$SCRIPTDIR/../crawl.avsc --message_encoding=json
 $SCRIPTDIR/create_topic.py --project=$PROJECT --topic=changed-pages --schema_id=changed-pages --schema=$SCRIPTDIR/../changed-pages.avsc --message_encoding=json
+$SCRIPTDIR/create_topic.py --project=$PROJECT --topic=archive-pages --schema_id=archive-pages --schema=$SCRIPTDIR/../archive-pages.avsc --message_encoding=json
 
 "$@"
@@ -0,0 +1,17 @@
+#! /usr/bin/env python3
+
+import argparse
+
+from google.cloud import firestore
+
+parser = argparse.ArgumentParser(description="List the crawls in the manifest.")
+args = parser.parse_args()
+
+db = firestore.Client()
+manifest = db.collection("crawl_state").document("crawls").get().to_dict() or {}
+
+for crawl, info in sorted(manifest.get("crawls", {}).items()):
+    print(
+        f"{crawl}\t{info.get('status', '?')}\t{info.get('pages', 0)} pages"
+        + f"\tprev={info.get('prev_crawl', '')}"
+    )
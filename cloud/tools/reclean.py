@@ -0,0 +1,117 @@
+#! /usr/bin/env python3
+
+import argparse
+import sys
+from collections import Counter
+from concurrent import futures
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from google.cloud import firestore
+
+sys.path += [str(Path(__file__).parent.parent / "crawl-url-function")]
+from codec import decode_text  # noqa: E402
+from htmlutil import noise_rules  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Reapply config.NOISE_RULES to a crawl's stored content, and "
+    + "report how the content hashes would change, without fetching anything."
+)
+parser.add_argument("crawl", help="The crawl's date, in YYYY-MM-DD format.")
+parser.add_argument(
+    "--prev",
+    help="An earlier crawl to compare with, to count the pages that would no "
+    + "longer look changed.",
+)
+parser.add_argument(
+    "--threads", type=int, default=16, help="How many batches to read at once."
+)
+args = parser.parse_args()
+
+db = firestore.Client()
+
+BATCH_SIZE = 100
+
+
+def content_paths(crawl: str) -> Dict[str, str]:
+    """Returns the path of each URL's content document in crawl."""
+    paths = {}
+    for snapshot in db.collection(f"crawl-{crawl}").select(["url", "content"]).stream():
+        content = snapshot.get("content")
+        if content is not None:
+            paths[snapshot.get("url")] = content.path
+    return paths
+
+
+def reclean_batch(paths: List[str]) -> Dict[str, Tuple[str, str]]:
+    """Returns the hash of each content document's stored content, and the hash
+    it would have under the current rules, keyed by its path.
+
+    The stored content is text, so both hashes are of its UTF-8 encoding. That
+    isn't always the document's ID, which hashes the page in its original
+    charset, but it means that only the rules can make the two hashes differ.
+    """
+    hashes = {}
+    for snapshot in db.get_all(
+        [db.document(path) for path in paths], field_paths=["content"]
+    ):
+        content = (snapshot.to_dict() or {}).get("content")
+        if content is None:
+            # Too big to store, so there's nothing to reclean.
+            hashes[snapshot.reference.path] = (snapshot.id, snapshot.id)
+            continue
+        encoded = decode_text(content).encode("utf-8", errors="backslashreplace")
+        hashes[snapshot.reference.path] = (
+            sha256(encoded).hexdigest(),
+            sha256(noise_rules.clean(encoded)).hexdigest(),
+        )
+    return hashes
+
+
+def reclean(paths: List[str]) -> Dict[str, Tuple[str, str]]:
+    """Maps each content path to its old and new hashes, reading in parallel."""
+    hashes: Dict[str, Tuple[str, str]] = {}
+    batches = [paths[i : i + BATCH_SIZE] for i in range(0, len(paths), BATCH_SIZE)]
+    with futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for done, batch_hashes in enumerate(executor.map(reclean_batch, batches), 1):
+            hashes.update(batch_hashes)
+            print(f"[{done}/{len(batches)}] batches recleaned", file=sys.stderr)
+    return hashes
+
+
+crawls = [args.crawl] + ([args.prev] if args.prev else [])
+paths_by_crawl = {crawl: content_paths(crawl) for crawl in crawls}
+unique_paths = sorted(
+    {path for paths in paths_by_crawl.values() for path in paths.values()}
+)
+hashes = reclean(unique_paths)
+new_hashes = {path: new_hash for path, (_, new_hash) in hashes.items()}
+
+paths = paths_by_crawl[args.crawl]
+old_ids = {path.rsplit("/", 1)[-1] for path in paths.values()}
+new_ids = {new_hashes[path] for path in paths.values()}
+print(f"Pages with content in {args.crawl}: {len(paths)}")
+changed_hashes = sum(
+    old_hash != new_hash
+    for old_hash, new_hash in (hashes[path] for path in paths.values())
+)
+print(f"Pages whose hash would change: {changed_hashes}")
+print(f"Distinct contents: {len(old_ids)} now, {len(new_ids)} after recleaning")
+
+if args.prev:
+    prev_paths = paths_by_crawl[args.prev]
+    common = [url for url in paths if url in prev_paths]
+    changed_before = sum(paths[url] != prev_paths[url] for url in common)
+    changed_after = sum(
+        new_hashes[paths[url]] != new_hashes[prev_paths[url]] for url in common
+    )
+    print(
+        f"Pages changed since {args.prev}: {changed_before} now, "
+        + f"{changed_after} after recleaning, of {len(common)}"
+    )
+
+print("Rule hits:")
+hits = Counter(noise_rules.take_hits())
+for name in noise_rules.names:
+    print(f"  {name}\t{hits[name]}")
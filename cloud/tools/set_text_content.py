@@ -2,13 +2,18 @@
 
 import argparse
 import asyncio
+import sys
 from datetime import date
 from hashlib import sha256
+from pathlib import Path
 from typing import List
 
 import html2text
 from google.cloud import firestore
 
+sys.path += [str(Path(__file__).parent.parent / "crawl-url-function")]
+from codec import decode_text, encode_text  # noqa: E402
+
 parser = argparse.ArgumentParser(
     description="Set all the text contents for a crawl that only has full HTML."
 )
@@ -47,12 +52,15 @@ async def update_text_for_ref(ref: firestore.AsyncDocumentReference) -> None:
         if content_ref is None:
             return
         content: firestore.DocumentSnapshot = await db.document(content_ref.path).get()  # type: ignore
-        markdown = html2text.html2text(content.get("content"), baseurl=url)
+        markdown = html2text.html2text(
+            decode_text(content.to_dict().get("content")), baseurl=url
+        )
         text_ref = db.collection("text_content").document(
             sha256(markdown.encode()).hexdigest()
         )
         await asyncio.gather(
-            text_ref.set({"text": markdown}), ref.update({"text_content": text_ref})
+            text_ref.set({"text": encode_text(markdown)}),
+            ref.update({"text_content": text_ref}),
         )
     finally:
         finished_docs += 1
@@ -1,11 +1,15 @@
 import hashlib
 import os.path
+import sys
 from enum import Enum, auto
 from pathlib import Path
 from typing import Dict
 
 import requests
 
+sys.path += [str(Path(__file__).parent.parent / 'cloud' / 'crawl-url-function')]
+from config import MAX_BODY_BYTES
+from download import read_body
 from util import is_good_html_response
 
 
@@ -25,12 +29,14 @@ class Cache:
     a URL. We don't currently escape any characters.
     """
 
-    def __init__(self, origin: str, cache_root: Path, current_crawl: Path, prev_crawl: Path):
+    def __init__(self, origin: str, cache_root: Path, current_crawl: Path, prev_crawl: Path,
+                 max_body_bytes: int = MAX_BODY_BYTES):
         self.origin = origin
         self.cache_root = cache_root
         self.current_crawl = current_crawl
         self.prev_crawl = prev_crawl
         self.object_store = cache_root/"objects"
+        self.max_body_bytes = max_body_bytes
 
     def response_for(self, url: str) -> 'CachedResponse':
         """Loads url from the cache into a CachedResponse."""
@@ -60,6 +66,8 @@ class CachedResponse:
         self.status_code = 0
         self.headers: Dict[str, str] = {}
         self.content = None
+        # The SHA-256 of content, if it was computed while downloading.
+        self.content_digest = None
 
         assert url.startswith(cache.origin), url
         self.url_path = url[len(cache.origin):].lstrip('/')
@@ -120,9 +128,16 @@ class CachedResponse:
                 self.status_code = response.status_code
                 self.headers = dict(response.headers.lower_items())
                 self.content = None
-                # We don't need the content of non-HTML files or failed responses.
+                # We don't need the content of non-HTML files or failed responses,
+                # so they're never read.
                 if is_good_html_response(response):
-                    self.content = response.content
+                    digest = hashlib.sha256()
+                    body = read_body(response, self.cache.max_body_bytes, digest.update)
+                    if body is None:
+                        print(f'Not storing {self.url}: body is over {self.cache.max_body_bytes} bytes')
+                    else:
+                        self.content = body
+                        self.content_digest = digest.hexdigest()
             self.state = CacheState.FRESH
         self._write()
 
@@ -141,7 +156,7 @@ class CachedResponse:
             for name, value in self.headers.items():
                 file_size += headers.write(f'{name}: {value}\n')
         if self.content:
-            digest = hashlib.sha256(self.content).hexdigest()
+            digest = self.content_digest or hashlib.sha256(self.content).hexdigest()
             cas_file = self.cache.object_store/digest[:2]/digest[2:]
             cas_file.parent.mkdir(parents=True, exist_ok=True)
             try:
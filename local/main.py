@@ -1,16 +1,18 @@
 import curses
-import time
-import urllib.parse
-from datetime import date, datetime, timedelta, timezone
+import os
+import sys
+from concurrent import futures
+from datetime import date, datetime, timezone
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Set, Union
 from urllib.robotparser import RobotFileParser
 
 import requests
-import whatwg_url
-from bs4 import BeautifulSoup
 
-from cache import Cache, CacheState
+sys.path += [str(Path(__file__).parent.parent / 'cloud' / 'crawl-url-function')]
+from cache import Cache, CacheState, CachedResponse
+from htmlutil import content_type_charset, scrape_links
+from ratelimit import RateLimiter, parse_retry_after
 
 URL_ORIGIN = 'https://www.portland.gov/'
 
@@ -18,6 +20,16 @@ SESSION = requests.Session()
 USER_AGENT = 'PBOT Crawler'
 SESSION.headers.update({'user-agent': USER_AGENT})
 
+# How many pages can be fetched at once. The rate limiter still spaces out the
+# requests, but one slow response doesn't hold up the next.
+FETCH_THREADS = 4
+# How many pages can wait for a fetch thread before we stop looking up more.
+MAX_QUEUED_FETCHES = 4 * FETCH_THREADS
+# How many processes parse pages for links.
+PARSE_PROCESSES = os.cpu_count() or 1
+# How many pages can wait to be parsed before we stop fetching more.
+MAX_QUEUED_PARSES = 4 * PARSE_PROCESSES
+
 
 class Crawl:
     def __init__(self, out_dir: Path, roots: List[str], max_size: Optional[int] = None):
@@ -40,21 +52,12 @@ class Crawl:
         self.max_size = max_size
         self.robots = RobotFileParser(URL_ORIGIN + 'robots.txt')
         self.robots.read()
-        self.crawl_delay = timedelta(
-            seconds=self.robots.crawl_delay(USER_AGENT) or 1)
-
-        self.next_fetch = datetime.now(timezone.utc)
+        self.rate_limiter = RateLimiter(
+            float(self.robots.crawl_delay(USER_AGENT) or 1))
 
     def ok_to_crawl(self, url: str):
         return url.startswith('https://www.portland.gov/transportation') and self.robots.can_fetch(USER_AGENT, url)
 
-    def wait_for_next_fetch(self):
-        """Wait until the next fetch is allowed."""
-        now = datetime.now(timezone.utc)
-        if now < self.next_fetch:
-            time.sleep((self.next_fetch - now).total_seconds())
-        self.next_fetch = datetime.now(timezone.utc) + self.crawl_delay
-
     def is_complete(self):
         return len(self.pending) == 0 or (self.max_size is not None and self.total_size > self.max_size)
 
@@ -88,62 +91,79 @@ def newest_subdirectory_except(out_dir: Path, except_dir: Path) -> Union[Path, N
     return newest
 
 
-def fetch_one(crawl: Crawl, stdscr):
-    """Fetch one URL from the crawl, and add its links back to the crawl.
+def crawl_all(crawl: Crawl, stdscr):
+    """Crawl until the crawl is complete.
+
+    This thread looks up each URL in the cache, then hands pages that need
+    fetching to a pool of fetch threads, which share the crawl's rate limiter,
+    and pages with content to a pool of parsing processes. Cache hits and
+    parsing carry on while the fetches wait their turn, and each stage's queue
+    is bounded so that pages don't pile up in memory.
 
     Args:
-        crawl: The crawl to fetch from.
+        crawl: The crawl to run.
         stdscr: A curses window to write progress into
     """
-    url = crawl.pending.pop()
-    crawl.complete.add(url)
-
-    describe_progress(url, crawl, stdscr)
-
-    assert crawl.ok_to_crawl(url), url
-
-    response = crawl.cache.response_for(url)
-    if response.state != CacheState.FRESH:
-        crawl.wait_for_next_fetch()
-        response.fetch(SESSION)
-    crawl.total_size += response.file_size
-
-    if response.status_code//100 == 3:
-        crawl.add_pending(response.headers['location'])
-        return
-
-    if response.content:
-        soup = BeautifulSoup(response.content, 'lxml')
-        for link in soup.find_all('a', href=True):
-            # Skip nofollow links. This isn't strictly required by the spec, but
-            # nofollow links seem less valuable, so we can focus on the other
-            # ones. We'll see if this misses anything important.
-            if 'nofollow' in link.get('rel', []):
-                continue
-            try:
-                href = urljoin(url, link['href'].strip())
-            except whatwg_url.UrlParserError:
-                continue
-
-            crawl.add_pending(clean_url(href).href)
-
+    with futures.ThreadPoolExecutor(FETCH_THREADS, thread_name_prefix='fetch') as fetchers, \
+            futures.ProcessPoolExecutor(PARSE_PROCESSES) as parsers:
+        fetches: Dict[futures.Future, str] = {}
+        parses: Set[futures.Future] = set()
+
+        def handle_response(response: CachedResponse, url: str):
+            crawl.total_size += response.file_size
+            if response.status_code//100 == 3:
+                crawl.add_pending(response.headers['location'])
+            elif response.content:
+                charset = content_type_charset(response.headers.get('content-type'))
+                parses.add(parsers.submit(parse_links, response.content, url, charset))
+
+        while True:
+            while (not crawl.is_complete() and len(fetches) < MAX_QUEUED_FETCHES
+                   and len(parses) < MAX_QUEUED_PARSES):
+                url = crawl.pending.pop()
+                crawl.complete.add(url)
+                describe_progress(url, crawl, stdscr)
+                assert crawl.ok_to_crawl(url), url
+
+                response = crawl.cache.response_for(url)
+                if response.state == CacheState.FRESH:
+                    handle_response(response, url)
+                else:
+                    fetches[fetchers.submit(fetch, crawl, response)] = url
+
+            if not fetches and not parses:
+                break
+            done, _ = futures.wait(
+                [*fetches, *parses], return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                if future in fetches:
+                    handle_response(future.result(), fetches.pop(future))
+                else:
+                    parses.remove(future)
+                    for href in future.result():
+                        crawl.add_pending(href)
+
+
+def fetch(crawl: Crawl, response: CachedResponse) -> CachedResponse:
+    """Freshen a response from the network, when the rate limiter allows.
+
+    Runs in a fetch thread.
+    """
+    crawl.rate_limiter.acquire()
+    response.fetch(SESSION)
+    if response.status_code in (429, 503):
+        retry_after = parse_retry_after(response.headers.get('retry-after'))
+        if retry_after is not None:
+            crawl.rate_limiter.defer(retry_after)
+    return response
 
-def urljoin(base: str, relative: str) -> whatwg_url.Url:
-    """Join a base URL and a relative URL, removing any fragments."""
-    url = whatwg_url.parse_url(relative, base=base)
-    url.fragment = None
-    return url
 
+def parse_links(content: bytes, url: str, charset: Optional[str]) -> List[str]:
+    """Find the links to crawl in a page.
 
-def clean_url(url: whatwg_url.Url) -> whatwg_url.Url:
-    """Removes query parameters that don't affect the resulting page."""
-    query = urllib.parse.parse_qs(url.query)
-    query.pop('utm_medium', None)
-    query.pop('utm_source', None)
-    query.pop("_ga", None)
-    query.pop("_gl", None)
-    url.query = urllib.parse.urlencode(query, doseq=True) or None
-    return url
+    Runs in a parsing process, so it has to be picklable.
+    """
+    return list(scrape_links(content, url, charset))
 
 
 def describe_progress(current_url: str, crawl: Crawl, stdscr):
@@ -165,8 +185,7 @@ def main(stdscr=None):
     crawl = Crawl(Path('out'), [
                   'https://www.portland.gov/transportation'], max_size=1*1024*1024*1024)
 
-    while not crawl.is_complete():
-        fetch_one(crawl, stdscr)
+    crawl_all(crawl, stdscr)
 
     return crawl
 